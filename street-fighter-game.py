@@ -2,6 +2,29 @@ import pygame
 import sys
 import random
 import math
+import argparse
+import socket
+import struct
+import time
+import heapq
+import asyncio
+import multiprocessing
+from multiprocessing import shared_memory
+import pickle
+import threading
+import queue
+import tracemalloc
+import gc
+import gzip
+import json
+import zlib
+import os
+import bisect
+from array import array
+try:
+    import numpy as np
+except ImportError:
+    np = None  # only the batched simulation kernel needs it
 from pygame.locals import *
 
 # Initialize pygame
@@ -32,15 +55,18 @@ CHARACTER_SELECT = 1
 FIGHTING = 2
 GAME_OVER = 3
 
-# Create screen and clock
-screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
-pygame.display.set_caption("Python Street Fighter")
+# Scaling modes for presenting the internal canvas
+SCALE_FAST = "fast"
+SCALE_SMOOTH = "smooth"
+
+# Clock (the window is created in main() once the display options are known)
 clock = pygame.time.Clock()
 
 # Load fonts
 title_font = pygame.font.SysFont('Impact', 64)
 menu_font = pygame.font.SysFont('Arial', 36)
 hud_font = pygame.font.SysFont('Arial', 24)
+profiler_font = pygame.font.SysFont('Arial', 16)
 
 # Sound effects
 try:
@@ -54,6 +80,8 @@ except:
 
 # Simple particle system for special effects
 class Particle:
+    __slots__ = ("x", "y", "color", "vel_x", "vel_y", "size", "lifetime", "age")
+    
     def __init__(self, x, y, color, vel_x, vel_y, size, lifetime):
         self.x = x
         self.y = y
@@ -61,7 +89,7 @@ class Particle:
         self.vel_x = vel_x
         self.vel_y = vel_y
         self.size = size
-        self.lifetime = lifetime
+        self.lifetime = lifetime * particle_lifetime
         self.age = 0
     
     def update(self):
@@ -73,15 +101,289 @@ class Particle:
         self.size = max(1, self.size * 0.95)
         return self.age < self.lifetime
     
-    def draw(self, surface):
+    def age_only(self):
+        # Off-camera particles just run out their lifetime
+        self.age += 1
+        return self.age < self.lifetime
+    
+    def copy(self):
+        particle = object.__new__(Particle)
+        particle.x, particle.y, particle.color = self.x, self.y, self.color
+        particle.size, particle.lifetime, particle.age = self.size, self.lifetime, self.age
+        return particle
+    
+    def draw(self, surface, camera_x=0):
+        x = self.x - camera_x
+        if x + self.size < 0 or x - self.size > SCREEN_WIDTH:
+            return
         alpha = int(255 * (1 - self.age / self.lifetime))
-        particle_color = (*self.color, alpha)
-        s = pygame.Surface((self.size * 2, self.size * 2), pygame.SRCALPHA)
-        pygame.draw.circle(s, particle_color, (self.size, self.size), self.size)
-        surface.blit(s, (self.x - self.size, self.y - self.size))
+        s = particle_sprite(self.color, int(self.size))
+        s.set_alpha(alpha)
+        surface.blit(s, (x - self.size, self.y - self.size))
+
+# Particle effect density. 1.0 is full detail; headless simulation sets 0 so
+# no particles are spawned at all.
+effect_scale = 1.0
+
+def effect_count(count):
+    return int(count * effect_scale)
+
+def effect_chance(probability):
+    return effect_scale > 0 and random.random() < probability * effect_scale
+
+# Set while spectating faster than real time
+muted = False
+
+def play_sound(sound):
+    if effect_scale > 0 and not muted:
+        sound.play()
+
+# Adaptive effects quality. Each level sets the particle density, how long
+# particles live and how often the animated background is re-rolled; the
+# governor drops a level while frames run over budget and climbs back once
+# there has been headroom for a while.
+QUALITY_LEVELS = [
+    # (name, effect scale, particle lifetime scale, background animation interval)
+    ("high", 1.0, 1.0, 1),
+    ("medium", 0.6, 0.75, 2),
+    ("low", 0.3, 0.5, 4),
+    ("minimal", 0.1, 0.35, 8),
+]
+QUALITY_NAMES = [level[0] for level in QUALITY_LEVELS]
+QUALITY_DROP_FRAMES = 15      # Frames over budget before dropping a level
+QUALITY_RAISE_FRAMES = 180    # Frames with headroom before raising a level
+QUALITY_HEADROOM = 0.5        # Fraction of the budget that counts as headroom
+
+particle_lifetime = 1.0
+background_interval = 1
+
+def set_quality(level):
+    global effect_scale, particle_lifetime, background_interval
+    _, effect_scale, particle_lifetime, background_interval = QUALITY_LEVELS[level]
+
+class QualityGovernor:
+    def __init__(self, level=0, adaptive=True, budget=1 / FPS):
+        self.level = level
+        self.adaptive = adaptive
+        self.budget = budget
+        self.frame_start = 0.0
+        self.frame_time = 0.0
+        self.average = 0.0
+        self.over = 0
+        self.under = 0
+        set_quality(level)
+    
+    def name(self):
+        return QUALITY_LEVELS[self.level][0]
+    
+    def begin_frame(self):
+        self.frame_start = time.perf_counter()
+    
+    def end_frame(self):
+        # Work time only: the frame cap's sleep happens after this
+        self.frame_time = time.perf_counter() - self.frame_start
+        self.average += (self.frame_time - self.average) * 0.1
+        if not self.adaptive:
+            return
+        if self.average > self.budget * 0.9:
+            self.over += 1
+            self.under = 0
+        elif self.average < self.budget * QUALITY_HEADROOM:
+            self.under += 1
+            self.over = 0
+        else:
+            self.over = self.under = 0
+        if self.over >= QUALITY_DROP_FRAMES and self.level < len(QUALITY_LEVELS) - 1:
+            self.change(self.level + 1)
+        elif self.under >= QUALITY_RAISE_FRAMES and self.level > 0:
+            self.change(self.level - 1)
+    
+    def change(self, level):
+        self.level = level
+        self.over = self.under = 0
+        set_quality(level)
+
+# Most particles a fighter keeps alive; the oldest are dropped beyond this
+PARTICLE_LIMIT = 400
+
+# Stage x range the camera can see (plus a margin) on stages wider than the
+# screen; particles outside it skip their motion. None: everything is visible.
+particle_view = None
+
+# Particles of the same color and radius share one sprite; alpha is applied
+# per blit instead of allocating a new surface per particle per frame
+particle_sprites = {}
+PARTICLE_SPRITE_LIMIT = 1024
+
+def particle_sprite(color, radius):
+    key = (color, radius)
+    sprite = particle_sprites.get(key)
+    if sprite is None:
+        if len(particle_sprites) >= PARTICLE_SPRITE_LIMIT:
+            particle_sprites.clear()
+        sprite = pygame.Surface((radius * 2, radius * 2), pygame.SRCALPHA)
+        pygame.draw.circle(sprite, color, (radius, radius), radius)
+        particle_sprites[key] = sprite
+    return sprite
+
+# Cache of rendered text surfaces, keyed by font, text and color
+text_cache = {}
+TEXT_CACHE_LIMIT = 256
+
+def render_text(font, text, color):
+    key = (font, text, color)
+    text_surface = text_cache.get(key)
+    if text_surface is None:
+        if len(text_cache) >= TEXT_CACHE_LIMIT:
+            text_cache.clear()
+        text_surface = text_cache[key] = font.render(text, True, color)
+    return text_surface
+
+# Pre-rendered animation frames for one fighter look (size, color, timings).
+# Every state/frame combination is drawn once into an atlas surface, with a
+# mirrored copy for facing left, so drawing a fighter is a single blit.
+ANIM_FRAMES = 20        # Fighter.frame runs 0..4 in steps of animation_speed
+JUMP_VELOCITY_STEP = 0.5
+ATLAS_MAX_WIDTH = 1024
+
+class FighterAtlas:
+    atlases = {}
+    
+    @classmethod
+    def for_fighter(cls, fighter):
+        key = (fighter.width, fighter.height, fighter.color, fighter.attack_duration, fighter.jump_strength)
+        atlas = cls.atlases.get(key)
+        if atlas is None:
+            atlas = cls.atlases[key] = cls(fighter)
+        return atlas
+    
+    def __init__(self, fighter):
+        self.width = fighter.width
+        self.height = fighter.height
+        self.color = fighter.color
+        self.attack_duration = fighter.attack_duration
+        self.jump_strength = fighter.jump_strength
+        self.jump_buckets = int(abs(self.jump_strength) * 2 / JUMP_VELOCITY_STEP) + 1
+        
+        # Distinct images, all drawn facing right, relative to the fighter's (x, y)
+        images = {}
+        images["base"] = self.shapes(0, 0, self.width, self.height)
+        for bucket in range(self.jump_buckets):
+            stretch = max(0, 1 - bucket * JUMP_VELOCITY_STEP / self.jump_strength)
+            images[("jump", bucket)] = self.shapes(0, 0, self.width * (1 + stretch * 0.1),
+                                                   self.height * (1 - stretch * 0.2))
+        for cooldown in range(self.attack_duration + 1):
+            attack_extend = (self.attack_duration - cooldown) / self.attack_duration
+            attack_extend = 1 - abs(2 * attack_extend - 1)  # Make it go out and back
+            images[("attack", cooldown)] = self.shapes(0, 0, self.width * (1 + attack_extend * 0.3), self.height)
+        for index in range(ANIM_FRAMES):
+            scale = 1 + 0.2 * math.sin(index / ANIM_FRAMES * 4 * math.pi)
+            w, h = self.width * scale, self.height * scale
+            images[("special", index)] = self.shapes((self.width - w) / 2, (self.height - h) / 2, w, h)
+        images["hit"] = self.shapes(self.width * 0.05, self.height * 0.05, self.width * 0.9, self.height * 0.9)
+        images["block"] = self.shapes(self.width * 0.2, 0, self.width * 0.8, self.height,
+                                      block=(0, 0, self.width * 0.2, self.height))
+        
+        self.pack(images)
+        
+        # Lookup table: (state, index, facing_right) -> (area, offset_x, offset_y)
+        self.table = {}
+        for index in range(ANIM_FRAMES):
+            frame = index * 4 / ANIM_FRAMES
+            self.add("idle", index, "base", 0, math.sin(frame * 0.5) * 2)
+            self.add("walk", index, "base", math.sin(frame * math.pi) * 3, 0)
+            self.add("special", index, ("special", index))
+        for bucket in range(self.jump_buckets):
+            self.add("jump", bucket, ("jump", bucket))
+        for cooldown in range(self.attack_duration + 1):
+            self.add("attack", cooldown, ("attack", cooldown))
+        self.add("hit", 0, "hit")
+        self.add("block", 0, "block")
+    
+    def shapes(self, x, y, width, height, block=None):
+        # Body rect, optional block rect and the eye, like the old procedural draw
+        eye = (x + width * 0.7, y + height * 0.3, max(3, min(width, height) * 0.1))
+        return (x, y, width, height), block, eye
+    
+    def pack(self, images):
+        # Simple row packing into one surface
+        self.cells = {}
+        layout = []
+        row_x = row_y = row_height = 0
+        for name, ((x, y, width, height), block, eye) in images.items():
+            left = math.floor(min(x, block[0] if block else x))
+            top = math.floor(y)
+            cell_width = math.ceil(x + width) - left + 1
+            cell_height = math.ceil(y + height) - top + 1
+            if row_x + cell_width > ATLAS_MAX_WIDTH:
+                row_x, row_y, row_height = 0, row_y + row_height, 0
+            layout.append((name, left, top, pygame.Rect(row_x, row_y, cell_width, cell_height)))
+            row_x += cell_width
+            row_height = max(row_height, cell_height)
+        
+        atlas_width = max(cell.right for _, _, _, cell in layout)
+        atlas_height = max(cell.bottom for _, _, _, cell in layout)
+        atlas = pygame.Surface((atlas_width, atlas_height), pygame.SRCALPHA)
+        for name, left, top, cell in layout:
+            (x, y, width, height), block, eye = images[name]
+            dx, dy = cell.x - left, cell.y - top
+            if block:
+                pygame.draw.rect(atlas, (100, 100, 100), pygame.Rect(block[0] + dx, block[1] + dy, block[2], block[3]))
+            pygame.draw.rect(atlas, self.color, pygame.Rect(x + dx, y + dy, width, height))
+            pygame.draw.circle(atlas, BLACK, (eye[0] + dx, eye[1] + dy), eye[2])
+            self.cells[name] = (cell, left, top)
+        
+        if pygame.display.get_surface() is not None:
+            atlas = atlas.convert_alpha()
+        self.surfaces = {True: atlas, False: pygame.transform.flip(atlas, True, False)}
+    
+    def add(self, state, index, image, shift_x=0, shift_y=0):
+        cell, left, top = self.cells[image]
+        self.table[(state, index, True)] = (cell, left + shift_x, top + shift_y)
+        # Mirror around the fighter's vertical center line
+        flipped = pygame.Rect(self.surfaces[True].get_width() - cell.right, cell.y, cell.width, cell.height)
+        self.table[(state, index, False)] = (flipped, self.width - left - cell.width - shift_x, top + shift_y)
+    
+    def lookup(self, fighter):
+        state = fighter.state
+        if state == "jump":
+            index = min(int(abs(fighter.vel_y) / JUMP_VELOCITY_STEP), self.jump_buckets - 1)
+        elif state == "attack":
+            index = min(max(int(fighter.attack_cooldown), 0), self.attack_duration)
+        elif state == "hit" or state == "block":
+            index = 0
+        else:
+            index = int(fighter.frame / fighter.animation_speed + 0.5) % ANIM_FRAMES
+        area, offset_x, offset_y = self.table[(state, index, fighter.facing_right)]
+        return self.surfaces[fighter.facing_right], area, offset_x, offset_y
+
+def preload_atlases(fighter_classes):
+    # Render every fighter's frames up front so the first fight doesn't hitch
+    for fighter_class in fighter_classes:
+        FighterAtlas.for_fighter(fighter_class(0, 0))
+
+FIGHTER_STATES = ("idle", "walk", "jump", "attack", "special", "hit", "block")
 
 # Character base class
 class Fighter:
+    # Gameplay state in a fixed order, with the struct code used to send each
+    # field over the network. Particles are cosmetic and not part of it.
+    state_fields = (
+        ("x", "f"), ("y", "f"), ("vel_x", "f"), ("vel_y", "f"), ("hp", "f"),
+        ("speed", "f"), ("attack_damage", "f"), ("attack_cooldown", "f"),
+        ("special_cooldown", "h"), ("hit_cooldown", "h"), ("combo_counter", "h"),
+        ("combo_timer", "h"), ("frame", "f"), ("state", "B"), ("facing_right", "?"),
+        ("is_jumping", "?"), ("is_attacking", "?"), ("is_blocking", "?"),
+    )
+    # Continuous quantities, which fixed-point fighters keep in 1/FIXED_ONE
+    # units. Literal distances in the rules are multiplied by `one`.
+    scaled_fields = (
+        "x", "y", "vel_x", "vel_y", "hp", "max_hp", "speed", "jump_strength", "width", "height",
+        "gravity", "attack_damage", "attack_range", "frame", "animation_speed",
+    )
+    one = 1
+    stage_width = SCREEN_WIDTH  # create_match sets it per fighter on wider stages
+    
     def __init__(self, name, x, y, width, height, color, hp, speed, jump_strength):
         self.name = name
         self.x = x
@@ -95,6 +397,7 @@ class Fighter:
         self.jump_strength = jump_strength
         self.vel_x = 0
         self.vel_y = 0
+        self.gravity = GRAVITY
         self.facing_right = True
         self.is_jumping = False
         self.is_attacking = False
@@ -105,6 +408,7 @@ class Fighter:
         self.combo_counter = 0
         self.combo_timer = 0
         self.particles = []
+        self.slot = 0  # index in the match
         
         # Animation states
         self.frame = 0
@@ -118,23 +422,25 @@ class Fighter:
 
     def update(self, opponent):
         # Apply gravity
-        self.vel_y += GRAVITY
+        self.vel_y += self.gravity
         
         # Apply velocity
         self.x += self.vel_x
         self.y += self.vel_y
         
         # Floor collision
-        if self.y + self.height > FLOOR_HEIGHT:
-            self.y = FLOOR_HEIGHT - self.height
+        floor = FLOOR_HEIGHT * self.one
+        if self.y + self.height > floor:
+            self.y = floor - self.height
             self.vel_y = 0
             self.is_jumping = False
         
-        # Screen boundaries
+        # Stage boundaries
+        right = self.stage_width * self.one
         if self.x < 0:
             self.x = 0
-        if self.x + self.width > SCREEN_WIDTH:
-            self.x = SCREEN_WIDTH - self.width
+        if self.x + self.width > right:
+            self.x = right - self.width
         
         # Cooldowns
         if self.attack_cooldown > 0:
@@ -155,13 +461,17 @@ class Fighter:
             self.combo_counter = 0
         
         # Update particles
-        self.particles = [p for p in self.particles if p.update()]
+        self.update_particles()
         
         # Animation
         self.frame += self.animation_speed
-        if self.frame >= 4:  # 4 frames per animation
+        if self.frame >= 4 * self.one:  # 4 frames per animation
             self.frame = 0
         
+        # Special attack energy particles
+        if self.state == "special" and effect_chance(0.3):
+            self.effects().energy_effect()
+        
         # Determine facing direction based on opponent position
         if opponent:
             if self.x + self.width/2 < opponent.x + opponent.width/2:
@@ -189,21 +499,25 @@ class Fighter:
             self.attack_cooldown = self.attack_duration
             self.state = "attack"
             self.vel_x = 0  # Stop movement during attack
-            punch_sound.play()
+            play_sound(punch_sound)
             return True
         return False
     
     def special_attack(self):
         if not self.is_attacking and not self.is_blocking and self.special_cooldown == 0:
             self.is_attacking = True
-            self.attack_cooldown = self.attack_duration * 1.5
+            self.attack_cooldown = self.ratio(self.attack_duration, 3, 2)
             self.special_cooldown = 120  # 2 second cooldown
             self.state = "special"
             self.vel_x = 0
-            special_sound.play()
+            play_sound(special_sound)
             return True
         return False
     
+    def special_ready(self):
+        # special_attack() would start the special now
+        return not self.is_attacking and not self.is_blocking and self.special_cooldown == 0
+    
     def block(self, is_blocking):
         if not self.is_attacking:
             self.is_blocking = is_blocking
@@ -216,7 +530,7 @@ class Fighter:
     def take_damage(self, damage, knockback=0):
         if self.hit_cooldown == 0:
             if self.is_blocking:
-                damage = damage * 0.3  # 70% damage reduction when blocking
+                damage = self.ratio(damage, 3, 10)  # 70% damage reduction when blocking
             
             self.hp -= damage
             self.hit_cooldown = 15  # Brief invincibility
@@ -227,162 +541,150 @@ class Fighter:
             self.vel_x = knockback * direction
             
             # Create hit particles
-            for _ in range(10):
-                angle = random.uniform(0, math.pi * 2)
-                speed = random.uniform(1, 3)
-                self.particles.append(
-                    Particle(
-                        self.x + self.width/2, 
-                        self.y + self.height/2,
-                        (255, 0, 0),
-                        math.cos(angle) * speed,
-                        math.sin(angle) * speed,
-                        random.uniform(2, 5),
-                        random.randint(20, 30)
-                    )
-                )
+            self.effects().hit_effect()
             
             return True
         return False
     
-    def check_hit(self, opponent):
+    def attack_reach(self):
+        return self.attack_range
+    
+    def attack_hitbox(self):
+        # Active attack hitbox as (x, y, width, height), or None
         if self.is_attacking and self.attack_cooldown > self.attack_duration / 2:
+            attack_range = self.attack_reach()
             # Attack hitbox depends on facing direction
             if self.facing_right:
                 attack_x = self.x + self.width
-                attack_width = self.attack_range
             else:
-                attack_x = self.x - self.attack_range
-                attack_width = self.attack_range
-                
-            # Check collision with opponent
-            if (attack_x < opponent.x + opponent.width and 
+                attack_x = self.x - attack_range
+            return attack_x, self.y, attack_range, self.height
+        return None
+    
+    def prepare_hit(self, opponent):
+        # Hook for attacks with effects tied to the target (teleports, projectiles)
+        pass
+    
+    def hitbox_overlaps(self, hitbox, opponent):
+        attack_x, attack_y, attack_width, attack_height = hitbox
+        return (attack_x < opponent.x + opponent.width and 
                 attack_x + attack_width > opponent.x and
-                self.y < opponent.y + opponent.height and
-                self.y + self.height > opponent.y):
-                
-                # Calculate damage based on current action
-                damage = self.attack_damage
-                knockback = 5
-                
-                if self.state == "special":
-                    damage *= 2
-                    knockback = 10
-                
-                # Apply combo system
-                if self.combo_counter > 0:
-                    damage *= (1 + self.combo_counter * 0.1)  # 10% more damage per combo hit
-                
-                if opponent.take_damage(damage, knockback):
-                    self.combo_counter += 1
-                    self.combo_timer = 90  # 1.5 seconds to continue combo
-                
-                return True
-        return False
+                attack_y < opponent.y + opponent.height and
+                attack_y + attack_height > opponent.y)
     
-    def draw(self, surface):
-        # Draw fighter
-        frame_int = int(self.frame)
-        
-        # Base fighter shape
-        fighter_rect = pygame.Rect(self.x, self.y, self.width, self.height)
+    def land_hit(self, opponent):
+        # Calculate damage based on current action
+        damage = self.attack_damage
+        knockback = 5 * self.one
         
-        # Different visual based on state
-        if self.state == "idle":
-            # Just the base character with subtle breathing animation
-            y_offset = math.sin(self.frame * 0.5) * 2
-            fighter_rect.y += y_offset
-            
-        elif self.state == "walk":
-            # Walking animation - shift position slightly
-            x_offset = math.sin(self.frame * math.pi) * 3
-            if not self.facing_right:
-                x_offset *= -1
-            fighter_rect.x += x_offset
-            
-        elif self.state == "jump":
-            # Jump animation - stretch vertically
-            stretch = max(0, 1 - abs(self.vel_y) / self.jump_strength)
-            fighter_rect.height = self.height * (1 - stretch * 0.2)
-            fighter_rect.width = self.width * (1 + stretch * 0.1)
-            
-        elif self.state == "attack":
-            # Attack animation - extend in attack direction
-            attack_extend = (self.attack_duration - self.attack_cooldown) / self.attack_duration
-            attack_extend = 1 - abs(2 * attack_extend - 1)  # Make it go out and back
-            
-            if self.facing_right:
-                fighter_rect.width = self.width * (1 + attack_extend * 0.3)
-            else:
-                width_extend = self.width * attack_extend * 0.3
-                fighter_rect.x -= width_extend
-                fighter_rect.width = self.width + width_extend
-                
-        elif self.state == "special":
-            # Special attack animation - pulsate
-            scale = 1 + 0.2 * math.sin(self.frame * math.pi)
-            center_x = fighter_rect.x + fighter_rect.width / 2
-            center_y = fighter_rect.y + fighter_rect.height / 2
-            
-            fighter_rect.width = self.width * scale
-            fighter_rect.height = self.height * scale
-            fighter_rect.x = center_x - fighter_rect.width / 2
-            fighter_rect.y = center_y - fighter_rect.height / 2
-            
-            # Add energy particles
-            if random.random() < 0.3:
-                for _ in range(3):
-                    angle = random.uniform(0, math.pi * 2)
-                    self.particles.append(
-                        Particle(
-                            center_x, 
-                            center_y,
-                            self.color,
-                            math.cos(angle) * random.uniform(1, 3),
-                            math.sin(angle) * random.uniform(1, 3),
-                            random.uniform(3, 7),
-                            random.randint(20, 40)
-                        )
-                    )
-                
-        elif self.state == "hit":
-            # Hit animation - compress slightly
-            fighter_rect.width = self.width * 0.9
-            fighter_rect.height = self.height * 0.9
-            fighter_rect.x += self.width * 0.05
-            fighter_rect.y += self.height * 0.05
-            
-        elif self.state == "block":
-            # Block animation - shift arms (indicated by color change)
-            block_rect = fighter_rect.copy()
-            if self.facing_right:
-                block_rect.width = self.width * 0.2
-                pygame.draw.rect(surface, (100, 100, 100), block_rect)
-                fighter_rect.x += self.width * 0.2
-                fighter_rect.width = self.width * 0.8
-            else:
-                block_rect.x = fighter_rect.right - self.width * 0.2
-                block_rect.width = self.width * 0.2
-                pygame.draw.rect(surface, (100, 100, 100), block_rect)
-                fighter_rect.width = self.width * 0.8
+        if self.state == "special":
+            damage *= 2
+            knockback = 10 * self.one
         
-        # Draw the character
-        pygame.draw.rect(surface, self.color, fighter_rect)
+        # Apply combo system
+        if self.combo_counter > 0:
+            damage = self.combo_damage(damage)
         
-        # Draw eyes to indicate facing direction
-        eye_x = fighter_rect.x + fighter_rect.width * (0.7 if self.facing_right else 0.3)
-        eye_y = fighter_rect.y + fighter_rect.height * 0.3
-        eye_radius = max(3, min(fighter_rect.width, fighter_rect.height) * 0.1)
-        pygame.draw.circle(surface, BLACK, (eye_x, eye_y), eye_radius)
+        hp = opponent.hp
+        blocked = opponent.is_blocking
+        if opponent.take_damage(damage, knockback):
+            self.combo_counter += 1
+            self.combo_timer = 90  # 1.5 seconds to continue combo
+            
+            if telemetry:
+                telemetry.emit(EVENT_BLOCK if blocked else EVENT_HIT, self, opponent, (hp - opponent.hp) / self.one)
+                if self.combo_counter > 1:
+                    telemetry.emit(EVENT_COMBO, self, opponent, self.combo_counter)
+                if opponent.hp <= 0 < hp:
+                    telemetry.emit(EVENT_KO, self, opponent, opponent.hp / self.one)
+    
+    def combo_damage(self, damage):
+        return damage * (1 + self.combo_counter * 0.1)  # 10% more damage per combo hit
+    
+    def ratio(self, value, numerator, denominator):
+        # value * numerator / denominator for fractional factors of the rules
+        return value * (numerator / denominator)
+    
+    def count(self, value, step):
+        # Whole steps (in pixels/points) in value
+        return int(value / step)
+    
+    def effects(self):
+        # The fighter as particle effects see it (pixel units)
+        return self
+    
+    def energy_effect(self):
+        for _ in range(effect_count(3)):
+            angle = random.uniform(0, math.pi * 2)
+            self.particles.append(
+                Particle(
+                    self.x + self.width / 2, 
+                    self.y + self.height / 2,
+                    self.color,
+                    math.cos(angle) * random.uniform(1, 3),
+                    math.sin(angle) * random.uniform(1, 3),
+                    random.uniform(3, 7),
+                    random.randint(20, 40)
+                )
+            )
+    
+    def hit_effect(self):
+        for _ in range(effect_count(10)):
+            angle = random.uniform(0, math.pi * 2)
+            speed = random.uniform(1, 3)
+            self.particles.append(
+                Particle(
+                    self.x + self.width/2, 
+                    self.y + self.height/2,
+                    (255, 0, 0),
+                    math.cos(angle) * speed,
+                    math.sin(angle) * speed,
+                    random.uniform(2, 5),
+                    random.randint(20, 30)
+                )
+            )
+    
+    def update_particles(self):
+        if particle_view is None:
+            self.particles = [p for p in self.particles if p.update()]
+        else:
+            left, right = particle_view
+            self.particles = [p for p in self.particles if (p.update() if left <= p.x <= right else p.age_only())]
+        if len(self.particles) > PARTICLE_LIMIT:
+            del self.particles[:-PARTICLE_LIMIT]
+    
+    def get_state(self):
+        state = [getattr(self, name) for name, _ in self.state_fields]
+        state[STATE_FIELD_INDEX] = FIGHTER_STATES.index(self.state)
+        return tuple(state)
+    
+    def set_state(self, state):
+        for (name, _), value in zip(self.state_fields, state):
+            setattr(self, name, value)
+        self.state = FIGHTER_STATES[state[STATE_FIELD_INDEX]]
+    
+    def snapshot(self):
+        # Copy that stays as it is while the simulation moves on, for drawing
+        # on another thread
+        view = object.__new__(type(self))
+        view.__dict__.update(self.__dict__)
+        view.particles = [particle.copy() for particle in self.particles]
+        return view
+    
+    def draw(self, surface, camera_x=0):
+        # Draw fighter - a single blit of the pre-rendered frame
+        x = self.x - camera_x
+        atlas_surface, area, offset_x, offset_y = FighterAtlas.for_fighter(self).lookup(self)
+        surface.blit(atlas_surface, (x + offset_x, self.y + offset_y), area)
         
         # Draw particles
         for particle in self.particles:
-            particle.draw(surface)
+            particle.draw(surface, camera_x)
         
         # Draw health bar
         health_width = 100
         health_height = 10
-        health_x = self.x + (self.width - health_width) / 2
+        health_x = x + (self.width - health_width) / 2
         health_y = self.y - 20
         
         # Background
@@ -395,7 +697,7 @@ class Fighter:
         if self.special_cooldown > 0:
             cooldown_width = 80
             cooldown_height = 5
-            cooldown_x = self.x + (self.width - cooldown_width) / 2
+            cooldown_x = x + (self.width - cooldown_width) / 2
             cooldown_y = self.y - 30
             
             cooldown_percent = self.special_cooldown / 120
@@ -404,24 +706,28 @@ class Fighter:
                             (cooldown_x, cooldown_y, cooldown_width * (1 - cooldown_percent), cooldown_height))
         
         # Draw name
-        name_text = hud_font.render(self.name, True, WHITE)
-        surface.blit(name_text, (self.x + self.width/2 - name_text.get_width()/2, self.y - 45))
+        name_text = render_text(hud_font, self.name, WHITE)
+        surface.blit(name_text, (x + self.width/2 - name_text.get_width()/2, self.y - 45))
         
         # Draw combo counter if active
         if self.combo_counter > 1:
-            combo_text = hud_font.render(f"{self.combo_counter}x Combo!", True, YELLOW)
-            surface.blit(combo_text, (self.x + self.width/2 - combo_text.get_width()/2, self.y - 70))
+            combo_text = render_text(hud_font, f"{self.combo_counter}x Combo!", YELLOW)
+            surface.blit(combo_text, (x + self.width/2 - combo_text.get_width()/2, self.y - 70))
 
         # Debug - draw attack hitbox
         if self.is_attacking:
             if self.facing_right:
-                attack_rect = pygame.Rect(self.x + self.width, self.y, self.attack_range, self.height)
+                attack_rect = pygame.Rect(x + self.width, self.y, self.attack_range, self.height)
             else:
-                attack_rect = pygame.Rect(self.x - self.attack_range, self.y, self.attack_range, self.height)
+                attack_rect = pygame.Rect(x - self.attack_range, self.y, self.attack_range, self.height)
             pygame.draw.rect(surface, (255, 0, 0, 128), attack_rect, 1)
 
+STATE_FIELD_INDEX = [name for name, _ in Fighter.state_fields].index("state")
+
 # Define unique fighters
 class NinjaFighter(Fighter):
+    state_fields = Fighter.state_fields + (("dash_cooldown", "h"), ("has_double_jumped", "?"))
+    
     def __init__(self, x, y):
         super().__init__("Shadow Ninja", x, y, 40, 80, BLACK, 100, 5, JUMP_STRENGTH - 2)
         self.attack_damage = 8  # Less damage
@@ -444,160 +750,171 @@ class NinjaFighter(Fighter):
         if not self.is_jumping:
             super().jump()
         elif self.can_double_jump and not self.has_double_jumped:
-            self.vel_y = self.jump_strength * 0.8
+            self.vel_y = self.ratio(self.jump_strength, 4, 5)
             self.has_double_jumped = True
             self.state = "jump"
             
             # Create jump effect
-            for _ in range(5):
-                self.particles.append(
-                    Particle(
-                        self.x + self.width/2, 
-                        self.y + self.height,
-                        (100, 100, 100),
-                        random.uniform(-1, 1),
-                        random.uniform(1, 3),
-                        random.uniform(3, 5),
-                        random.randint(10, 20)
-                    )
-                )
+            self.effects().double_jump_effect()
     
     def dash(self, direction):
         if self.dash_cooldown == 0 and not self.is_attacking:
-            self.vel_x = direction * 15
+            self.vel_x = direction * 15 * self.one
             self.dash_cooldown = 45
             
             # Create dash effect
-            for _ in range(10):
-                self.particles.append(
-                    Particle(
-                        self.x + (0 if direction > 0 else self.width), 
-                        self.y + random.uniform(0, self.height),
-                        (50, 50, 50),
-                        -direction * random.uniform(2, 4),
-                        random.uniform(-1, 1),
-                        random.uniform(2, 4),
-                        random.randint(10, 20)
-                    )
-                )
+            self.effects().dash_effect(direction)
             return True
         return False
     
+    def double_jump_effect(self):
+        for _ in range(effect_count(5)):
+            self.particles.append(
+                Particle(
+                    self.x + self.width/2, 
+                    self.y + self.height,
+                    (100, 100, 100),
+                    random.uniform(-1, 1),
+                    random.uniform(1, 3),
+                    random.uniform(3, 5),
+                    random.randint(10, 20)
+                )
+            )
+    
+    def dash_effect(self, direction):
+        for _ in range(effect_count(10)):
+            self.particles.append(
+                Particle(
+                    self.x + (0 if direction > 0 else self.width), 
+                    self.y + random.uniform(0, self.height),
+                    (50, 50, 50),
+                    -direction * random.uniform(2, 4),
+                    random.uniform(-1, 1),
+                    random.uniform(2, 4),
+                    random.randint(10, 20)
+                )
+            )
+    
+    def smoke_effect(self):
+        for _ in range(effect_count(15)):
+            self.particles.append(
+                Particle(
+                    self.x + self.width/2, 
+                    self.y + self.height/2,
+                    (100, 100, 100),
+                    random.uniform(-2, 2),
+                    random.uniform(-2, 2),
+                    random.uniform(3, 6),
+                    random.randint(20, 40)
+                )
+            )
+    
     def special_attack(self):
         if super().special_attack():
             # Teleport behind opponent and attack
             return True
         return False
     
-    def check_hit(self, opponent):
+    def prepare_hit(self, opponent):
         # If in special attack and we're in the right frame, teleport behind opponent
         if self.state == "special" and self.attack_cooldown == int(self.attack_duration * 0.75):
             # Determine which side to teleport to
-            teleport_x = opponent.x + opponent.width + 10
-            if teleport_x + self.width > SCREEN_WIDTH:
-                teleport_x = opponent.x - self.width - 10
+            teleport_x = opponent.x + opponent.width + 10 * self.one
+            if teleport_x + self.width > self.stage_width * self.one:
+                teleport_x = opponent.x - self.width - 10 * self.one
                 
             # Create smoke effect at current position
-            for _ in range(15):
-                self.particles.append(
-                    Particle(
-                        self.x + self.width/2, 
-                        self.y + self.height/2,
-                        (100, 100, 100),
-                        random.uniform(-2, 2),
-                        random.uniform(-2, 2),
-                        random.uniform(3, 6),
-                        random.randint(20, 40)
-                    )
-                )
+            self.effects().smoke_effect()
                 
             # Teleport
+            if telemetry:
+                telemetry.emit(EVENT_TELEPORT, self, opponent, (teleport_x - self.x) / self.one)
             self.x = teleport_x
             
             # Create smoke effect at new position
-            for _ in range(15):
-                self.particles.append(
-                    Particle(
-                        self.x + self.width/2, 
-                        self.y + self.height/2,
-                        (100, 100, 100),
-                        random.uniform(-2, 2),
-                        random.uniform(-2, 2),
-                        random.uniform(3, 6),
-                        random.randint(20, 40)
-                    )
-                )
-        
-        return super().check_hit(opponent)
+            self.effects().smoke_effect()
 
 class ElectricFighter(Fighter):
+    state_fields = Fighter.state_fields + (("charge_level", "f"),)
+    scaled_fields = Fighter.scaled_fields + ("charge_level", "max_charge", "charge_rate")
+    
     def __init__(self, x, y):
         super().__init__("Volt Striker", x, y, 50, 90, BLUE, 90, 4, JUMP_STRENGTH)
         self.attack_damage = 12
         self.charge_level = 0
         self.max_charge = 100
+        self.charge_rate = 0.2
     
     def update(self, opponent):
         super().update(opponent)
         
         # Slowly build charge when on ground
         if not self.is_jumping and not self.is_attacking:
-            self.charge_level = min(self.max_charge, self.charge_level + 0.2)
+            self.charge_level = min(self.max_charge, self.charge_level + self.charge_rate)
         
         # Electric particles based on charge
-        if random.random() < self.charge_level / 500:  # Higher chance with more charge
-            self.particles.append(
-                Particle(
-                    self.x + random.uniform(0, self.width), 
-                    self.y + random.uniform(0, self.height),
-                    (0, 200, 255),
-                    random.uniform(-1, 1),
-                    random.uniform(-3, -1),
-                    random.uniform(1, 3),
-                    random.randint(10, 20)
-                )
-            )
+        if effect_chance(self.charge_level / self.one / 500):  # Higher chance with more charge
+            self.effects().spark_effect()
     
     def attack(self):
         if super().attack():
             # Standard attack uses some charge
-            if self.charge_level > 10:
-                self.attack_damage = 12 + int(self.charge_level / 20)
-                self.charge_level -= 10
+            if self.charge_level > 10 * self.one:
+                self.attack_damage = (12 + self.count(self.charge_level, 20)) * self.one
+                self.charge_level -= 10 * self.one
             else:
-                self.attack_damage = 12
+                self.attack_damage = 12 * self.one
             return True
         return False
     
+    def special_ready(self):
+        return self.charge_level >= 50 * self.one and super().special_ready()
+    
     def special_attack(self):
-        if self.charge_level >= 50 and super().special_attack():
+        if self.charge_level >= 50 * self.one and super().special_attack():
             # Lightning strike attack
-            self.charge_level -= 50
+            self.charge_level -= 50 * self.one
             
             # Create lightning effect
-            for _ in range(30):
-                height_position = random.uniform(0, 1)
-                self.particles.append(
-                    Particle(
-                        self.x + self.width/2 + random.uniform(-50, 50), 
-                        self.y * height_position,
-                        (0, 200, 255),
-                        random.uniform(-1, 1),
-                        random.uniform(5, 15),
-                        random.uniform(2, 5),
-                        random.randint(10, 30)
-                    )
-                )
+            self.effects().lightning_effect()
             return True
         return False
     
-    def draw(self, surface):
-        super().draw(surface)
+    def spark_effect(self):
+        self.particles.append(
+            Particle(
+                self.x + random.uniform(0, self.width), 
+                self.y + random.uniform(0, self.height),
+                (0, 200, 255),
+                random.uniform(-1, 1),
+                random.uniform(-3, -1),
+                random.uniform(1, 3),
+                random.randint(10, 20)
+            )
+        )
+    
+    def lightning_effect(self):
+        for _ in range(effect_count(30)):
+            height_position = random.uniform(0, 1)
+            self.particles.append(
+                Particle(
+                    self.x + self.width/2 + random.uniform(-50, 50), 
+                    self.y * height_position,
+                    (0, 200, 255),
+                    random.uniform(-1, 1),
+                    random.uniform(5, 15),
+                    random.uniform(2, 5),
+                    random.randint(10, 30)
+                )
+            )
+    
+    def draw(self, surface, camera_x=0):
+        super().draw(surface, camera_x)
         
         # Draw charge meter
         charge_width = 80
         charge_height = 5
-        charge_x = self.x + (self.width - charge_width) / 2
+        charge_x = self.x - camera_x + (self.width - charge_width) / 2
         charge_y = self.y - 35
         
         pygame.draw.rect(surface, BLACK, (charge_x, charge_y, charge_width, charge_height))
@@ -605,11 +922,15 @@ class ElectricFighter(Fighter):
                         (charge_x, charge_y, charge_width * (self.charge_level / self.max_charge), charge_height))
 
 class FireFighter(Fighter):
+    state_fields = Fighter.state_fields + (("heat_level", "f"), ("overheated", "?"), ("fireball_cooldown", "h"))
+    scaled_fields = Fighter.scaled_fields + ("heat_level", "max_heat", "cooling_rate")
+    
     def __init__(self, x, y):
         super().__init__("Flame Master", x, y, 55, 85, RED, 110, 3.5, JUMP_STRENGTH + 1)
         self.attack_damage = 15
         self.heat_level = 0
         self.max_heat = 100
+        self.cooling_rate = 0.5
         self.overheated = False
         self.fireball_cooldown = 0
     
@@ -618,24 +939,14 @@ class FireFighter(Fighter):
         
         # Heat management
         if self.overheated:
-            self.heat_level -= 0.5
+            self.heat_level -= self.cooling_rate
             if self.heat_level <= 0:
                 self.heat_level = 0
                 self.overheated = False
         
         # Fire particles
-        if not self.overheated and random.random() < 0.1 + (self.heat_level / 200):
-            self.particles.append(
-                Particle(
-                    self.x + random.uniform(0, self.width), 
-                    self.y + random.uniform(self.height * 0.7, self.height),
-                    (255, random.randint(100, 200), 0),
-                    random.uniform(-1, 1),
-                    random.uniform(-4, -2),
-                    random.uniform(2, 4),
-                    random.randint(15, 25)
-                )
-            )
+        if not self.overheated and effect_chance(0.1 + (self.heat_level / self.one / 200)):
+            self.effects().flame_effect()
         
         if self.fireball_cooldown > 0:
             self.fireball_cooldown -= 1
@@ -643,63 +954,85 @@ class FireFighter(Fighter):
     def attack(self):
         if not self.overheated and super().attack():
             # Attacks generate heat
-            self.heat_level = min(self.max_heat, self.heat_level + 15)
+            self.heat_level = min(self.max_heat, self.heat_level + 15 * self.one)
             
             # More damage with more heat
-            heat_bonus = int(self.heat_level / 20)
-            self.attack_damage = 15 + heat_bonus
+            heat_bonus = self.count(self.heat_level, 20)
+            self.attack_damage = (15 + heat_bonus) * self.one
             
             # Check for overheat
             if self.heat_level >= self.max_heat:
                 self.overheated = True
+                if telemetry:
+                    telemetry.emit(EVENT_OVERHEAT, self, None, self.heat_level / self.one)
             
             return True
         return False
     
+    def special_ready(self):
+        return (not self.overheated and self.heat_level >= 40 * self.one and self.fireball_cooldown == 0
+                and super().special_ready())
+    
     def special_attack(self):
-        if not self.overheated and self.heat_level >= 40 and self.fireball_cooldown == 0:
+        if not self.overheated and self.heat_level >= 40 * self.one and self.fireball_cooldown == 0:
             if super().special_attack():
                 # Fireball attack
-                self.heat_level -= 40
+                self.heat_level -= 40 * self.one
                 self.fireball_cooldown = 90
                 return True
         return False
     
-    def check_hit(self, opponent):
+    def is_fireball_frame(self):
+        return self.state == "special" and self.attack_cooldown == int(self.attack_duration * 0.8)
+    
+    def attack_reach(self):
+        # Extended attack range for fireball
+        if self.is_fireball_frame():
+            return 150 * self.one
+        return self.attack_range
+    
+    def prepare_hit(self, opponent):
         # For special, create fireball projectile effect
-        if self.state == "special" and self.attack_cooldown == int(self.attack_duration * 0.8):
-            # Create fireball effect moving forward
-            direction = 1 if self.facing_right else -1
-            for _ in range(20):
-                speed_x = direction * random.uniform(5, 8)
-                self.particles.append(
-                    Particle(
-                        self.x + (self.width if direction > 0 else 0), 
-                        self.y + self.height/2,
-                        (255, random.randint(100, 200), 0),
-                        speed_x,
-                        random.uniform(-2, 2),
-                        random.uniform(3, 7),
-                        random.randint(30, 50)
-                    )
+        if self.is_fireball_frame():
+            self.effects().fireball_effect()
+    
+    def flame_effect(self):
+        self.particles.append(
+            Particle(
+                self.x + random.uniform(0, self.width), 
+                self.y + random.uniform(self.height * 0.7, self.height),
+                (255, random.randint(100, 200), 0),
+                random.uniform(-1, 1),
+                random.uniform(-4, -2),
+                random.uniform(2, 4),
+                random.randint(15, 25)
+            )
+        )
+    
+    def fireball_effect(self):
+        # Fireball moving forward
+        direction = 1 if self.facing_right else -1
+        for _ in range(effect_count(20)):
+            speed_x = direction * random.uniform(5, 8)
+            self.particles.append(
+                Particle(
+                    self.x + (self.width if direction > 0 else 0), 
+                    self.y + self.height/2,
+                    (255, random.randint(100, 200), 0),
+                    speed_x,
+                    random.uniform(-2, 2),
+                    random.uniform(3, 7),
+                    random.randint(30, 50)
                 )
-                
-            # Extend attack range for fireball
-            old_range = self.attack_range
-            self.attack_range = 150
-            hit = super().check_hit(opponent)
-            self.attack_range = old_range
-            return hit
-        
-        return super().check_hit(opponent)
+            )
     
-    def draw(self, surface):
-        super().draw(surface)
+    def draw(self, surface, camera_x=0):
+        super().draw(surface, camera_x)
         
         # Draw heat meter
         heat_width = 80
         heat_height = 5
-        heat_x = self.x + (self.width - heat_width) / 2
+        heat_x = self.x - camera_x + (self.width - heat_width) / 2
         heat_y = self.y - 35
         
         pygame.draw.rect(surface, BLACK, (heat_x, heat_y, heat_width, heat_height))
@@ -708,6 +1041,9 @@ class FireFighter(Fighter):
                         (heat_x, heat_y, heat_width * (self.heat_level / self.max_heat), heat_height))
 
 class EarthFighter(Fighter):
+    state_fields = Fighter.state_fields + (("stone_armor", "f"),)
+    scaled_fields = Fighter.scaled_fields + ("stone_armor", "max_stone_armor", "armor_regen_rate")
+    
     def __init__(self, x, y):
         super().__init__("Stone Titan", x, y, 60, 95, (139, 69, 19), 140, 2.5, JUMP_STRENGTH + 3)  # Brown color
         self.attack_damage = 20
@@ -729,129 +1065,198 @@ class EarthFighter(Fighter):
             absorbed = min(self.stone_armor, damage)
             self.stone_armor -= absorbed
             damage -= absorbed
+            if telemetry:
+                telemetry.emit(EVENT_ARMOR_ABSORB, self, None, absorbed / self.one)
             
             # Create stone particle effect
-            for _ in range(int(absorbed / 2)):
-                self.particles.append(
-                    Particle(
-                        self.x + random.uniform(0, self.width), 
-                        self.y + random.uniform(0, self.height),
-                        (139, 69, 19),
-                        random.uniform(-3, 3),
-                        random.uniform(-3, 0),
-                        random.uniform(2, 5),
-                        random.randint(20, 40)
-                    )
-                )
+            self.effects().stone_effect(absorbed / self.one)
         
         # Reduced knockback
-        return super().take_damage(damage, knockback * 0.7)
+        return super().take_damage(damage, self.ratio(knockback, 7, 10))
     
     def special_attack(self):
         if super().special_attack():
             # Ground slam - fully regenerate armor but slow afterward
             self.stone_armor = self.max_stone_armor
-            self.speed *= 0.8  # Temporary speed decrease
+            self.speed = self.ratio(self.speed, 4, 5)  # Temporary speed decrease
             
             # Stone eruption effect
-            for _ in range(30):
-                distance = random.uniform(20, 150)
-                angle = random.uniform(0, math.pi)
-                if not self.facing_right:
-                    angle = math.pi - angle
-                    
-                self.particles.append(
-                    Particle(
-                        self.x + self.width/2 + math.cos(angle) * distance, 
-                        FLOOR_HEIGHT - random.uniform(10, 30),
-                        (139, 69, 19),
-                        random.uniform(-1, 1),
-                        random.uniform(-10, -5),
-                        random.uniform(5, 10),
-                        random.randint(30, 60)
-                    )
-                )
+            self.effects().eruption_effect()
             
             return True
         return False
     
-    def draw(self, surface):
-        super().draw(surface)
+    def stone_effect(self, absorbed):
+        for _ in range(effect_count(int(absorbed / 2))):
+            self.particles.append(
+                Particle(
+                    self.x + random.uniform(0, self.width), 
+                    self.y + random.uniform(0, self.height),
+                    (139, 69, 19),
+                    random.uniform(-3, 3),
+                    random.uniform(-3, 0),
+                    random.uniform(2, 5),
+                    random.randint(20, 40)
+                )
+            )
+    
+    def eruption_effect(self):
+        for _ in range(effect_count(30)):
+            distance = random.uniform(20, 150)
+            angle = random.uniform(0, math.pi)
+            if not self.facing_right:
+                angle = math.pi - angle
+                
+            self.particles.append(
+                Particle(
+                    self.x + self.width/2 + math.cos(angle) * distance, 
+                    FLOOR_HEIGHT - random.uniform(10, 30),
+                    (139, 69, 19),
+                    random.uniform(-1, 1),
+                    random.uniform(-10, -5),
+                    random.uniform(5, 10),
+                    random.randint(30, 60)
+                )
+            )
+    
+    def draw(self, surface, camera_x=0):
+        super().draw(surface, camera_x)
         
         # Draw armor meter
         armor_width = 80
         armor_height = 5
-        armor_x = self.x + (self.width - armor_width) / 2
+        armor_x = self.x - camera_x + (self.width - armor_width) / 2
         armor_y = self.y - 35
         
         pygame.draw.rect(surface, BLACK, (armor_x, armor_y, armor_width, armor_height))
         pygame.draw.rect(surface, (139, 69, 19), 
                         (armor_x, armor_y, armor_width * (self.stone_armor / self.max_stone_armor), armor_height))
 
-# Background elements
+# Fixed-point fighters for lockstep and replays across machines. Quantities
+# in scaled_fields are ints in 1/FIXED_ONE units and fractional factors are
+# integer ratios, so the simulation is integer-only; effects and drawing see
+# a copy converted back to pixels.
+FIXED_ONE = 1000
+
+class FixedPoint:
+    one = FIXED_ONE
+    
+    def __init__(self, x, y):
+        super().__init__(x, y)
+        for name in self.scaled_fields:
+            setattr(self, name, round(getattr(self, name) * FIXED_ONE))
+    
+    def combo_damage(self, damage):
+        return damage * (10 + self.combo_counter) // 10
+    
+    def ratio(self, value, numerator, denominator):
+        return value * numerator // denominator
+    
+    def count(self, value, step):
+        return value // (step * FIXED_ONE)
+    
+    def effects(self):
+        view = object.__new__(self.float_class)
+        view.__dict__.update(self.__dict__)
+        for name in self.scaled_fields:
+            setattr(view, name, getattr(self, name) / FIXED_ONE)
+        return view
+    
+    def snapshot(self):
+        return self.effects().snapshot()
+    
+    def draw(self, surface, camera_x=0):
+        self.effects().draw(surface, camera_x)
+
+fixed_classes = {}
+
+def fixed_class(fighter_class):
+    if issubclass(fighter_class, FixedPoint):
+        return fighter_class
+    fixed = fixed_classes.get(fighter_class)
+    if fixed is None:
+        # Same wire layout with the scaled floats sent as ints
+        state_fields = tuple((name, "i" if code == "f" else code) for name, code in fighter_class.state_fields)
+        fixed = fixed_classes[fighter_class] = type("Fixed" + fighter_class.__name__, (FixedPoint, fighter_class),
+                                                     {"float_class": fighter_class, "state_fields": state_fields})
+        CHARACTER_INDEX[fixed] = CHARACTER_INDEX[fighter_class]
+    return fixed
+
+# Background elements. Stages can be wider than the screen: the wall layer
+# scrolls at PARALLAX_DEPTH of the camera's speed and the floor moves with
+# the fighters. The static part of each layer is drawn once into a cached
+# surface per depth, so a frame costs one screen-sized blit per layer however
+# wide the stage is; only the animated crowd is drawn live, where visible.
+PARALLAX_DEPTH = 0.5
+SKY_COLORS = {"dojo": (150, 120, 90), "street": (100, 150, 200), "arena": (50, 50, 80)}
+
 class Background:
-    def __init__(self, theme="dojo"):
+    def __init__(self, theme="dojo", width=SCREEN_WIDTH):
         self.theme = theme
+        self.width = width
         self.elements = []
+        self.frame = 0
+        self.layers = None
+        # The screen-sized layout repeats across the wall layer, which is as
+        # wide as the camera's travel at its depth
+        self.wall_width = SCREEN_WIDTH + int((width - SCREEN_WIDTH) * PARALLAX_DEPTH)
+        panels = range(0, self.wall_width, SCREEN_WIDTH)
         
         if theme == "dojo":
             # Wooden floor
             self.floor_color = (139, 69, 19)
             # Background elements - windows, wall decorations
-            for i in range(5):
-                self.elements.append({
-                    'type': 'window',
-                    'x': 100 + i * 150,
-                    'y': 100,
-                    'width': 80,
-                    'height': 120
-                })
+            for panel in panels:
+                for i in range(5):
+                    self.elements.append({
+                        'type': 'window',
+                        'x': panel + 100 + i * 150,
+                        'y': 100,
+                        'width': 80,
+                        'height': 120
+                    })
                 
         elif theme == "street":
             # Concrete floor
             self.floor_color = (100, 100, 100)
             # Street elements - buildings, cars, etc.
-            for i in range(3):
-                self.elements.append({
-                    'type': 'building',
-                    'x': i * 250,
-                    'y': 50,
-                    'width': 200,
-                    'height': 250
-                })
+            for panel in panels:
+                for i in range(3):
+                    self.elements.append({
+                        'type': 'building',
+                        'x': panel + i * 250,
+                        'y': 50,
+                        'width': 200,
+                        'height': 250
+                    })
             
         elif theme == "arena":
             # Arena floor
             self.floor_color = (200, 180, 100)
             # Arena elements - crowd, banners, etc.
-            for i in range(8):
-                self.elements.append({
-                    'type': 'crowd',
-                    'x': i * 100,
-                    'y': 150,
-                    'width': 80,
-                    'height': 30
-                })
-    
-    def draw(self, surface):
-        # Draw sky/background
-        if self.theme == "dojo":
-            pygame.draw.rect(surface, (150, 120, 90), (0, 0, SCREEN_WIDTH, SCREEN_HEIGHT))
-        elif self.theme == "street":
-            pygame.draw.rect(surface, (100, 150, 200), (0, 0, SCREEN_WIDTH, SCREEN_HEIGHT))
-        elif self.theme == "arena":
-            pygame.draw.rect(surface, (50, 50, 80), (0, 0, SCREEN_WIDTH, SCREEN_HEIGHT))
-        
-        # Draw background elements
+            for panel in panels:
+                for i in range(8):
+                    self.elements.append({
+                        'type': 'crowd',
+                        'x': panel + i * 100,
+                        'y': 150,
+                        'width': 80,
+                        'height': 30
+                    })
+    
+    def build(self, surface):
+        # Static layers in the target surface's pixel format
+        wall = pygame.Surface((self.wall_width, FLOOR_HEIGHT), 0, surface)
+        wall.fill(SKY_COLORS[self.theme])
         for element in self.elements:
             if element['type'] == 'window':
-                pygame.draw.rect(surface, (200, 200, 255), 
+                pygame.draw.rect(wall, (200, 200, 255), 
                                (element['x'], element['y'], element['width'], element['height']))
-                pygame.draw.rect(surface, (100, 100, 100), 
+                pygame.draw.rect(wall, (100, 100, 100), 
                                (element['x'], element['y'], element['width'], element['height']), 3)
                 
             elif element['type'] == 'building':
-                pygame.draw.rect(surface, (80, 80, 80), 
+                pygame.draw.rect(wall, (80, 80, 80), 
                                (element['x'], element['y'], element['width'], element['height']))
                 
                 # Windows
@@ -859,168 +1264,3250 @@ class Background:
                     for wx in range(3):
                         window_x = element['x'] + 20 + wx * 60
                         window_y = element['y'] + 30 + wy * 50
-                        pygame.draw.rect(surface, (255, 255, 200), 
+                        pygame.draw.rect(wall, (255, 255, 200), 
                                        (window_x, window_y, 40, 30))
-                
-            elif element['type'] == 'crowd':
-                # Random crowd color
-                for p in range(10):
-                    person_color = (random.randint(50, 255), random.randint(50, 255), random.randint(50, 255))
-                    pygame.draw.circle(surface, person_color, 
-                                    (element['x'] + random.randint(0, element['width']), 
-                                     element['y'] + random.randint(0, element['height'])), 
-                                    random.randint(5, 10))
         
-        # Draw floor
-        pygame.draw.rect(surface, self.floor_color, (0, FLOOR_HEIGHT, SCREEN_WIDTH, SCREEN_HEIGHT - FLOOR_HEIGHT))
-        
-        # Draw floor details
+        floor = pygame.Surface((self.width, SCREEN_HEIGHT - FLOOR_HEIGHT), 0, surface)
+        floor.fill(self.floor_color)
         if self.theme == "dojo":
             # Wood grain
             for i in range(5):
-                pygame.draw.line(surface, (100, 50, 0), 
-                               (0, FLOOR_HEIGHT + 20 + i * 15), 
-                               (SCREEN_WIDTH, FLOOR_HEIGHT + 20 + i * 15), 2)
+                pygame.draw.line(floor, (100, 50, 0), (0, 20 + i * 15), (self.width, 20 + i * 15), 2)
                 
         elif self.theme == "street":
             # Street markings
-            pygame.draw.rect(surface, (255, 255, 255), 
-                           (50, FLOOR_HEIGHT + 30, 100, 20))
-            pygame.draw.rect(surface, (255, 255, 255), 
-                           (250, FLOOR_HEIGHT + 30, 100, 20))
-            pygame.draw.rect(surface, (255, 255, 255), 
-                           (450, FLOOR_HEIGHT + 30, 100, 20))
-            pygame.draw.rect(surface, (255, 255, 255), 
-                           (650, FLOOR_HEIGHT + 30, 100, 20))
-            
-        elif self.theme == "arena":
-            # Arena circle
-            pygame.draw.circle(surface, (255, 255, 255), 
-                             (SCREEN_WIDTH // 2, FLOOR_HEIGHT + 50), 150, 5)
+            for panel in range(0, self.width, SCREEN_WIDTH):
+                for marking_x in (50, 250, 450, 650):
+                    pygame.draw.rect(floor, (255, 255, 255), (panel + marking_x, 30, 100, 20))
+        self.layers = wall, floor
+    
+    def draw(self, surface, camera_x=0):
+        if self.layers is None:
+            self.build(surface)
+        wall, floor = self.layers
+        
+        # Draw sky and wall
+        wall_x = int(camera_x * PARALLAX_DEPTH)
+        surface.blit(wall, (0, 0), (wall_x, 0, SCREEN_WIDTH, FLOOR_HEIGHT))
+        
+        for element in self.elements:
+            if element['type'] == 'crowd':
+                x = element['x'] - wall_x
+                if x + element['width'] + 10 < 0 or x - 10 > SCREEN_WIDTH:
+                    continue
+                # Random crowd color, re-rolled every background_interval frames
+                if 'people' not in element or self.frame % background_interval == 0:
+                    element['people'] = [
+                        ((random.randint(50, 255), random.randint(50, 255), random.randint(50, 255)),
+                         (element['x'] + random.randint(0, element['width']),
+                          element['y'] + random.randint(0, element['height'])),
+                         random.randint(5, 10))
+                        for p in range(10)
+                    ]
+                for person_color, (person_x, person_y), radius in element['people']:
+                    pygame.draw.circle(surface, person_color, (person_x - wall_x, person_y), radius)
+        
+        # Draw floor
+        surface.blit(floor, (0, FLOOR_HEIGHT), (camera_x, 0, SCREEN_WIDTH, SCREEN_HEIGHT - FLOOR_HEIGHT))
+        self.frame += 1
+        
+        if self.theme == "arena":
+            # Arena circle, centred on the stage
+            circle_x = self.width // 2 - camera_x
+            if -150 < circle_x < SCREEN_WIDTH + 150:
+                pygame.draw.circle(surface, (255, 255, 255), 
+                                 (circle_x, FLOOR_HEIGHT + 50), 150, 5)
 
-# Main game functions
-def draw_menu(screen):
-    screen.fill(BLACK)
+# Camera over a stage wider than the screen. It eases toward the midpoint of
+# the fighters still standing, clamped to the stage edges, and tells the
+# particle update which part of the stage is in view.
+CAMERA_EASE = 0.15
+CAMERA_MARGIN = 150  # Beyond the screen edge: drawing and particle motion stop
+
+class Camera:
+    def __init__(self, stage_width=SCREEN_WIDTH):
+        self.stage_width = stage_width
+        self.x = 0.0
     
-    # Title
-    title_text = title_font.render("PYTHON STREET FIGHTER", True, RED)
-    screen.blit(title_text, (SCREEN_WIDTH//2 - title_text.get_width()//2, 100))
+    def left(self):
+        return int(self.x)
     
-    # Menu options
-    start_text = menu_font.render("PRESS ENTER TO START", True, WHITE)
-    screen.blit(start_text, (SCREEN_WIDTH//2 - start_text.get_width()//2, 300))
+    def follow(self, fighters, snap=False):
+        global particle_view
+        standing = [fighter for fighter in fighters if fighter.hp > 0] or fighters
+        centers = [(fighter.x + fighter.width / 2) / fighter.one for fighter in standing]
+        target = (min(centers) + max(centers)) / 2 - SCREEN_WIDTH / 2
+        target = max(0, min(self.stage_width - SCREEN_WIDTH, target))
+        self.x = target if snap else self.x + (target - self.x) * CAMERA_EASE
+        if self.stage_width > SCREEN_WIDTH:
+            particle_view = (self.x - CAMERA_MARGIN, self.x + SCREEN_WIDTH + CAMERA_MARGIN)
+        else:
+            # Everything is in view; don't keep culling against a wider stage's window
+            particle_view = None
     
-    controls_text = menu_font.render("Player 1: WASD + F/G    Player 2: Arrows + K/L", True, WHITE)
-    screen.blit(controls_text, (SCREEN_WIDTH//2 - controls_text.get_width()//2, 400))
+    def sees(self, fighter):
+        x = fighter.x / fighter.one - self.x
+        return -CAMERA_MARGIN < x + fighter.width / fighter.one and x < SCREEN_WIDTH + CAMERA_MARGIN
+
+# Player input. Each control is one bit so a player's input for a frame is a
+# single int, whether it comes from the keyboard or a CPU controller.
+INPUT_LEFT = 1
+INPUT_RIGHT = 2
+INPUT_JUMP = 4
+INPUT_DASH = 8
+INPUT_ATTACK = 16
+INPUT_SPECIAL = 32
+INPUT_BLOCK = 64
+
+P1_KEYS = {INPUT_LEFT: K_a, INPUT_RIGHT: K_d, INPUT_JUMP: K_w, INPUT_DASH: K_s,
+           INPUT_ATTACK: K_f, INPUT_SPECIAL: K_g, INPUT_BLOCK: K_c}
+P2_KEYS = {INPUT_LEFT: K_LEFT, INPUT_RIGHT: K_RIGHT, INPUT_JUMP: K_UP, INPUT_DASH: K_DOWN,
+           INPUT_ATTACK: K_k, INPUT_SPECIAL: K_j, INPUT_BLOCK: K_l}
+
+def read_input(keys, key_map):
+    bits = 0
+    for bit, key in key_map.items():
+        if keys[key]:
+            bits |= bit
+    return bits
+
+def apply_input(fighter, bits):
+    x_direction = 0
+    if bits & INPUT_LEFT:
+        x_direction = -1
+    elif bits & INPUT_RIGHT:
+        x_direction = 1
+    fighter.move(x_direction)
     
-    pygame.display.flip()
+    if bits & INPUT_JUMP:
+        fighter.jump()
+        
+    if bits & INPUT_DASH:
+        if isinstance(fighter, NinjaFighter) and x_direction != 0:
+            fighter.dash(x_direction)
+        
+    fighter.block(bool(bits & INPUT_BLOCK))
+    
+    # Attacks only start when not already attacking (avoids key repeat)
+    if bits & INPUT_ATTACK and not fighter.is_attacking:
+        fighter.attack()
+    if bits & INPUT_SPECIAL and not fighter.is_attacking:
+        fighter.special_attack()
 
-def draw_character_select(screen, p1_selection, p2_selection, characters):
-    screen.fill(BLACK)
+class KeyboardController:
+    def __init__(self, key_map):
+        self.key_map = key_map
     
-    # Title
-    title_text = title_font.render("SELECT YOUR FIGHTER", True, RED)
-    screen.blit(title_text, (SCREEN_WIDTH//2 - title_text.get_width()//2, 50))
+    def control(self, fighter, target):
+        return read_input(pygame.key.get_pressed(), self.key_map)
+
+class CpuController:
+    def __init__(self, seed=None, frame_data=None):
+        self.rng = random.Random(seed)
+        self.frame_data = frame_data
     
-    # Character selection boxes
-    box_width = 150
-    box_height = 200
-    spacing = 30
-    total_width = len(characters) * box_width + (len(characters) - 1) * spacing
-    start_x = (SCREEN_WIDTH - total_width) // 2
+    def control(self, fighter, target):
+        bits = self.choose(fighter, target)
+        if self.frame_data and target is not None:
+            # Specials whenever the frame data says they land from here; other
+            # moves that would whiff become a step toward the target
+            if fighter.special_ready() and self.connects(fighter, target, ACTION_SPECIAL):
+                bits = INPUT_SPECIAL
+            action = ACTION_SPECIAL if bits & INPUT_SPECIAL else ACTION_ATTACK
+            if bits & (INPUT_ATTACK | INPUT_SPECIAL) and not self.connects(fighter, target, action):
+                bits = bits & ~(INPUT_ATTACK | INPUT_SPECIAL) or (INPUT_RIGHT if target.x > fighter.x else INPUT_LEFT)
+        return bits
     
-    for i, (name, color, _) in enumerate(characters):
-        x = start_x + i * (box_width + spacing)
-        y = 150
+    def choose(self, fighter, target):
+        if target is None:
+            return 0
         
-        # Box background
-        pygame.draw.rect(screen, color, (x, y, box_width, box_height))
+        rng = self.rng
+        one = fighter.one
+        dx = (target.x + target.width / 2) - (fighter.x + fighter.width / 2)
+        toward = INPUT_RIGHT if dx > 0 else INPUT_LEFT
+        away = INPUT_LEFT if dx > 0 else INPUT_RIGHT
+        gap = abs(dx) - (fighter.width + target.width) / 2
         
-        # Character name
-        name_text = menu_font.render(name, True, WHITE)
-        screen.blit(name_text, (x + box_width//2 - name_text.get_width()//2, y + box_height + 20))
+        # Block incoming attacks some of the time
+        if target.is_attacking and gap < target.attack_range + 20 * one and rng.random() < 0.5:
+            return INPUT_BLOCK
         
-        # Selection indicators
-        if p1_selection == i:
-            pygame.draw.rect(screen, RED, (x, y, box_width, box_height), 5)
-            p1_text = menu_font.render("P1", True, RED)
+        if gap > fighter.attack_range:
+            bits = toward
+            if rng.random() < 0.02:
+                bits |= INPUT_JUMP
+            if gap > 200 * one and rng.random() < 0.05:
+                bits |= INPUT_DASH
+            if rng.random() < 0.01:
+                bits |= INPUT_SPECIAL
+            return bits
+        
+        roll = rng.random()
+        if roll < 0.1:
+            return INPUT_SPECIAL
+        if roll < 0.5:
+            return INPUT_ATTACK
+        if roll < 0.6:
+            return away
+        return 0
+    
+    def connects(self, fighter, target, action):
+        # Per the frame data, the move would hit from here while the target can be hit
+        one = fighter.one
+        gap = (abs(target.x + target.width / 2 - fighter.x - fighter.width / 2) - (fighter.width + target.width) / 2) / one
+        guard = GUARD_BLOCK if target.is_blocking else GUARD_IDLE
+        contact = self.frame_data.entry(CHARACTER_INDEX[type(fighter)], CHARACTER_INDEX[type(target)],
+                                        action, guard, gap)[0]
+        return 0 <= contact and target.hit_cooldown <= contact
+
+# Fighters bucketed by x so targeting and hit checks only look at nearby
+# fighters instead of testing every pair
+class SpatialGrid:
+    def __init__(self, cell_size=128):
+        self.cell_size = cell_size
+        self.cells = {}
+    
+    def rebuild(self, fighters, active):
+        self.cells = {}
+        for index, fighter in enumerate(fighters):
+            if active[index]:
+                for cell in range(int(fighter.x // self.cell_size), int((fighter.x + fighter.width) // self.cell_size) + 1):
+                    self.cells.setdefault(cell, []).append(index)
+    
+    def query(self, left, right):
+        found = set()
+        for cell in range(int(left // self.cell_size), int(right // self.cell_size) + 1):
+            found.update(self.cells.get(cell, ()))
+        return sorted(found)
+    
+    def nearest(self, fighters, index, accept):
+        # Search outward ring by ring until no closer fighter can exist
+        fighter = fighters[index]
+        center = fighter.x + fighter.width / 2
+        home = int(center // self.cell_size)
+        lowest = min(self.cells, default=home)
+        highest = max(self.cells, default=home)
+        best, best_distance = None, None
+        radius = 0
+        while home - radius >= lowest or home + radius <= highest:
+            if best is not None and (radius - 2) * self.cell_size > best_distance:
+                break
+            for cell in {home - radius, home + radius}:
+                for other in self.cells.get(cell, ()):
+                    if other == index or not accept(other):
+                        continue
+                    distance = abs(fighters[other].x + fighters[other].width / 2 - center)
+                    if best is None or (distance, other) < (best_distance, best):
+                        best, best_distance = other, distance
+            radius += 1
+        return best
+
+# A match between any number of fighters. Fighters on the same team never
+# target or hit each other; by default everyone is on their own team.
+class Match:
+    def __init__(self, fighters, teams=None):
+        self.fighters = fighters
+        self.teams = teams if teams is not None else list(range(len(fighters)))
+        self.grid = SpatialGrid(128 * fighters[0].one)
+        self.frame = 0
+        self.active = [True] * len(fighters)
+        for slot, fighter in enumerate(fighters):
+            fighter.slot = slot
+        self.match_id = telemetry.new_match() if telemetry else 0
+        self.hasher = StateHasher(fighters)
+        self.replay = recorder.start(self) if recorder else None
+        # A speculative match can still be rolled back past its knockout,
+        # so its owner finishes the replay instead
+        self.speculative = False
+        self.grid.rebuild(self.fighters, self.active)
+    
+    def target_index(self, index):
+        team = self.teams[index]
+        return self.grid.nearest(self.fighters, index,
+                                 lambda other: self.active[other] and self.teams[other] != team)
+    
+    def target_of(self, fighter):
+        index = self.fighters.index(fighter)
+        if not self.active[index]:
+            return None
+        target = self.target_index(index)
+        return None if target is None else self.fighters[target]
+    
+    def step(self, inputs):
+        fighters = self.fighters
+        if telemetry:
+            telemetry.begin_frame(self.match_id, self.frame)
+        # Fighters knocked out before this frame sit out
+        self.active = active = [fighter.hp > 0 for fighter in fighters]
+        
+        for index, bits in enumerate(inputs):
+            apply_input(fighters[index], bits if active[index] else 0)
+        
+        # Update fighters
+        targets = [self.target_index(i) if active[i] else None for i in range(len(fighters))]
+        for fighter, target in zip(fighters, targets):
+            fighter.update(None if target is None else fighters[target])
+        
+        # Check for hits
+        self.grid.rebuild(fighters, active)
+        for index, attacker in enumerate(fighters):
+            if targets[index] is None:
+                continue
+            position = attacker.x
+            attacker.prepare_hit(fighters[targets[index]])
+            if attacker.x != position:
+                # Teleported; later attackers must see the new position
+                self.grid.rebuild(fighters, active)
+            hitbox = attacker.attack_hitbox()
+            if hitbox is None:
+                continue
+            for victim in self.grid.query(hitbox[0], hitbox[0] + hitbox[2]):
+                if (active[victim] and self.teams[victim] != self.teams[index] and
+                        attacker.hitbox_overlaps(hitbox, fighters[victim])):
+                    attacker.land_hit(fighters[victim])
+        
+        self.grid.rebuild(fighters, [fighter.hp > 0 for fighter in fighters])
+        if self.replay:
+            self.replay.record(self.frame, inputs, self.hasher.pack([fighter.get_state() for fighter in fighters]))
+        self.frame += 1
+        if telemetry:
+            telemetry.end_frame()
+        if self.replay and self.is_over() and not self.speculative:
+            recorder.finish(self.replay)
+            self.replay = None
+    
+    def save_state(self):
+        return self.frame, tuple(fighter.get_state() for fighter in self.fighters)
+    
+    def state_hash(self):
+        return self.hasher.checksum([fighter.get_state() for fighter in self.fighters])
+    
+    def load_state(self, saved):
+        self.frame, states = saved
+        for fighter, state in zip(self.fighters, states):
+            fighter.set_state(state)
+        self.active = [fighter.hp > 0 for fighter in self.fighters]
+        self.grid.rebuild(self.fighters, self.active)
+    
+    def is_over(self):
+        return len({team for fighter, team in zip(self.fighters, self.teams) if fighter.hp > 0}) <= 1
+    
+    def result(self):
+        # (winner, loser); if everyone is down the higher HP percentage wins
+        standing = [fighter for fighter in self.fighters if fighter.hp > 0]
+        if not standing:
+            standing = self.fighters
+        winner = standing[0]
+        for fighter in standing[1:]:
+            if fighter.hp / fighter.max_hp >= winner.hp / winner.max_hp:
+                winner = fighter
+        winner_team = self.teams[self.fighters.index(winner)]
+        loser = next(fighter for fighter, team in zip(self.fighters, self.teams) if team != winner_team)
+        return winner, loser
+
+# Character definitions
+CHARACTERS = [
+    ("Shadow Ninja", BLACK, NinjaFighter),
+    ("Volt Striker", BLUE, ElectricFighter),
+    ("Flame Master", RED, FireFighter),
+    ("Stone Titan", (139, 69, 19), EarthFighter)
+]
+CHARACTER_INDEX = {fighter_class: index for index, (_, _, fighter_class) in enumerate(CHARACTERS)}
+STAGE_THEMES = ["dojo", "street", "arena"]
+
+MATCH_MODES = ("versus", "2v2", "ffa")
+
+# Set by --fixed: matches are created with fixed-point fighters
+fixed_point = False
+# Set by --stage-width: matches are fought on stages this wide (pixels)
+stage_width = SCREEN_WIDTH
+
+def spawn_positions(count, width=SCREEN_WIDTH):
+    # The screen-sized layout, centred on the stage
+    offset = (width - SCREEN_WIDTH) // 2
+    if count == 2:
+        return [150 + offset, SCREEN_WIDTH - 200 + offset]
+    # Alternate sides so P1/P3 start left and P2/P4 start right
+    step = (SCREEN_WIDTH - 220) / max(1, count - 1)
+    left = [offset + 80 + i * step for i in range(0, count, 2)]
+    right = [offset + SCREEN_WIDTH - 140 - i * step for i in range(0, count - 1, 2)]
+    return [left[i // 2] if i % 2 == 0 else right[i // 2] for i in range(count)]
+
+def create_match(fighter_classes, mode="versus", fixed=None, width=None):
+    if fixed_point if fixed is None else fixed:
+        fighter_classes = [fixed_class(fighter_class) for fighter_class in fighter_classes]
+    width = stage_width if width is None else width
+    positions = spawn_positions(len(fighter_classes), width)
+    fighters = []
+    for fighter_class, x in zip(fighter_classes, positions):
+        fighter = fighter_class(x, FLOOR_HEIGHT - 100)
+        if width != SCREEN_WIDTH:
+            fighter.stage_width = width
+        fighter.facing_right = x < width / 2
+        fighters.append(fighter)
+    # 2v2 pairs P1 with P3 and P2 with P4
+    teams = [i % 2 for i in range(len(fighters))] if mode == "2v2" else None
+    return Match(fighters, teams)
+
+# Frame data. Every move of every character is simulated against every
+# character, guard and spacing (gap between the bodies, in pixels) on the
+# headless simulator, and the results are kept in flat arrays indexed by
+# (attacker, defender, action, guard, gap bucket) so controllers can look an
+# interaction up instead of simulating it. Gaps round up to the next bucket.
+# Meters start at the lowest level that allows the special.
+FRAME_DATA_MAGIC = b"SFFD1\n"
+FRAME_DATA_STEP = 4
+FRAME_DATA_GAPS = 76          # Gaps 0..300 px
+FRAME_DATA_FRAMES = 120       # Longest interaction simulated
+FRAME_DATA_LEAD = 1           # Frames the defender guards before the attacker's first input
+FRAME_DATA_ACTIONS = (
+    # (name, attacker inputs from the first frame; the last one starts the move)
+    ("attack", (INPUT_ATTACK,)),
+    ("special", (INPUT_SPECIAL,)),
+    ("dash attack", (INPUT_DASH | INPUT_RIGHT, INPUT_ATTACK)),
+    ("dash special", (INPUT_DASH | INPUT_RIGHT, INPUT_SPECIAL)),
+)
+FRAME_DATA_GUARDS = (
+    # (name, defender input on the attacker's move frame, input held otherwise,
+    # starting FRAME_DATA_LEAD frames before the attacker's first input)
+    ("idle", 0, 0),
+    ("block", INPUT_BLOCK, INPUT_BLOCK),
+    ("attack", INPUT_ATTACK, 0),
+)
+ACTION_ATTACK, ACTION_SPECIAL, ACTION_DASH_ATTACK, ACTION_DASH_SPECIAL = range(len(FRAME_DATA_ACTIONS))
+GUARD_IDLE, GUARD_BLOCK, GUARD_ATTACK = range(len(FRAME_DATA_GUARDS))
+# Per interaction: first contact frame after the move starts (-1: none),
+# frame advantage (defender ready minus attacker ready), damage dealt and
+# taken in tenths of HP (armor included), and the gap once both can act.
+# The rules have no hit or block stun (a blocking fighter can let go and
+# attack on the same frame), so advantage on hit and on block come out alike;
+# blocking changes the damage.
+FRAME_DATA_FIELDS = (("contact", "b"), ("advantage", "b"), ("damage", "h"), ("damage_taken", "h"), ("gap_after", "h"))
+# Per move: startup (from the first input up to and including the first
+# active frame), active frames, recovery
+MOVE_FIELDS = ("startup", "active", "recovery")
+NO_REACH = -1
+
+class FrameData:
+    def __init__(self):
+        kinds = len(CHARACTERS)
+        self.shape = (kinds, kinds, len(FRAME_DATA_ACTIONS), len(FRAME_DATA_GUARDS), FRAME_DATA_GAPS)
+        size = math.prod(self.shape)
+        self.tables = {name: array(code, [0]) * size for name, code in FRAME_DATA_FIELDS}
+        self.tables["contact"] = array("b", [-1]) * size
+        self.moves = array("B", [0]) * (kinds * len(FRAME_DATA_ACTIONS) * len(MOVE_FIELDS))
+        self.reaches = array("h", [NO_REACH]) * (kinds * kinds * len(FRAME_DATA_ACTIONS))
+    
+    def index(self, attacker, defender, action, guard, gap):
+        bucket = min(FRAME_DATA_GAPS - 1, max(0, -int(-gap // FRAME_DATA_STEP)))
+        _, kinds, actions, guards, gaps = self.shape
+        return (((attacker * kinds + defender) * actions + action) * guards + guard) * gaps + bucket
+    
+    def entry(self, attacker, defender, action, guard, gap):
+        # (contact, advantage, damage, damage_taken, gap_after) with damage in HP
+        index = self.index(attacker, defender, action, guard, gap)
+        tables = self.tables
+        return (tables["contact"][index], tables["advantage"][index], tables["damage"][index] / 10,
+                tables["damage_taken"][index] / 10, tables["gap_after"][index])
+    
+    def connects(self, attacker, defender, action, guard, gap):
+        return self.tables["contact"][self.index(attacker, defender, action, guard, gap)] >= 0
+    
+    def move(self, kind, action):
+        start = (kind * len(FRAME_DATA_ACTIONS) + action) * len(MOVE_FIELDS)
+        return tuple(self.moves[start:start + len(MOVE_FIELDS)])
+    
+    def reach(self, attacker, defender, action):
+        # Widest gap (px) at which the move connects on an idle defender
+        return self.reaches[(attacker * len(CHARACTERS) + defender) * len(FRAME_DATA_ACTIONS) + action]
+    
+    def store(self, attacker, defender, action, guard, gap, result):
+        index = self.index(attacker, defender, action, guard, gap)
+        for (name, _), value in zip(FRAME_DATA_FIELDS, result):
+            self.tables[name][index] = value
+    
+    def store_move(self, kind, action, frames):
+        start = (kind * len(FRAME_DATA_ACTIONS) + action) * len(MOVE_FIELDS)
+        self.moves[start:start + len(MOVE_FIELDS)] = array("B", frames)
+    
+    def compute_reaches(self):
+        for attacker in range(len(CHARACTERS)):
+            for defender in range(len(CHARACTERS)):
+                for action in range(len(FRAME_DATA_ACTIONS)):
+                    reach = NO_REACH
+                    for bucket in range(FRAME_DATA_GAPS):
+                        if self.connects(attacker, defender, action, GUARD_IDLE, bucket * FRAME_DATA_STEP):
+                            reach = bucket * FRAME_DATA_STEP
+                    self.reaches[(attacker * len(CHARACTERS) + defender) * len(FRAME_DATA_ACTIONS) + action] = reach
+    
+    def write(self, path):
+        header = {"characters": [name for name, _, _ in CHARACTERS], "shape": self.shape, "step": FRAME_DATA_STEP}
+        with gzip.open(path, "wb") as out:
+            out.write(FRAME_DATA_MAGIC + json.dumps(header).encode() + b"\n")
+            out.write(self.moves.tobytes())
+            for name, _ in FRAME_DATA_FIELDS:
+                out.write(self.tables[name].tobytes())
+    
+    @classmethod
+    def read(cls, path):
+        frame_data = cls()
+        with gzip.open(path, "rb") as data:
+            if data.readline() != FRAME_DATA_MAGIC:
+                raise ValueError(f"{path} is not a frame data file")
+            header = json.loads(data.readline())
+            if tuple(header["shape"]) != frame_data.shape or header["step"] != FRAME_DATA_STEP:
+                raise ValueError(f"{path} was built for a different roster or spacing")
+            frame_data.moves = array("B", data.read(len(frame_data.moves)))
+            for name, code in FRAME_DATA_FIELDS:
+                table = frame_data.tables[name]
+                frame_data.tables[name] = array(code, data.read(len(table) * table.itemsize))
+        frame_data.compute_reaches()
+        return frame_data
+
+def prime_meters(fighter):
+    one = fighter.one
+    if hasattr(fighter, "charge_level"):
+        fighter.charge_level = 50 * one
+    if hasattr(fighter, "heat_level"):
+        fighter.heat_level = 40 * one
+
+def can_act(fighter):
+    # A new attack would start this frame
+    return not fighter.is_attacking and fighter.attack_cooldown == 0
+
+def health(fighter):
+    return fighter.hp + getattr(fighter, "stone_armor", 0)
+
+# One interaction: the attacker (facing right, on the left) performs the move
+# with `gap` pixels between the bodies. The defender is already guarding when
+# the attacker's first input comes. Returns the move's frames and the
+# FRAME_DATA_FIELDS values.
+def analyze_interaction(attacker_class, defender_class, inputs, guard, gap):
+    _, guard_first, guard_held = guard
+    match = create_match([attacker_class, defender_class], fixed=False, width=SCREEN_WIDTH)
+    attacker, defender = match.fighters
+    left = (SCREEN_WIDTH - attacker.width - gap - defender.width) / 2
+    attacker.x, defender.x = left, left + attacker.width + gap
+    for fighter in match.fighters:
+        fighter.y = FLOOR_HEIGHT - fighter.height
+        prime_meters(fighter)
+    first = FRAME_DATA_LEAD
+    start = first + len(inputs) - 1
+    active = []
+    contact = attacker_ready = defender_ready = None
+    damage = damage_taken = 0
+    for step in range(FRAME_DATA_FRAMES):
+        before = health(attacker), health(defender)
+        attacker_input = inputs[step - first] if first <= step < first + len(inputs) else 0
+        match.step([attacker_input, guard_first if step == start else guard_held])
+        if defender.hit_cooldown == 15:
+            damage += before[1] - health(defender)
+            if contact is None:
+                contact = step
+        if attacker.hit_cooldown == 15:
+            damage_taken += before[0] - health(attacker)
+        if attacker.attack_hitbox() is not None:
+            active.append(step)
+        if step >= start and attacker_ready is None and active and can_act(attacker):
+            attacker_ready = step
+        if contact is not None and defender_ready is None and can_act(defender):
+            defender_ready = step
+        if (step >= start and (attacker_ready is not None or not attacker.is_attacking) and
+                (defender_ready is not None if contact is not None else can_act(defender))):
+            break
+    if not active:
+        return (0, 0, 0), (-1, 0, 0, round(damage_taken * 10), gap)
+    if attacker_ready is None:
+        attacker_ready = step
+    frames = (active[0] - first + 1, len(active), attacker_ready - active[-1])
+    gap_after = abs(defender.x + defender.width / 2 - attacker.x - attacker.width / 2) - (attacker.width + defender.width) / 2
+    if contact is None:
+        return frames, (-1, 0, 0, round(damage_taken * 10), round(gap_after))
+    advantage = max(-128, min(127, (defender_ready if defender_ready is not None else step) - attacker_ready))
+    return frames, (contact - start, advantage, round(damage * 10), round(damage_taken * 10), round(gap_after))
+
+def build_frame_data():
+    global effect_scale, telemetry, recorder
+    saved = effect_scale, telemetry, recorder
+    effect_scale, telemetry, recorder = 0, None, None
+    try:
+        frame_data = FrameData()
+        for attacker, (_, _, attacker_class) in enumerate(CHARACTERS):
+            for action, (_, inputs) in enumerate(FRAME_DATA_ACTIONS):
+                if inputs[0] & INPUT_DASH and not hasattr(attacker_class, "dash"):
+                    continue  # Only the ninja dashes
+                for defender, (_, _, defender_class) in enumerate(CHARACTERS):
+                    for guard_index, guard in enumerate(FRAME_DATA_GUARDS):
+                        for bucket in range(FRAME_DATA_GAPS):
+                            gap = bucket * FRAME_DATA_STEP
+                            frames, result = analyze_interaction(attacker_class, defender_class, inputs, guard, gap)
+                            frame_data.store(attacker, defender, action, guard_index, gap, result)
+                if frames[0]:
+                    frame_data.store_move(attacker, action, frames)
+    finally:
+        effect_scale, telemetry, recorder = saved
+    frame_data.compute_reaches()
+    return frame_data
+
+def run_frame_data_build(args):
+    start = time.perf_counter()
+    frame_data = build_frame_data()
+    elapsed = time.perf_counter() - start
+    frame_data.write(args.frame_data_build)
+    interactions = math.prod(frame_data.shape)
+    print(f"frame data: {interactions} interactions in {elapsed:.1f} s, "
+          f"{sum(table.itemsize * len(table) for table in frame_data.tables.values()) // 1024} KiB of tables "
+          f"written to {args.frame_data_build}")
+    for kind, (name, _, _) in enumerate(CHARACTERS):
+        print(name)
+        for action, (action_name, _) in enumerate(FRAME_DATA_ACTIONS):
+            startup, active, recovery = frame_data.move(kind, action)
+            if not startup:
+                continue
+            # Mirror match: reach on an idle defender, advantage at point blank
+            reach = frame_data.reach(kind, kind, action)
+            reach = "none" if reach == NO_REACH else "stage" if reach == (FRAME_DATA_GAPS - 1) * FRAME_DATA_STEP else f"{reach} px"
+            on_hit = frame_data.entry(kind, kind, action, GUARD_IDLE, 0)
+            on_block = frame_data.entry(kind, kind, action, GUARD_BLOCK, 0)
+            print(f"  {action_name:<13} startup {startup:>2}  active {active:>2}  recovery {recovery:>2}  "
+                  f"range {reach:<6}  on hit {on_hit[1]:+d} ({on_hit[2]:g} dmg)  "
+                  f"on block {on_block[1]:+d} ({on_block[2]:g} dmg)")
+    return 0
+
+# Batched simulation: K versus matches as NumPy arrays of shape (2, K), one
+# row per slot, stepped with vectorized operations. It follows the rules of
+# Match.step and the Fighter classes exactly (same float operations in the
+# same order), without particles, sounds or telemetry.
+BATCH_FIELDS = ("x", "y", "vel_x", "vel_y", "hp", "speed", "attack_damage", "attack_cooldown",
+                "special_cooldown", "hit_cooldown", "combo_counter", "combo_timer", "frame",
+                "dash_cooldown", "charge_level", "heat_level", "fireball_cooldown", "stone_armor")
+BATCH_FLAGS = ("facing_right", "is_jumping", "is_attacking", "is_blocking", "has_double_jumped", "overheated")
+BATCH_CONSTANTS = ("width", "height", "jump_strength", "attack_range", "attack_duration", "max_hp")
+STATE_IDLE, STATE_WALK, STATE_JUMP, STATE_ATTACK, STATE_SPECIAL, STATE_HIT, STATE_BLOCK = range(len(FIGHTER_STATES))
+
+class MatchBatch:
+    def __init__(self, characters):
+        # characters: (K, 2) CHARACTERS indices
+        self.characters = np.array(characters, dtype=np.int8).T.copy()
+        count = self.characters.shape[1]
+        self.fields = {name: np.zeros((2, count)) for name in BATCH_FIELDS}
+        self.fields.update((name, np.zeros((2, count), dtype=bool)) for name in BATCH_FLAGS)
+        self.fields["state"] = np.zeros((2, count), dtype=np.int8)
+        self.constants = {name: np.zeros((2, count)) for name in BATCH_CONSTANTS}
+        self.kinds = [self.characters == kind for kind in range(len(CHARACTERS))]
+        self.frames = np.zeros(count, dtype=np.int64)
+        self.views = {}
+        self.reset()
+    
+    def reset(self, matches=None):
+        # Restart the given matches (all by default) from create_match's setup
+        matches = np.arange(self.frames.size) if matches is None else np.asarray(matches)
+        for slot, x in enumerate(spawn_positions(2)):
+            for kind, (_, _, fighter_class) in enumerate(CHARACTERS):
+                chosen = matches[self.characters[slot, matches] == kind]
+                if not chosen.size:
+                    continue
+                fighter = fighter_class(x, FLOOR_HEIGHT - 100)
+                fighter.facing_right = x < SCREEN_WIDTH / 2
+                for name, values in self.fields.items():
+                    if name == "state":
+                        values[slot, chosen] = FIGHTER_STATES.index(fighter.state)
+                    else:
+                        values[slot, chosen] = getattr(fighter, name, 0)
+                for name, values in self.constants.items():
+                    values[slot, chosen] = getattr(fighter, name)
+        self.frames[matches] = 0
+    
+    def done(self):
+        return (self.fields["hp"] <= 0).any(axis=0)
+    
+    def fighters(self, match):
+        # Fighter objects holding the match's current state, for drawing.
+        # They are reused, so they are only valid until the next call.
+        fighters = []
+        for slot in range(2):
+            kind = self.characters[slot, match]
+            fighter = self.views.get((slot, kind))
+            if fighter is None:
+                fighter = self.views[(slot, kind)] = CHARACTERS[kind][2](0, 0)
+            fighter.set_state(self.fighter_state(match, slot))
+            fighters.append(fighter)
+        return fighters
+    
+    def fighter_state(self, match, slot):
+        # The match's fighter as Fighter.get_state() would return it
+        fighter_class = CHARACTERS[self.characters[slot, match]][2]
+        return tuple(self.fields[name][slot, match].item() for name, _ in fighter_class.state_fields)
+    
+    def step(self, inputs):
+        # inputs: (K, 2) input bitmasks
+        f = self.fields
+        x, y, vel_x, vel_y, hp, speed = f["x"], f["y"], f["vel_x"], f["vel_y"], f["hp"], f["speed"]
+        attack_damage, attack_cooldown, state = f["attack_damage"], f["attack_cooldown"], f["state"]
+        special_cooldown, hit_cooldown = f["special_cooldown"], f["hit_cooldown"]
+        combo_counter, combo_timer = f["combo_counter"], f["combo_timer"]
+        facing_right, is_jumping = f["facing_right"], f["is_jumping"]
+        is_attacking, is_blocking = f["is_attacking"], f["is_blocking"]
+        dash_cooldown, has_double_jumped = f["dash_cooldown"], f["has_double_jumped"]
+        charge, heat, overheated = f["charge_level"], f["heat_level"], f["overheated"]
+        fireball_cooldown, armor = f["fireball_cooldown"], f["stone_armor"]
+        width, height = self.constants["width"], self.constants["height"]
+        duration = self.constants["attack_duration"]
+        ninja, electric, fire, earth = self.kinds
+        
+        # Fighters knocked out before this frame sit out
+        active = hp > 0
+        bits = np.where(active, np.asarray(inputs, dtype=np.int16).T, 0)
+        
+        # apply_input: move
+        direction = np.where(bits & INPUT_LEFT, -1, np.where(bits & INPUT_RIGHT, 1, 0))
+        free = ~is_attacking & ~is_blocking
+        np.copyto(vel_x, speed * direction, where=free)
+        np.copyto(state, np.where(direction != 0, STATE_WALK, STATE_IDLE), where=free, casting="unsafe")
+        
+        # jump (the ninja can jump again once in the air)
+        jump = (bits & INPUT_JUMP) != 0
+        ground_jump = jump & ~is_jumping & free
+        double_jump = jump & ninja & is_jumping & ~has_double_jumped
+        np.copyto(vel_y, self.constants["jump_strength"], where=ground_jump)
+        is_jumping |= ground_jump
+        np.copyto(vel_y, self.constants["jump_strength"] * (4 / 5), where=double_jump)
+        has_double_jumped |= double_jump
+        state[ground_jump | double_jump] = STATE_JUMP
+        
+        # dash
+        dash = ((bits & INPUT_DASH) != 0) & ninja & (direction != 0) & (dash_cooldown == 0) & ~is_attacking
+        np.copyto(vel_x, direction * 15, where=dash)
+        dash_cooldown[dash] = 45
+        
+        # block
+        blocking = (bits & INPUT_BLOCK) != 0
+        np.copyto(is_blocking, blocking, where=~is_attacking)
+        np.copyto(state, np.where(blocking, STATE_BLOCK, STATE_IDLE), where=~is_attacking, casting="unsafe")
+        vel_x[blocking & ~is_attacking] = 0
+        
+        # attack
+        pressed = ((bits & INPUT_ATTACK) != 0) & ~is_attacking
+        start = pressed & ~is_blocking & (attack_cooldown == 0) & ~(fire & overheated)
+        is_attacking |= start
+        np.copyto(attack_cooldown, duration, where=start)
+        state[start] = STATE_ATTACK
+        vel_x[start] = 0
+        charged = start & electric & (charge > 10)
+        np.copyto(attack_damage, 12 + np.trunc(charge / 20), where=charged)
+        charge[charged] -= 10
+        attack_damage[start & electric & ~charged] = 12
+        heated = start & fire
+        np.copyto(heat, np.minimum(100, heat + 15), where=heated)
+        np.copyto(attack_damage, 15 + np.trunc(heat / 20), where=heated)
+        overheated |= heated & (heat >= 100)
+        
+        # special attack
+        pressed = ((bits & INPUT_SPECIAL) != 0) & ~is_attacking
+        ready = ~(electric | fire) | (electric & (charge >= 50)) | (
+            fire & ~overheated & (heat >= 40) & (fireball_cooldown == 0))
+        start = pressed & ~is_blocking & (special_cooldown == 0) & ready
+        is_attacking |= start
+        np.copyto(attack_cooldown, duration * (3 / 2), where=start)
+        special_cooldown[start] = 120
+        state[start] = STATE_SPECIAL
+        vel_x[start] = 0
+        charge[start & electric] -= 50
+        heat[start & fire] -= 40
+        fireball_cooldown[start & fire] = 90
+        np.copyto(armor, 30, where=start & earth)
+        np.copyto(speed, speed * (4 / 5), where=start & earth)
+        
+        # update: physics
+        x_before = x.copy()
+        vel_y += GRAVITY
+        x += vel_x
+        y += vel_y
+        landed = y + height > FLOOR_HEIGHT
+        np.copyto(y, FLOOR_HEIGHT - height, where=landed)
+        vel_y[landed] = 0
+        is_jumping &= ~landed
+        x[x < 0] = 0
+        np.copyto(x, SCREEN_WIDTH - width, where=x + width > SCREEN_WIDTH)
+        
+        # cooldowns and combo timer
+        cooling = attack_cooldown > 0
+        attack_cooldown[cooling] -= 1
+        is_attacking &= ~(cooling & (attack_cooldown == 0))
+        special_cooldown[special_cooldown > 0] -= 1
+        hit_cooldown[hit_cooldown > 0] -= 1
+        timing = combo_timer > 0
+        combo_timer[timing] -= 1
+        combo_counter[~timing] = 0
+        
+        # animation
+        frame = f["frame"]
+        frame += 0.2
+        frame[frame >= 4] = 0
+        
+        # facing: slot 0 sees slot 1 before its update, slot 1 sees slot 0 after
+        both = active[0] & active[1]
+        centers = x + width / 2
+        np.copyto(facing_right[0], centers[0] < x_before[1] + width[1] / 2, where=both)
+        np.copyto(facing_right[1], centers[1] < centers[0], where=both)
+        
+        # per-character updates
+        dash_cooldown[ninja & (dash_cooldown > 0)] -= 1
+        has_double_jumped &= ~(ninja & ~is_jumping)
+        charging = electric & ~is_jumping & ~is_attacking
+        np.copyto(charge, np.minimum(100, charge + 0.2), where=charging)
+        cooling = fire & overheated
+        heat[cooling] -= 0.5
+        cooled = cooling & (heat <= 0)
+        heat[cooled] = 0
+        overheated &= ~cooled
+        fireball_cooldown[fire & (fireball_cooldown > 0)] -= 1
+        regenerating = earth & (armor < 30)
+        np.copyto(armor, np.minimum(30, armor + 0.1), where=regenerating)
+        
+        # hits, attacker slot 0 first
+        for attacker, victim in ((0, 1), (1, 0)):
+            # Ninja special teleports behind the target
+            teleport = both & ninja[attacker] & (state[attacker] == STATE_SPECIAL) & (
+                attack_cooldown[attacker] == np.trunc(duration[attacker] * 0.75))
+            teleport_x = x[victim] + width[victim] + 10
+            teleport_x = np.where(teleport_x + width[attacker] > SCREEN_WIDTH,
+                                  x[victim] - width[attacker] - 10, teleport_x)
+            np.copyto(x[attacker], teleport_x, where=teleport)
+            
+            special = state[attacker] == STATE_SPECIAL
+            fireball = fire[attacker] & special & (attack_cooldown[attacker] == np.trunc(duration[attacker] * 0.8))
+            reach = np.where(fireball, 150, self.constants["attack_range"][attacker])
+            attack_x = np.where(facing_right[attacker], x[attacker] + width[attacker], x[attacker] - reach)
+            hit = (both & is_attacking[attacker] & (attack_cooldown[attacker] > duration[attacker] / 2) &
+                   (attack_x < x[victim] + width[victim]) & (attack_x + reach > x[victim]) &
+                   (y[attacker] < y[victim] + height[victim]) & (y[attacker] + height[attacker] > y[victim]))
+            if not hit.any():
+                continue
+            
+            damage = np.where(special, attack_damage[attacker] * 2, attack_damage[attacker])
+            knockback = np.where(special, 10, 5)
+            combo = combo_counter[attacker]
+            damage = np.where(combo > 0, damage * (1 + combo * 0.1), damage)
+            
+            # Stone armor absorbs damage first, even while invincible
+            absorbing = hit & earth[victim] & (armor[victim] > 0)
+            absorbed = np.minimum(armor[victim], damage)
+            np.copyto(armor[victim], armor[victim] - absorbed, where=absorbing)
+            damage = np.where(absorbing, damage - absorbed, damage)
+            knockback = np.where(earth[victim], knockback * (7 / 10), knockback)
+            
+            taken = hit & (hit_cooldown[victim] == 0)
+            damage = np.where(is_blocking[victim], damage * (3 / 10), damage)
+            np.copyto(hp[victim], hp[victim] - damage, where=taken)
+            hit_cooldown[victim][taken] = 15
+            state[victim][taken] = STATE_HIT
+            np.copyto(vel_x[victim], knockback * np.where(facing_right[victim], -1, 1), where=taken)
+            combo_counter[attacker][taken] += 1
+            combo_timer[attacker][taken] = 90
+        
+        self.frames += 1
+
+# Checks MatchBatch against Match objects driven by the same CPU inputs, then
+# measures batch throughput
+def run_batch_benchmark(args):
+    global effect_scale
+    if np is None:
+        print("--batch-bench needs numpy")
+        return 1
+    effect_scale = 0
+    
+    pairs = [(a, b) for a in range(len(CHARACTERS)) for b in range(len(CHARACTERS))] * 4
+    batch = MatchBatch(pairs)
+    matches = [create_match([CHARACTERS[a][2], CHARACTERS[b][2]]) for a, b in pairs]
+    controllers = [(CpuController(2 * index), CpuController(2 * index + 1)) for index in range(len(pairs))]
+    mismatches = checked = 0
+    for _ in range(2000):
+        inputs = [[controller.control(fighter, match.target_of(fighter))
+                   for controller, fighter in zip(pair, match.fighters)]
+                  for pair, match in zip(controllers, matches)]
+        for match, match_inputs in zip(matches, inputs):
+            match.step(match_inputs)
+        batch.step(inputs)
+        for index, match in enumerate(matches):
+            for slot, fighter in enumerate(match.fighters):
+                checked += 1
+                if batch.fighter_state(index, slot) != fighter.get_state():
+                    mismatches += 1
+            if match.is_over():
+                matches[index] = create_match([type(fighter) for fighter in match.fighters])
+                batch.reset([index])
+    
+    count = args.batch_bench
+    rng = np.random.default_rng(1)
+    batch = MatchBatch(rng.integers(0, len(CHARACTERS), (count, 2)))
+    inputs = rng.integers(0, 1 << 7, (64, count, 2), dtype=np.uint8)
+    steps = max(1, 2_000_000 // count)
+    start = time.perf_counter()
+    for step in range(steps):
+        batch.step(inputs[step % len(inputs)])
+        if step % 64 == 63:
+            batch.reset(np.flatnonzero(batch.done()))
+    elapsed = time.perf_counter() - start
+    print(f"batch kernel: {mismatches} mismatched fighter states out of {checked} checked against Match")
+    print(f"  {count} matches x {steps} steps: {elapsed / steps * 1000:.2f} ms/step, "
+          f"{count * steps / elapsed / 1e6:.2f}M match-frames/s")
+    return 1 if mismatches else 0
+
+# Training pool: worker processes step slices of a MatchBatch and write each
+# fighter's observation, reward and done flag straight into shared-memory
+# arrays, so the learner reads whole batches with no copy or pickling. One
+# barrier wait hands the actions to the workers and a second one hands the
+# results back.
+OBSERVATION_FEATURES = (
+    "x", "y", "vel_x", "vel_y", "hp", "attack_cooldown", "special_cooldown", "hit_cooldown",
+    "combo_counter", "meter", "facing_right", "is_jumping", "is_attacking", "is_blocking", "character",
+    "opponent_dx", "opponent_dy", "opponent_hp", "opponent_attacking", "opponent_blocking",
+    "opponent_attack_cooldown",
+)
+# Scale of each character's meter: dash cooldown, charge, heat, stone armor
+METER_FIELDS = (("dash_cooldown", 45), ("charge_level", 100), ("heat_level", 100), ("stone_armor", 30))
+KO_REWARD = 1.0
+
+def write_observations(batch, out):
+    # out: (K, 2, len(OBSERVATION_FEATURES)) float32
+    f = batch.fields
+    width, height = batch.constants["width"], batch.constants["height"]
+    centers_x = f["x"] + width / 2
+    centers_y = f["y"] + height / 2
+    hp = f["hp"] / batch.constants["max_hp"]
+    meter = np.zeros_like(hp)
+    for kind, (name, scale) in enumerate(METER_FIELDS):
+        np.copyto(meter, f[name] / scale, where=batch.kinds[kind])
+    for slot in range(2):
+        other = 1 - slot
+        columns = (
+            f["x"][slot] / SCREEN_WIDTH, f["y"][slot] / SCREEN_HEIGHT, f["vel_x"][slot] / 15,
+            f["vel_y"][slot] / 15, hp[slot], f["attack_cooldown"][slot] / 30,
+            f["special_cooldown"][slot] / 120, f["hit_cooldown"][slot] / 15, f["combo_counter"][slot] / 10,
+            meter[slot], f["facing_right"][slot], f["is_jumping"][slot], f["is_attacking"][slot],
+            f["is_blocking"][slot], batch.characters[slot] / (len(CHARACTERS) - 1),
+            (centers_x[other] - centers_x[slot]) / SCREEN_WIDTH,
+            (centers_y[other] - centers_y[slot]) / SCREEN_HEIGHT, hp[other], f["is_attacking"][other],
+            f["is_blocking"][other], f["attack_cooldown"][other] / 30,
+        )
+        for feature, column in enumerate(columns):
+            out[:, slot, feature] = column
+
+class SharedArray:
+    # A NumPy array in a named shared-memory block
+    def __init__(self, shape, dtype, name=None):
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        self.memory = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+        self.spec = (shape, dtype, self.memory.name)
+        self.array = np.ndarray(shape, dtype=dtype, buffer=self.memory.buf)
+    
+    @classmethod
+    def attach(cls, spec):
+        shape, dtype, name = spec
+        return cls(shape, dtype, name)
+    
+    def close(self, unlink=False):
+        del self.array
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+def training_worker(specs, start, end, barrier, seed):
+    global effect_scale
+    effect_scale = 0
+    shared = {name: SharedArray.attach(spec) for name, spec in specs.items()}
+    observations, rewards, dones, actions, running = (
+        shared[name].array for name in ("observations", "rewards", "dones", "actions", "running"))
+    observations, rewards, dones, actions = (
+        array[start:end] for array in (observations, rewards, dones, actions))
+    rng = np.random.default_rng(seed)
+    batch = MatchBatch(rng.integers(0, len(CHARACTERS), (end - start, 2)))
+    write_observations(batch, observations)
+    try:
+        worker_loop(batch, barrier, observations, rewards, dones, actions, running)
+    except threading.BrokenBarrierError:
+        pass  # The learner gave up on the pool
+    for array in shared.values():
+        array.close()
+
+def worker_loop(batch, barrier, observations, rewards, dones, actions, running):
+    barrier.wait()
+    while True:
+        barrier.wait()  # actions written
+        if not running[0]:
+            break
+        hp = batch.fields["hp"].copy()
+        batch.step(actions)
+        lost = hp - batch.fields["hp"]
+        done = batch.done()
+        # Damage dealt minus damage taken, in units of 100 hp, and the KO
+        rewards[:, 0] = (lost[1] - lost[0]) / 100
+        rewards[:, 1] = (lost[0] - lost[1]) / 100
+        knocked_out = batch.fields["hp"] <= 0
+        rewards[:, 0] += KO_REWARD * (knocked_out[1].astype(np.float32) - knocked_out[0])
+        rewards[:, 1] += KO_REWARD * (knocked_out[0].astype(np.float32) - knocked_out[1])
+        dones[:] = done
+        if done.any():
+            batch.reset(np.flatnonzero(done))
+        write_observations(batch, observations)
+        barrier.wait()  # results written
+
+# Longest the learner waits on the workers before it checks whether they died
+TRAINING_TIMEOUT = 60.0
+
+class TrainingPool:
+    # count matches split over worker processes. observations, rewards and
+    # dones are views of shared memory, valid until the next step(); the
+    # observation after a done is the first one of the new match.
+    def __init__(self, count, workers=None, seed=0):
+        if np is None:
+            raise RuntimeError("the training pool needs numpy")
+        workers = max(1, min(count, workers or multiprocessing.cpu_count()))
+        self.shared = {
+            "observations": SharedArray((count, 2, len(OBSERVATION_FEATURES)), np.float32),
+            "rewards": SharedArray((count, 2), np.float32),
+            "dones": SharedArray((count,), np.bool_),
+            "actions": SharedArray((count, 2), np.uint8),
+            "running": SharedArray((1,), np.bool_),
+        }
+        self.observations, self.rewards, self.dones, self.actions = (
+            self.shared[name].array for name in ("observations", "rewards", "dones", "actions"))
+        self.shared["running"].array[0] = True
+        specs = {name: array.spec for name, array in self.shared.items()}
+        self.barrier = multiprocessing.Barrier(workers + 1)
+        bounds = [count * index // workers for index in range(workers + 1)]
+        self.workers = [multiprocessing.Process(target=training_worker,
+                                                args=(specs, bounds[index], bounds[index + 1], self.barrier,
+                                                      seed * 1000 + index), daemon=True)
+                        for index in range(workers)]
+        self.closed = False
+        for worker in self.workers:
+            worker.start()
+        self.wait()  # first observations written
+    
+    def wait(self):
+        try:
+            self.barrier.wait(TRAINING_TIMEOUT)
+        except threading.BrokenBarrierError:
+            dead = [f"worker {index} (exit code {worker.exitcode})"
+                    for index, worker in enumerate(self.workers) if not worker.is_alive()]
+            self.abort()
+            raise RuntimeError("training pool failed: " + (", ".join(dead) + " died" if dead else
+                               f"no answer from the workers in {TRAINING_TIMEOUT:g} s")) from None
+    
+    def step(self, actions=None):
+        # actions: (count, 2) input bitmasks, or None if already written to
+        # self.actions
+        if actions is not None:
+            self.actions[:] = actions
+        self.wait()
+        self.wait()
+        return self.observations, self.rewards, self.dones
+    
+    def abort(self):
+        # Breaks the barrier so surviving workers exit, and frees the memory
+        self.barrier.abort()
+        for worker in self.workers:
+            worker.join(1)
+            if worker.is_alive():
+                worker.terminate()
+        self.release()
+    
+    def release(self):
+        if not self.closed:
+            self.closed = True
+            for array in self.shared.values():
+                array.close(unlink=True)
+    
+    def close(self):
+        if self.closed:
+            return
+        self.shared["running"].array[0] = False
+        self.wait()
+        for worker in self.workers:
+            worker.join()
+        self.release()
+
+# Random actions through a TrainingPool, compared with what pickling the
+# same observations back from the workers would cost
+def run_pool_benchmark(args):
+    if np is None:
+        print("--pool-bench needs numpy")
+        return 1
+    pool = TrainingPool(args.pool_bench, args.workers)
+    rng = np.random.default_rng(1)
+    actions = rng.integers(0, 1 << 7, (64,) + pool.actions.shape, dtype=np.uint8)
+    steps = max(100, 200_000 // args.pool_bench)
+    episodes = 0
+    try:
+        start = time.perf_counter()
+        for step in range(steps):
+            observations, rewards, dones = pool.step(actions[step % len(actions)])
+            episodes += int(dones.sum())
+        elapsed = time.perf_counter() - start
+        payload = (observations, rewards, dones)
+        pickle_start = time.perf_counter()
+        for _ in range(20):
+            pickle.loads(pickle.dumps(payload, pickle.HIGHEST_PROTOCOL))
+        pickle_time = (time.perf_counter() - pickle_start) / 20
+    finally:
+        pool.close()
+    per_step = elapsed / steps
+    print(f"training pool: {args.pool_bench} matches on {len(pool.workers)} workers, {steps} steps, "
+          f"{episodes} matches finished")
+    print(f"  {per_step * 1000:.3f} ms/step, {args.pool_bench * steps / elapsed / 1e6:.2f}M match-frames/s, "
+          f"{observations.nbytes / 1024:.0f} KiB of observations per step shared without copying")
+    print(f"  pickling them per step instead would add {pickle_time * 1000:.3f} ms (one copy each way)")
+    return 0
+
+# Self-play training. CPU opponents learn a tabular Q-policy per character over
+# a small discretized state: distance to the opponent, own HP, attack and
+# special readiness, meter level and whether the opponent is attacking.
+# Experience comes from a TrainingPool (worker processes stepping batched
+# matches), both fighters of every match play the policy being learned, and
+# the learner folds each step's TD errors into the shared table. The greedy
+# action per state is what the game loads.
+POLICY_MAGIC = b"SFPL1\n"
+POLICY_DISTANCE_EDGES = (50, 80, 95, 105, 115, 130, 160, 250)  # Centre-to-centre distance, px
+POLICY_LEVEL_EDGES = (1 / 3, 2 / 3)          # HP and meter fractions
+POLICY_ACTIONS = ("idle", "move toward", "move away", "jump", "attack", "special attack", "block", "dash")
+POLICY_STATES = (len(POLICY_DISTANCE_EDGES) + 1) * (len(POLICY_LEVEL_EDGES) + 1) ** 2 * 2 * 2 * 2
+POLICY_ALPHA = 0.1
+POLICY_GAMMA = 0.99
+POLICY_EPSILON = 0.05  # Exploration left at the end of training
+POLICY_ROUNDS = 10     # Training rounds, each followed by an evaluation
+
+def policy_bits(action, toward, away):
+    return (0, toward, away, INPUT_JUMP, INPUT_ATTACK, INPUT_SPECIAL, INPUT_BLOCK, INPUT_DASH | toward)[action]
+
+# Input bits of each action with the opponent to the left / right
+POLICY_BITS = [(policy_bits(action, INPUT_LEFT, INPUT_RIGHT), policy_bits(action, INPUT_RIGHT, INPUT_LEFT))
+               for action in range(len(POLICY_ACTIONS))]
+
+def policy_state(distance, hp, attack_ready, special_ready, meter, opponent_attacking):
+    state = bisect.bisect_right(POLICY_DISTANCE_EDGES, distance)
+    state = state * (len(POLICY_LEVEL_EDGES) + 1) + bisect.bisect_right(POLICY_LEVEL_EDGES, hp)
+    state = state * (len(POLICY_LEVEL_EDGES) + 1) + bisect.bisect_right(POLICY_LEVEL_EDGES, meter)
+    return ((state * 2 + attack_ready) * 2 + special_ready) * 2 + opponent_attacking
+
+def policy_states(observations):
+    # policy_state() for a (K, 2, len(OBSERVATION_FEATURES)) observation batch
+    feature = {name: observations[..., index] for index, name in enumerate(OBSERVATION_FEATURES)}
+    state = np.searchsorted(POLICY_DISTANCE_EDGES, np.abs(feature["opponent_dx"]) * SCREEN_WIDTH, side="right")
+    state = state * (len(POLICY_LEVEL_EDGES) + 1) + np.searchsorted(POLICY_LEVEL_EDGES, feature["hp"], side="right")
+    state = state * (len(POLICY_LEVEL_EDGES) + 1) + np.searchsorted(POLICY_LEVEL_EDGES, feature["meter"], side="right")
+    state = (state * 2 + (feature["attack_cooldown"] == 0)) * 2 + (feature["special_cooldown"] == 0)
+    return state * 2 + (feature["opponent_attacking"] > 0)
+
+class Policy:
+    def __init__(self):
+        size = len(CHARACTERS) * POLICY_STATES
+        self.values = array("f", [0.0]) * (size * len(POLICY_ACTIONS))
+        self.greedy = bytes(size)
+    
+    def action(self, kind, state):
+        return self.greedy[kind * POLICY_STATES + state]
+    
+    def update_greedy(self):
+        count = len(POLICY_ACTIONS)
+        values = self.values
+        self.greedy = bytes(max(range(count), key=lambda action: values[cell * count + action])
+                            for cell in range(len(self.greedy)))
+    
+    def write(self, path):
+        header = {"characters": [name for name, _, _ in CHARACTERS], "states": POLICY_STATES,
+                  "actions": POLICY_ACTIONS}
+        with open(path, "wb") as out:
+            out.write(POLICY_MAGIC + json.dumps(header).encode() + b"\n")
+            out.write(self.greedy)
+            out.write(self.values.tobytes())
+    
+    @classmethod
+    def read(cls, path):
+        policy = cls()
+        with open(path, "rb") as data:
+            if data.readline() != POLICY_MAGIC:
+                raise ValueError(f"{path} is not a policy file")
+            header = json.loads(data.readline())
+            if (header["states"] != POLICY_STATES or len(header["characters"]) != len(CHARACTERS)
+                    or len(header["actions"]) != len(POLICY_ACTIONS)):
+                raise ValueError(f"{path} was trained for a different roster or state layout")
+            policy.greedy = data.read(len(policy.greedy))
+            policy.values = array("f", data.read(len(policy.values) * policy.values.itemsize))
+        return policy
+
+class PolicyController:
+    def __init__(self, policy):
+        self.policy = policy
+    
+    def control(self, fighter, target):
+        if target is None:
+            return 0
+        one = fighter.one
+        kind = CHARACTER_INDEX[type(fighter)]
+        dx = (target.x + target.width / 2) - (fighter.x + fighter.width / 2)
+        meter_name, meter_scale = METER_FIELDS[kind]
+        meter = getattr(fighter, meter_name) / meter_scale
+        if meter_name in fighter.scaled_fields:
+            meter /= one
+        state = policy_state(abs(dx) / one, fighter.hp / fighter.max_hp, fighter.attack_cooldown == 0,
+                             fighter.special_cooldown == 0, meter, target.is_attacking)
+        return POLICY_BITS[self.policy.action(kind, state)][dx > 0]
+
+class SelfPlayTrainer:
+    def __init__(self, policy, matches, workers=None, seed=0):
+        self.policy = policy
+        self.q = np.frombuffer(policy.values, dtype=np.float32).reshape(-1, len(POLICY_ACTIONS))
+        self.bits = np.array(POLICY_BITS, dtype=np.uint8)
+        self.rng = np.random.default_rng(seed)
+        self.pool = TrainingPool(matches, workers, seed)
+        self.episodes = 0
+        observations = self.pool.observations
+        character = OBSERVATION_FEATURES.index("character")
+        self.kinds = np.rint(observations[..., character] * (len(CHARACTERS) - 1)).astype(np.intp)
+        self.cells = self.kinds * POLICY_STATES + policy_states(observations)
+    
+    def train(self, steps, epsilon):
+        q, rng, pool = self.q, self.rng, self.pool
+        opponent_dx = OBSERVATION_FEATURES.index("opponent_dx")
+        observations, cells = pool.observations, self.cells
+        for _ in range(steps):
+            actions = q[cells].argmax(axis=-1)
+            explore = rng.random(actions.shape) < epsilon
+            actions[explore] = rng.integers(0, len(POLICY_ACTIONS), int(explore.sum()))
+            pool.actions[:] = self.bits[actions, (observations[..., opponent_dx] > 0).astype(np.intp)]
+            observations, rewards, dones = pool.step()
+            self.episodes += int(dones.sum())
+            next_cells = self.kinds * POLICY_STATES + policy_states(observations)
+            targets = rewards + POLICY_GAMMA * q[next_cells].max(axis=-1) * ~dones[:, None]
+            # Average the TD errors of every (state, action) visited this step
+            visited = (cells * len(POLICY_ACTIONS) + actions).ravel()
+            errors = targets.ravel() - q.reshape(-1)[visited]
+            totals = np.bincount(visited, errors, minlength=q.size)
+            counts = np.bincount(visited, minlength=q.size)
+            seen = counts > 0
+            q.reshape(-1)[seen] += POLICY_ALPHA * totals[seen] / counts[seen]
+            cells = next_cells
+        self.cells = cells
+        self.policy.update_greedy()
+    
+    def close(self):
+        self.pool.close()
+
+# Win rate of the policy against the scripted CPU in full (object) matches,
+# each pairing played from both sides
+def evaluate_policy(policy, rounds, seed=0):
+    global effect_scale, recorder
+    scale, effect_scale = effect_scale, 0
+    recording, recorder = recorder, None
+    rng = random.Random(seed)
+    wins = 0
+    for round_index in range(rounds):
+        classes = [rng.choice(CHARACTERS)[2] for _ in range(2)]
+        for side in range(2):
+            match = create_match(classes)
+            controllers = [CpuController(round_index), CpuController(round_index)]
+            controllers[side] = PolicyController(policy)
+            for _ in range(FPS * 99):
+                if match.is_over():
+                    break
+                match.step([controller.control(fighter, match.target_of(fighter))
+                            for controller, fighter in zip(controllers, match.fighters)])
+            wins += match.result()[0] is match.fighters[side]
+    effect_scale = scale
+    recorder = recording
+    return wins / (2 * rounds)
+
+def run_policy_training(args):
+    if np is None:
+        print("--train needs numpy")
+        return 1
+    path = args.train
+    try:
+        policy = Policy.read(path)
+        print(f"continuing from {path}")
+    except FileNotFoundError:
+        policy = Policy()
+    # Self-play drifts away from whatever beats other opponents, so the table
+    # is checkpointed after every round and the one that does best against
+    # the scripted CPU is kept
+    best_rate, best_values = evaluate_policy(policy, args.train_eval, seed=1), array("f", policy.values)
+    start_rate = best_rate
+    trainer = SelfPlayTrainer(policy, args.train_matches, args.workers)
+    steps = max(1, args.train_steps // POLICY_ROUNDS)
+    start = time.perf_counter()
+    try:
+        for round_index in range(POLICY_ROUNDS):
+            # Explore less over the first 80% of the rounds
+            trainer.train(steps, max(POLICY_EPSILON, 1 - round_index / (POLICY_ROUNDS * 0.8)))
+            rate = evaluate_policy(policy, args.train_eval, seed=1)
+            print(f"  round {round_index + 1}/{POLICY_ROUNDS}: {rate:.0%} against the scripted CPU")
+            if rate > best_rate:
+                best_rate, best_values = rate, array("f", policy.values)
+    finally:
+        trainer.close()
+    elapsed = time.perf_counter() - start
+    policy.values = best_values
+    policy.update_greedy()
+    policy.write(path)
+    start_load = time.perf_counter()
+    Policy.read(path)
+    load_time = time.perf_counter() - start_load
+    # Fresh pairings, so the kept checkpoint isn't scored on the matches it was picked by
+    final_rate = evaluate_policy(policy, args.train_eval, seed=2)
+    print(f"self-play: {args.train_matches} matches x {POLICY_ROUNDS * steps} steps in {elapsed:.1f} s, "
+          f"{trainer.episodes} matches finished")
+    print(f"  win rate against the scripted CPU: {start_rate:.0%} before, {final_rate:.0%} after "
+          f"({2 * args.train_eval} matches)")
+    print(f"  {len(CHARACTERS)} x {POLICY_STATES} states written to {path}, loads in {load_time * 1000:.2f} ms")
+    return 0
+
+# Pixel observations for vision-based agents. Observations are drawn straight
+# at observation size and in grayscale by a reduced pass: the background is
+# scaled and converted once, and each fighter is its atlas frame scaled to
+# observation size, converted and cached on first use, then copied through its
+# mask (no health bars, text or hitbox outlines). Frames are drawn straight
+# into the frame stacks. Each match's stack is a ring: the newest frame
+# overwrites the oldest at `head` instead of the stack being shifted.
+# Particles are not drawn, so effects should be off (effect_scale = 0).
+class PixelObserver:
+    def __init__(self, count, size=(84, 84), stack=4, theme="dojo"):
+        if np is None:
+            raise RuntimeError("pixel observations need numpy")
+        self.width, self.height = size
+        self.scale_x = self.width / SCREEN_WIDTH
+        self.scale_y = self.height / SCREEN_HEIGHT
+        self.stacks = np.zeros((count, stack, self.height, self.width), dtype=np.uint8)
+        self.head = stack - 1  # Slot of the newest frame in every stack
+        self.fresh = np.ones(count, dtype=bool)
+        scene = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT))
+        scene.fill(BLACK)
+        Background(theme).draw(scene)
+        self.scene = self.grayscale(pygame.transform.scale(scene, size))
+        # (atlas surface, cell x, cell y) -> (grayscale, mask) of the cell at observation size
+        self.sprites = {}
+        preload_atlases([fighter_class for _, _, fighter_class in CHARACTERS])
+    
+    def reset(self, matches):
+        # The next observation of these matches starts a new stack
+        self.fresh[matches] = True
+    
+    def grayscale(self, surface):
+        # ITU-R 601 luma in 8-bit fixed point, as a (height, width) array
+        rgb = pygame.surfarray.array3d(surface).transpose(1, 0, 2).astype(np.uint16)
+        return ((rgb[:, :, 0] * 77 + rgb[:, :, 1] * 150 + rgb[:, :, 2] * 29) >> 8).astype(np.uint8)
+    
+    def sprite(self, atlas_surface, area):
+        key = (atlas_surface, area.x, area.y)
+        sprite = self.sprites.get(key)
+        if sprite is None:
+            size = (max(1, round(area.width * self.scale_x)), max(1, round(area.height * self.scale_y)))
+            scaled = pygame.transform.scale(atlas_surface.subsurface(area), size)
+            # Atlas alpha is all or nothing
+            mask = pygame.surfarray.array_alpha(scaled).T > 127
+            sprite = self.sprites[key] = (self.grayscale(scaled), mask)
+        return sprite
+    
+    def render(self, fighters, out):
+        out[...] = self.scene
+        for fighter in fighters:
+            view = fighter.effects()
+            atlas_surface, area, offset_x, offset_y = FighterAtlas.for_fighter(view).lookup(view)
+            gray, mask = self.sprite(atlas_surface, area)
+            x = math.floor((view.x + offset_x) * self.scale_x)
+            y = math.floor((view.y + offset_y) * self.scale_y)
+            # Clip to the frame
+            left, top = max(x, 0), max(y, 0)
+            right, bottom = min(x + gray.shape[1], self.width), min(y + gray.shape[0], self.height)
+            if left < right and top < bottom:
+                np.copyto(out[top:bottom, left:right], gray[top - y:bottom - y, left - x:right - x],
+                          where=mask[top - y:bottom - y, left - x:right - x])
+    
+    def observe(self, fighter_lists):
+        # One list of fighters per match; returns the (count, stack, height,
+        # width) frame stacks in ring order, with the newest frame at head
+        stacks = self.stacks
+        self.head = head = (self.head + 1) % stacks.shape[1]
+        for index, fighters in enumerate(fighter_lists):
+            self.render(fighters, stacks[index, head])
+            if self.fresh[index]:
+                stacks[index] = stacks[index, head]
+                self.fresh[index] = False
+        return stacks
+    
+    def ordered(self, index):
+        # Copy of one match's stack, oldest frame first
+        return np.roll(self.stacks[index], -(self.head + 1), axis=0)
+
+# Pixel observation cost next to state steps. The run fails when observations
+# cost more than PIXEL_RATIO_LIMIT times the state vector, a ratio that holds
+# across machines where absolute times don't
+PIXEL_RATIO_LIMIT = 150
+
+def run_pixel_benchmark(args):
+    global effect_scale
+    if np is None:
+        print("--pixel-bench needs numpy")
+        return 1
+    effect_scale = 0
+    count = args.pixel_bench
+    rng = np.random.default_rng(1)
+    batch = MatchBatch(rng.integers(0, len(CHARACTERS), (count, 2)))
+    observer = PixelObserver(count)
+    observations = np.zeros((count, 2, len(OBSERVATION_FEATURES)), np.float32)
+    match = create_match([CHARACTERS[0][2], CHARACTERS[2][2]])
+    steps = 200
+    step_time = state_time = pixel_time = 0.0
+    for step in range(steps):
+        actions = rng.integers(0, 1 << 7, (count, 2), dtype=np.uint8)
+        start = time.perf_counter()
+        batch.step(actions)
+        done = batch.done()
+        if done.any():
+            batch.reset(np.flatnonzero(done))
+            observer.reset(done)
+        stepped = time.perf_counter()
+        write_observations(batch, observations)
+        stated = time.perf_counter()
+        stacks = observer.observe([batch.fighters(index) for index in range(count)])
+        observed = time.perf_counter()
+        step_time += stepped - start
+        state_time += stated - stepped
+        pixel_time += observed - stated
+    # Reference: the object simulation stepping one match
+    inputs = rng.integers(0, 1 << 7, (steps, 2)).tolist()
+    start = time.perf_counter()
+    for bits in inputs:
+        if match.is_over():
+            match = create_match([CHARACTERS[0][2], CHARACTERS[2][2]])
+        match.step(bits)
+    match_time = time.perf_counter() - start
+    per_match = lambda total: total / steps / count * 1e6
+    print(f"pixel observations: {count} matches, {steps} steps, stacks of {stacks.shape[1]} "
+          f"{observer.width}x{observer.height} frames")
+    print(f"  per match-frame: batch step {per_match(step_time):.1f} us, state vector {per_match(state_time):.1f} us, "
+          f"pixels {per_match(pixel_time):.1f} us; one Match.step {match_time / steps * 1e6:.1f} us")
+    ratio = pixel_time / state_time
+    print(f"  pixels cost {ratio:.0f}x the state vector (limit {PIXEL_RATIO_LIMIT}x) and "
+          f"{per_match(pixel_time) / (match_time / steps * 1e6):.1f}x a Match.step")
+    if args.pixel_dump:
+        # Last stack of the first match, frames side by side
+        strip = np.concatenate(list(observer.ordered(0)), axis=1)
+        pygame.image.save(pygame.surfarray.make_surface(np.repeat(strip.T[:, :, None], 3, axis=2)), args.pixel_dump)
+        print(f"  wrote {args.pixel_dump}")
+    if ratio > PIXEL_RATIO_LIMIT:
+        print(f"  pixel observations over the {PIXEL_RATIO_LIMIT}x limit")
+        return 1
+    return 0
+
+# Combat telemetry. Events go into a preallocated ring of typed columns as
+# they happen; full chunks are handed to a writer thread which compresses
+# them to JSONL (*.jsonl.gz) or a chunked columnar file (anything else).
+EVENT_HIT = 0
+EVENT_BLOCK = 1
+EVENT_COMBO = 2
+EVENT_OVERHEAT = 3
+EVENT_ARMOR_ABSORB = 4
+EVENT_TELEPORT = 5
+EVENT_KO = 6
+EVENT_NAMES = ("hit", "block", "combo", "overheat", "armor_absorb", "teleport", "ko")
+
+TELEMETRY_COLUMNS = (("match", "I"), ("frame", "I"), ("event", "B"), ("fighter", "B"),
+                     ("character", "B"), ("target", "B"), ("value", "d"))
+TELEMETRY_MAGIC = b"SFTL1\n"
+NO_TARGET = 255
+
+telemetry = None
+
+class TelemetryWriter(threading.Thread):
+    def __init__(self, path):
+        super().__init__(name="telemetry-writer", daemon=True)
+        self.path = path
+        self.jsonl = ".jsonl" in path
+        self.chunks = queue.Queue()
+        self.events_written = 0
+    
+    def run(self):
+        with gzip.open(self.path, "wt" if self.jsonl else "wb", compresslevel=3) as out:
+            if not self.jsonl:
+                out.write(TELEMETRY_MAGIC)
+                out.write(json.dumps([list(column) for column in TELEMETRY_COLUMNS]).encode() + b"\n")
+            while True:
+                chunk = self.chunks.get()
+                if chunk is None:
+                    return
+                self.write(out, chunk)
+                self.events_written += len(chunk[0])
+    
+    def write(self, out, chunk):
+        if self.jsonl:
+            names = [name for name, _ in TELEMETRY_COLUMNS]
+            for row in zip(*chunk):
+                event = dict(zip(names, row))
+                event["event"] = EVENT_NAMES[event["event"]]
+                event["character"] = CHARACTERS[event["character"]][0]
+                if event["target"] == NO_TARGET:
+                    event["target"] = None
+                out.write(json.dumps(event) + "\n")
+        else:
+            out.write(struct.pack("<I", len(chunk[0])))
+            for column in chunk:
+                out.write(column.tobytes())
+
+class TelemetryBus:
+    def __init__(self, path, capacity=1 << 16, flush_every=1 << 12):
+        self.capacity = capacity
+        self.flush_every = flush_every
+        self.columns = [array(code, [0]) * capacity for _, code in TELEMETRY_COLUMNS]
+        (self.match_column, self.frame_column, self.event_column, self.fighter_column,
+         self.character_column, self.target_column, self.value_column) = self.columns
+        self.head = 0
+        self.flushed = 0
+        self.dropped = 0
+        self.matches = 0
+        self.match = 0
+        self.frame = 0
+        self.writer = TelemetryWriter(path)
+        self.writer.start()
+    
+    def new_match(self):
+        self.matches += 1
+        return self.matches
+    
+    def begin_frame(self, match, frame):
+        self.match = match
+        self.frame = frame
+    
+    def emit(self, event, fighter, target=None, value=0.0):
+        self.record(self.match, self.frame, event, fighter.slot, CHARACTER_INDEX[type(fighter)],
+                    NO_TARGET if target is None else target.slot, value)
+    
+    def record(self, match, frame, event, fighter, character, target, value):
+        index = self.head % self.capacity
+        self.match_column[index] = match
+        self.frame_column[index] = frame
+        self.event_column[index] = event
+        self.fighter_column[index] = fighter
+        self.character_column[index] = character
+        self.target_column[index] = target
+        self.value_column[index] = value
+        self.head += 1
+        if self.head - self.flushed > self.capacity:
+            # Writer fell a whole ring behind; oldest event is overwritten
+            self.flushed += 1
+            self.dropped += 1
+    
+    def end_frame(self):
+        if self.head - self.flushed >= self.flush_every:
+            self.flush()
+    
+    def flush(self):
+        start, end = self.flushed % self.capacity, self.head % self.capacity
+        if self.head == self.flushed:
+            return
+        if start < end:
+            chunk = [column[start:end] for column in self.columns]
+        else:
+            chunk = [column[start:] + column[:end] for column in self.columns]
+        self.flushed = self.head
+        self.writer.chunks.put(chunk)
+    
+    def close(self):
+        self.flush()
+        self.writer.chunks.put(None)
+        self.writer.join()
+
+# Stands in for the bus while a rollback session simulates. Events wait per
+# frame until the session confirms the frame; resimulating a frame replaces
+# its events, so hits from mispredicted inputs never reach the stream.
+class TelemetryStage:
+    def __init__(self, bus):
+        self.bus = bus
+        self.frames = {}
+        self.events = []
+        self.match = 0
+        self.frame = 0
+    
+    def begin_frame(self, match, frame):
+        self.match = match
+        self.frame = frame
+        self.events = self.frames[frame] = []
+    
+    def emit(self, event, fighter, target=None, value=0.0):
+        self.events.append((self.match, self.frame, event, fighter.slot, CHARACTER_INDEX[type(fighter)],
+                            NO_TARGET if target is None else target.slot, value))
+    
+    def end_frame(self):
+        pass
+    
+    def confirm(self, frame):
+        for row in self.frames.pop(frame, ()):
+            self.bus.record(*row)
+        self.bus.end_frame()
+
+def start_telemetry(path):
+    global telemetry
+    if path:
+        telemetry = TelemetryBus(path)
+
+def stop_telemetry():
+    global telemetry
+    if telemetry:
+        telemetry.close()
+        print(f"[telemetry] {telemetry.writer.events_written} events written to {telemetry.writer.path}"
+              + (f", {telemetry.dropped} dropped" if telemetry.dropped else ""))
+        telemetry = None
+
+def read_telemetry(path):
+    # Yields chunks as lists of columns, for either file format
+    names = [name for name, _ in TELEMETRY_COLUMNS]
+    with gzip.open(path, "rb") as source:
+        if source.read(len(TELEMETRY_MAGIC)) != TELEMETRY_MAGIC:
+            source.seek(0)
+            columns = [array(code) for _, code in TELEMETRY_COLUMNS]
+            for line in source:
+                event = json.loads(line)
+                event["event"] = EVENT_NAMES.index(event["event"])
+                event["character"] = next(i for i, (name, _, _) in enumerate(CHARACTERS) if name == event["character"])
+                if event["target"] is None:
+                    event["target"] = NO_TARGET
+                for column, name in zip(columns, names):
+                    column.append(event[name])
+            yield columns
+            return
+        source.readline()
+        while True:
+            header = source.read(4)
+            if not header:
+                return
+            count, = struct.unpack("<I", header)
+            chunk = []
+            for _, code in TELEMETRY_COLUMNS:
+                column = array(code)
+                column.frombytes(source.read(column.itemsize * count))
+                chunk.append(column)
+            yield chunk
+
+def summarize_telemetry(paths):
+    counts = {}
+    totals = {}
+    matches = set()
+    events = 0
+    for path in paths:
+        for match, frame, event, fighter, character, target, value in read_telemetry(path):
+            events += len(event)
+            matches.update(match)
+            for kind, who, amount in zip(event, character, value):
+                key = (kind, who)
+                counts[key] = counts.get(key, 0) + 1
+                totals[key] = totals.get(key, 0) + amount
+    print(f"{events} events from {len(matches)} matches")
+    for kind, name in enumerate(EVENT_NAMES):
+        for who, (character_name, _, _) in enumerate(CHARACTERS):
+            if (kind, who) in counts:
+                count = counts[(kind, who)]
+                print(f"  {name:13s} {character_name:13s} {count:9d}   avg value {totals[(kind, who)] / count:8.2f}")
+    return 0
+
+# Memory instrumentation. tracemalloc sees Python allocations only; surfaces
+# are SDL memory, so the surface caches are counted by their pixel bytes.
+memory = None
+
+def surface_bytes(surface):
+    return surface.get_width() * surface.get_height() * surface.get_bytesize()
+
+def memory_counters(fighters=()):
+    # Per-subsystem (items, bytes)
+    particles = [particle for fighter in fighters for particle in fighter.particles]
+    atlas_surfaces = [surface for atlas in FighterAtlas.atlases.values() for surface in atlas.surfaces.values()]
+    counters = {
+        "particles": (len(particles), sum(map(sys.getsizeof, particles))),
+        "particle sprites": (len(particle_sprites), sum(map(surface_bytes, particle_sprites.values()))),
+        "text cache": (len(text_cache), sum(map(surface_bytes, text_cache.values()))),
+        "atlases": (len(atlas_surfaces), sum(map(surface_bytes, atlas_surfaces))),
+    }
+    if telemetry:
+        counters["telemetry ring"] = (telemetry.capacity,
+                                      sum(column.itemsize * len(column) for column in telemetry.columns))
+    if recorder:
+        counters["replay buffers"] = (len(recorder.replays), sum(replay.size() for replay in recorder.replays))
+    return counters
+
+MEMORY_FRAME_WINDOW = 3600  # Frames kept for the per-frame percentile (a minute at 60 FPS)
+
+class MemoryMonitor:
+    def __init__(self):
+        # Bytes allocated above each frame's starting level, in a ring allocated
+        # before tracing starts so the monitor's own bookkeeping doesn't grow
+        self.frame_allocations = array("I", [0]) * MEMORY_FRAME_WINDOW
+        self.frames = 0
+        self.frame_total = 0
+        tracemalloc.start()
+        self.baseline = tracemalloc.take_snapshot()
+        self.match_peaks = []  # peak traced bytes above each match's starting level
+        self.match_start = tracemalloc.get_traced_memory()[0]
+        self.match_peak = 0
+        self.frame_start = 0
+        self.counter_peaks = {}
+    
+    def begin_frame(self):
+        tracemalloc.reset_peak()
+        self.frame_start = tracemalloc.get_traced_memory()[0]
+    
+    def end_frame(self):
+        current, peak = tracemalloc.get_traced_memory()
+        allocated = peak - self.frame_start
+        self.frame_allocations[self.frames % MEMORY_FRAME_WINDOW] = allocated
+        self.frames += 1
+        self.frame_total += allocated
+        self.match_peak = max(self.match_peak, peak - self.match_start)
+    
+    def end_match(self, fighters):
+        self.match_peaks.append(self.match_peak)
+        for name, (items, size) in memory_counters(fighters).items():
+            peak_items, peak_size = self.counter_peaks.get(name, (0, 0))
+            self.counter_peaks[name] = (max(items, peak_items), max(size, peak_size))
+    
+    def start_match(self):
+        self.match_start = tracemalloc.get_traced_memory()[0]
+        self.match_peak = 0
+    
+    def frame_percentile(self, fraction):
+        # Over the last MEMORY_FRAME_WINDOW frames
+        allocations = sorted(self.frame_allocations[:min(self.frames, MEMORY_FRAME_WINDOW)])
+        return allocations[min(len(allocations) - 1, int(len(allocations) * fraction))] if allocations else 0
+    
+    def report(self, top=5):
+        current, peak = tracemalloc.get_traced_memory()
+        print(f"[memory] traced {current / 1024:.0f} KiB, peak {peak / 1024:.0f} KiB over "
+              f"{self.frames} frames and {len(self.match_peaks)} matches")
+        if self.frames:
+            print(f"  per-frame allocations avg {self.frame_total / self.frames / 1024:.1f} KiB, "
+                  f"p99 {self.frame_percentile(0.99) / 1024:.1f} KiB (last {min(self.frames, MEMORY_FRAME_WINDOW)} frames)")
+        if self.match_peaks:
+            print(f"  per-match peak avg {sum(self.match_peaks) / len(self.match_peaks) / 1024:.0f} KiB, "
+                  f"max {max(self.match_peaks) / 1024:.0f} KiB")
+        for name, (items, size) in self.counter_peaks.items():
+            print(f"  {name:<16} peak {items:>6} items {size / 1024:>9.1f} KiB")
+        # Where traced memory grew since the monitor started
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        for difference in snapshot.compare_to(self.baseline, "lineno")[:top]:
+            if difference.size_diff > 0:
+                frame = difference.traceback[0]
+                print(f"  +{difference.size_diff / 1024:.1f} KiB in {difference.count_diff:+} blocks "
+                      f"at {frame.filename.rsplit('/', 1)[-1]}:{frame.lineno}")
+    
+    def over_budget(self, peak_budget, frame_budget):
+        # Budgets in bytes, 0 for none; returns the exceeded budgets as messages
+        failures = []
+        peak = max(self.match_peaks, default=self.match_peak)
+        if peak_budget and peak > peak_budget:
+            failures.append(f"match peak {peak / 1024:.0f} KiB over budget {peak_budget / 1024:.0f} KiB")
+        p99 = self.frame_percentile(0.99)
+        if frame_budget and p99 > frame_budget:
+            failures.append(f"p99 frame allocations {p99 / 1024:.1f} KiB over budget {frame_budget / 1024:.1f} KiB")
+        return failures
+
+def start_memory_monitor(enabled):
+    global memory
+    if enabled:
+        memory = MemoryMonitor()
+
+def stop_memory_monitor():
+    global memory
+    if memory:
+        memory.report()
+        tracemalloc.stop()
+        memory = None
+
+# State hashing for desync detection. A frame's hash is the CRC-32 of every
+# fighter's gameplay state packed with its wire layout (floats widened to
+# doubles so no difference is rounded away), chained fighter to fighter.
+class StateHasher:
+    def __init__(self, fighters):
+        self.layouts = [struct.Struct("<" + "".join("d" if code == "f" else code for _, code in fighter.state_fields))
+                        for fighter in fighters]
+        self.names = [[name for name, _ in fighter.state_fields] for fighter in fighters]
+        self.size = sum(layout.size for layout in self.layouts)
+    
+    def checksum(self, states):
+        crc = 0
+        for layout, state in zip(self.layouts, states):
+            crc = zlib.crc32(layout.pack(*state), crc)
+        return crc
+    
+    def pack(self, states):
+        return b"".join(layout.pack(*state) for layout, state in zip(self.layouts, states))
+    
+    def unpack(self, packed):
+        states, offset = [], 0
+        for layout in self.layouts:
+            states.append(layout.unpack_from(packed, offset))
+            offset += layout.size
+        return states
+    
+    def difference(self, packed, other):
+        # First differing (slot, field name, value, other value), or None
+        for slot, (state, other_state) in enumerate(zip(self.unpack(packed), self.unpack(other))):
+            for name, value, other_value in zip(self.names[slot], state, other_state):
+                if value != other_value:
+                    return slot, name, value, other_value
+        return None
+
+# Replays: per frame, the inputs, the state hash and the packed state, so a
+# re-simulation can be checked frame by frame and a divergence traced to a
+# field. Matches are recorded while --record is on and written when over.
+REPLAY_MAGIC = b"SFRP1\n"
+recorder = None
+
+class Replay:
+    def __init__(self, characters, teams, fixed, initial, stage_width=SCREEN_WIDTH):
+        self.characters = characters
+        self.teams = teams
+        self.fixed = fixed
+        self.stage_width = stage_width
+        self.hasher = StateHasher([fixed_class(CHARACTERS[character][2]) if fixed else CHARACTERS[character][2]
+                                   for character in characters])
+        self.inputs = bytearray()
+        self.hashes = array("I")
+        self.states = bytearray(initial)  # initial state, then the state after each frame
+        self.first_frame = None  # match frame number of replay frame 0
+    
+    @classmethod
+    def of_match(cls, match):
+        fighters = match.fighters
+        characters = [CHARACTER_INDEX[type(fighter)] for fighter in fighters]
+        return cls(characters, match.teams, fighters[0].one != 1,
+                   match.hasher.pack([fighter.get_state() for fighter in fighters]), fighters[0].stage_width)
+    
+    def frames(self):
+        return len(self.hashes)
+    
+    def size(self):
+        return len(self.inputs) + len(self.hashes) * self.hashes.itemsize + len(self.states)
+    
+    def record(self, frame, inputs, packed):
+        if self.first_frame is None:
+            self.first_frame = frame
+        frame -= self.first_frame
+        if frame < len(self.hashes):
+            # Rolled back; the frames from here on are being replayed
+            del self.inputs[frame * len(self.characters):]
+            del self.hashes[frame:]
+            del self.states[(frame + 1) * self.hasher.size:]
+        self.inputs.extend(inputs)
+        self.hashes.append(zlib.crc32(packed))
+        self.states.extend(packed)
+    
+    def frame_inputs(self, frame):
+        count = len(self.characters)
+        return list(self.inputs[frame * count:(frame + 1) * count])
+    
+    def state_after(self, frame):
+        # Packed state after `frame` (-1 for the initial state)
+        start = (frame + 1) * self.hasher.size
+        return bytes(self.states[start:start + self.hasher.size])
+    
+    def new_match(self):
+        match = create_match([CHARACTERS[character][2] for character in self.characters], fixed=self.fixed,
+                             width=self.stage_width)
+        match.teams = self.teams
+        match.load_state((0, self.hasher.unpack(self.state_after(-1))))
+        return match
+    
+    def write(self, out):
+        header = {"characters": self.characters, "teams": self.teams, "fixed": self.fixed,
+                  "stage_width": self.stage_width, "frames": self.frames()}
+        out.write(json.dumps(header).encode() + b"\n")
+        out.write(self.inputs)
+        out.write(self.hashes.tobytes())
+        out.write(self.states)
+
+class ReplayRecorder:
+    def __init__(self, path):
+        self.path = path
+        # No timestamp in the header, so the same matches give the same file
+        self.out = gzip.GzipFile(path, "wb", mtime=0)
+        self.out.write(REPLAY_MAGIC)
+        self.replays = []
+        self.written = 0
+    
+    def start(self, match):
+        replay = Replay.of_match(match)
+        self.replays.append(replay)
+        return replay
+    
+    def finish(self, replay):
+        self.replays.remove(replay)
+        if replay.frames():
+            replay.write(self.out)
+            self.written += 1
+    
+    def close(self):
+        # Matches still in progress are saved as they are
+        for replay in list(self.replays):
+            self.finish(replay)
+        self.out.close()
+
+def start_recording(path):
+    global recorder
+    if path:
+        recorder = ReplayRecorder(path)
+
+def stop_recording():
+    global recorder
+    if recorder:
+        recorder.close()
+        print(f"[replay] {recorder.written} matches written to {recorder.path}")
+        recorder = None
+
+def read_replays(path):
+    with gzip.open(path, "rb") as replay_file:
+        if replay_file.readline() != REPLAY_MAGIC:
+            raise ValueError(f"{path} is not a replay file")
+        for line in replay_file:
+            header = json.loads(line)
+            replay = Replay(header["characters"], header["teams"], header["fixed"], b"",
+                            header.get("stage_width", SCREEN_WIDTH))
+            frames = header["frames"]
+            replay.inputs = bytearray(replay_file.read(frames * len(replay.characters)))
+            replay.hashes.frombytes(replay_file.read(frames * replay.hashes.itemsize))
+            replay.states = bytearray(replay_file.read((frames + 1) * replay.hasher.size))
+            yield replay
+
+def verify_replay(replay):
+    # Re-simulates the replay; returns (frame, slot, field, recorded, now) for
+    # the first frame whose hash differs, or None, and the hashing time
+    match = replay.new_match()
+    match.replay = None
+    hash_time = 0.0
+    last = replay.frames() - 1
+    for frame in range(replay.frames()):
+        match.step(replay.frame_inputs(frame))
+        start = time.perf_counter()
+        crc = match.state_hash()
+        hash_time += time.perf_counter() - start
+        if crc != replay.hashes[frame] or frame == last:
+            # Any frame whose hash differs, and the final state byte for byte
+            packed = match.hasher.pack([fighter.get_state() for fighter in match.fighters])
+            if crc != replay.hashes[frame] or packed != replay.state_after(frame):
+                return (frame,) + (match.hasher.difference(replay.state_after(frame), packed) or (None, None, None, None)), hash_time
+    return None, hash_time
+
+def run_verify_replays(args):
+    global effect_scale
+    effect_scale = 0
+    matches = frames = failures = 0
+    hash_time = 0.0
+    for path in args.verify_replay:
+        for replay in read_replays(path):
+            divergence, elapsed = verify_replay(replay)
+            matches += 1
+            frames += replay.frames()
+            hash_time += elapsed
+            if divergence:
+                failures += 1
+                frame, slot, field, recorded, now = divergence
+                names = " vs ".join(CHARACTERS[character][0] for character in replay.characters)
+                print(f"{path} match {matches} ({names}): diverged at frame {frame}, "
+                      f"P{slot + 1} {field} recorded {recorded!r}, replayed {now!r}" if field else
+                      f"{path} match {matches} ({names}): hash differs at frame {frame}")
+    per_frame = hash_time / max(1, frames)
+    print(f"{matches} replays, {frames} frames, {failures} diverged; "
+          f"hashing {per_frame * 1e6:.1f} us/frame ({per_frame * FPS:.3%} of a frame)")
+    return 1 if failures else 0
+
+# Golden-replay corpus: seeded CPU matches for every character pairing, in
+# floating and fixed point, on the screen-wide and a wide stage, plus the
+# 2v2 and free-for-all modes. Stage themes only change drawing, so they are
+# not part of it. The corpus and the throughput baseline are committed under
+# golden/; the runner re-simulates each replay headless, reports the first
+# frame whose state differs, and times the simulation against the baseline.
+# They are only rewritten by --golden-build, on purpose. Throughput is kept
+# in frames per run of a fixed calibration loop timed in the same run, so the
+# baseline carries over between machines. Timings on a shared machine still
+# swing by tens of percent, so throughput is reported, and only divergences,
+# missing replays or missing baselines fail the run.
+GOLDEN_CORPUS = "golden/corpus.replay"
+GOLDEN_BASELINE = "golden/baseline.json"
+GOLDEN_FRAMES = 1800                           # Longest match recorded (30 s)
+GOLDEN_WIDTHS = (SCREEN_WIDTH, 2 * SCREEN_WIDTH)
+GOLDEN_REPEATS = 5                             # Timing passes per replay; the fastest counts
+GOLDEN_CALIBRATION_STEPS = 5000
+
+def golden_matches():
+    classes = [fighter_class for _, _, fighter_class in CHARACTERS]
+    for fixed in (False, True):
+        for width in GOLDEN_WIDTHS:
+            for first in classes:
+                for second in classes:
+                    yield [first, second], "versus", fixed, width
+        for mode in MATCH_MODES[1:]:
+            yield classes, mode, fixed, SCREEN_WIDTH
+
+def golden_label(characters, mode, fixed, width):
+    label = " vs ".join(CHARACTERS[character][0] for character in characters)
+    if mode != "versus":
+        label += f" ({mode})"
+    if fixed:
+        label += ", fixed"
+    if width != SCREEN_WIDTH:
+        label += f", {width} px"
+    return label
+
+def replay_label(replay):
+    if len(replay.characters) == 2:
+        mode = "versus"
+    else:
+        mode = "ffa" if len(set(replay.teams)) == len(replay.teams) else "2v2"
+    return golden_label(replay.characters, mode, replay.fixed, replay.stage_width)
+
+# Seconds to re-simulate the replay (no hashing), fastest of GOLDEN_REPEATS
+def time_replay(replay):
+    inputs = [replay.frame_inputs(frame) for frame in range(replay.frames())]
+    best = math.inf
+    for _ in range(GOLDEN_REPEATS):
+        match = replay.new_match()
+        match.replay = None
+        # No collection pauses inside the timed loop
+        gc.disable()
+        start = time.perf_counter()
+        for frame_inputs in inputs:
+            match.step(frame_inputs)
+        best = min(best, time.perf_counter() - start)
+        gc.enable()
+    return best
+
+# Seconds for a fixed pure-Python workload (attribute updates, float math and
+# branches, like a simulation step) that doesn't depend on the game code
+class CalibrationBody:
+    def __init__(self):
+        self.x = self.vel_x = self.cooldown = 0.0
+
+def time_calibration():
+    best = math.inf
+    for _ in range(GOLDEN_REPEATS):
+        bodies = [CalibrationBody() for _ in range(4)]
+        start = time.perf_counter()
+        for step in range(GOLDEN_CALIBRATION_STEPS):
+            for body in bodies:
+                body.vel_x = (body.vel_x + 0.6) * 0.95
+                body.x += body.vel_x
+                if body.x > SCREEN_WIDTH:
+                    body.x -= SCREEN_WIDTH
+                body.cooldown = max(0.0, body.cooldown - 1) if step % 7 else 20.0
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def run_golden_build(args):
+    global effect_scale, recorder
+    effect_scale = 0
+    os.makedirs(os.path.dirname(GOLDEN_CORPUS), exist_ok=True)
+    recorder = ReplayRecorder(GOLDEN_CORPUS)
+    for seed, (fighter_classes, mode, fixed, width) in enumerate(golden_matches()):
+        match = create_match(fighter_classes, mode, fixed, width)
+        controllers = [CpuController(seed * len(fighter_classes) + slot) for slot in range(len(fighter_classes))]
+        while not match.is_over() and match.frame < GOLDEN_FRAMES:
+            match.step([controller.control(fighter, match.target_of(fighter))
+                        for controller, fighter in zip(controllers, match.fighters)])
+        if match.replay:
+            # Stopped at GOLDEN_FRAMES without a knockout
+            recorder.finish(match.replay)
+            match.replay = None
+    stop_recording()
+    # Load only ever slows a run down, so the fastest calibration taken
+    # between the replays is the machine's speed
+    calibration, seconds = math.inf, {}
+    for replay in read_replays(GOLDEN_CORPUS):
+        calibration = min(calibration, time_calibration())
+        seconds[replay_label(replay)] = replay.frames(), time_replay(replay)
+    rates = {label: frames / elapsed * calibration for label, (frames, elapsed) in seconds.items()}
+    with open(GOLDEN_BASELINE, "w") as baseline_file:
+        json.dump({"unit": "frames per calibration run", "replays": rates}, baseline_file, indent=1)
+        baseline_file.write("\n")
+    print(f"throughput baseline written to {GOLDEN_BASELINE}")
+    return 0
+
+def run_golden(args):
+    global effect_scale
+    effect_scale = 0
+    try:
+        replays = list(read_replays(GOLDEN_CORPUS))
+        with open(GOLDEN_BASELINE) as baseline_file:
+            baseline = json.load(baseline_file)["replays"]
+    except FileNotFoundError as error:
+        print(f"golden corpus incomplete: {error.filename} is missing (record it with --golden-build)")
+        return 1
+    expected = {golden_label([CHARACTER_INDEX[fighter_class] for fighter_class in fighter_classes], mode, fixed, width)
+                for fighter_classes, mode, fixed, width in golden_matches()}
+    calibration = math.inf
+    failures = frames = 0
+    results = []
+    for replay in replays:
+        label = replay_label(replay)
+        expected.discard(label)
+        divergence, _ = verify_replay(replay)
+        calibration = min(calibration, time_calibration())
+        results.append((label, replay.frames(), time_replay(replay), divergence))
+    # Compared once the fastest calibration of the run is known
+    elapsed = baseline_elapsed = 0.0
+    for label, replay_frames, seconds, divergence in results:
+        rate = replay_frames / seconds
+        frames += replay_frames
+        elapsed += seconds
+        line = f"{label:<44} {replay_frames:5d} frames {rate:9.0f} frames/s"
+        if label in baseline:
+            line += f"  {rate * calibration / baseline[label]:5.2f}x baseline"
+            baseline_elapsed += replay_frames * calibration / baseline[label]
+        else:
+            failures += 1
+            line += "  NO BASELINE"
+        if divergence:
+            failures += 1
+            frame, slot, field, recorded, now = divergence
+            line += (f"  DIVERGED at frame {frame}: P{slot + 1} {field} recorded {recorded!r}, replayed {now!r}"
+                     if field else f"  DIVERGED at frame {frame}")
+        print(line)
+    for label in sorted(expected):
+        failures += 1
+        print(f"{label:<44} MISSING from {GOLDEN_CORPUS}")
+    print(f"{len(replays)} replays, {frames} frames, {failures} failures; {frames / max(elapsed, 1e-9):.0f} frames/s overall")
+    speed = baseline_elapsed / max(elapsed, 1e-9)
+    print(f"throughput {speed:.2f}x the baseline, calibrated by a {calibration * 1000:.1f} ms loop")
+    return 1 if failures else 0
+
+# Network versus over UDP. The host runs the only simulation; the client
+# sends its input bitmask every frame and gets back state deltas against the
+# last frame it acknowledged, so only fields that changed are sent.
+PACKET_HELLO = 0
+PACKET_WELCOME = 1
+PACKET_INPUT = 2
+PACKET_STATE = 3
+NO_BASELINE = 0xFFFFFFFF
+SNAPSHOT_HISTORY = 64
+MAX_PACKET_SIZE = 1400
+
+HELLO_FORMAT = struct.Struct("<BB")            # kind, character
+WELCOME_FORMAT = struct.Struct("<BBBB")        # kind, host character, client character, theme
+INPUT_FORMAT = struct.Struct("<BIIB")          # kind, sequence, acknowledged frame, input bits
+STATE_HEADER = struct.Struct("<BII")           # kind, frame, baseline frame
+FIELD_MASK = struct.Struct("<I")
+
+# Drops and delays outgoing packets so the netcode can be exercised over
+# localhost. Wraps a non-blocking UDP socket.
+class LossyLink:
+    def __init__(self, sock, loss=0.0, delay=0.0, jitter=0.0, seed=None, clock=time.monotonic):
+        self.sock = sock
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+        self.clock = clock
+        self.queue = []
+        self.sequence = 0
+        self.bytes_sent = 0
+        self.packets_sent = 0
+        self.packets_dropped = 0
+    
+    def sendto(self, data, address):
+        self.bytes_sent += len(data)
+        self.packets_sent += 1
+        if self.loss and self.rng.random() < self.loss:
+            self.packets_dropped += 1
+            return
+        if not self.delay and not self.jitter:
+            self.sock.sendto(data, address)
+            return
+        due = self.clock() + self.delay + self.rng.uniform(0, self.jitter)
+        self.sequence += 1
+        heapq.heappush(self.queue, (due, self.sequence, data, address))
+        self.flush()
+    
+    def flush(self):
+        now = self.clock()
+        while self.queue and self.queue[0][0] <= now:
+            _, _, data, address = heapq.heappop(self.queue)
+            self.sock.sendto(data, address)
+    
+    def receive(self):
+        # All packets waiting on the socket as (data, address)
+        self.flush()
+        packets = []
+        while True:
+            try:
+                packets.append(self.sock.recvfrom(MAX_PACKET_SIZE))
+            except (BlockingIOError, InterruptedError):
+                return packets
+            except ConnectionResetError:
+                # ICMP port unreachable on some platforms; the peer isn't up yet
+                continue
+
+def open_udp_socket(address):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(address)
+    sock.setblocking(False)
+    return sock
+
+# Packs fighter states into the wire format and computes/applies deltas
+class StateCodec:
+    def __init__(self, fighters):
+        self.codes = [[code for _, code in fighter.state_fields] for fighter in fighters]
+        self.full = [struct.Struct("<" + "".join(codes)) for codes in self.codes]
+    
+    def snapshot(self, fighters):
+        # States rounded through the wire format, exactly as the client sees them
+        return [full.unpack(full.pack(*fighter.get_state())) for full, fighter in zip(self.full, fighters)]
+    
+    def encode(self, frame, baseline_frame, baseline, snapshot):
+        parts = [STATE_HEADER.pack(PACKET_STATE, frame, baseline_frame)]
+        for index, state in enumerate(snapshot):
+            codes = self.codes[index]
+            if baseline is None:
+                mask = (1 << len(state)) - 1
+                parts.append(FIELD_MASK.pack(mask))
+                parts.append(self.full[index].pack(*state))
+                continue
+            previous = baseline[index]
+            mask = 0
+            fmt = "<"
+            values = []
+            for field, value in enumerate(state):
+                if value != previous[field]:
+                    mask |= 1 << field
+                    fmt += codes[field]
+                    values.append(value)
+            parts.append(FIELD_MASK.pack(mask))
+            if values:
+                parts.append(struct.pack(fmt, *values))
+        return b"".join(parts)
+    
+    def decode(self, data, history):
+        # Returns (frame, snapshot), or None if the baseline isn't known
+        _, frame, baseline_frame = STATE_HEADER.unpack_from(data)
+        baseline = None
+        if baseline_frame != NO_BASELINE:
+            baseline = history.get(baseline_frame)
+            if baseline is None:
+                return None
+        offset = STATE_HEADER.size
+        snapshot = []
+        for index, codes in enumerate(self.codes):
+            mask, = FIELD_MASK.unpack_from(data, offset)
+            offset += FIELD_MASK.size
+            changed = [field for field in range(len(codes)) if mask & (1 << field)]
+            fmt = "<" + "".join(codes[field] for field in changed)
+            values = struct.unpack_from(fmt, data, offset)
+            offset += struct.calcsize(fmt)
+            state = list(baseline[index]) if baseline is not None else [None] * len(codes)
+            for field, value in zip(changed, values):
+                state[field] = value
+            snapshot.append(tuple(state))
+        return frame, snapshot
+
+class NetHost:
+    def __init__(self, link, character, theme):
+        self.link = link
+        self.character = character
+        self.theme = theme
+        self.client = None
+        self.match = None
+        self.codec = None
+        self.remote_input = 0
+        self.remote_sequence = -1
+        self.acknowledged = None
+        self.history = {}
+        self.encode_time = 0.0
+        self.state_bytes = 0
+        self.state_packets = 0
+    
+    def poll(self):
+        for data, address in self.link.receive():
+            kind = data[0]
+            if kind == PACKET_HELLO and (self.client is None or address == self.client):
+                _, client_character = HELLO_FORMAT.unpack_from(data)
+                if self.match is None:
+                    self.client = address
+                    self.match = create_match([CHARACTERS[self.character][2], CHARACTERS[client_character][2]])
+                    self.codec = StateCodec(self.match.fighters)
+                    self.client_character = client_character
+                # Answer every hello in case the welcome got lost
+                self.link.sendto(WELCOME_FORMAT.pack(PACKET_WELCOME, self.character,
+                                                     self.client_character, self.theme), address)
+            elif kind == PACKET_INPUT and address == self.client:
+                _, sequence, acknowledged, bits = INPUT_FORMAT.unpack_from(data)
+                if sequence > self.remote_sequence:
+                    self.remote_sequence = sequence
+                    self.remote_input = bits
+                if acknowledged != NO_BASELINE and (self.acknowledged is None or acknowledged > self.acknowledged):
+                    self.acknowledged = acknowledged
+    
+    def rematch(self):
+        # Same characters, fresh fighters; frame numbers keep counting so the
+        # client's delta baselines stay valid
+        frame = self.match.frame
+        self.match = create_match([fighter.__class__ for fighter in self.match.fighters])
+        self.match.frame = frame
+    
+    def tick(self, local_input):
+        # Advance one frame and send the client its delta; False until connected
+        self.poll()
+        if self.match is None:
+            return False
+        # Once decided, keep resending the final state
+        if not self.match.is_over():
+            self.match.step([local_input, self.remote_input])
+        
+        start = time.perf_counter()
+        frame = self.match.frame
+        snapshot = self.codec.snapshot(self.match.fighters)
+        self.history[frame] = snapshot
+        self.history.pop(frame - SNAPSHOT_HISTORY, None)
+        baseline = self.history.get(self.acknowledged) if self.acknowledged is not None else None
+        packet = self.codec.encode(frame, self.acknowledged if baseline is not None else NO_BASELINE,
+                                   baseline, snapshot)
+        self.encode_time += time.perf_counter() - start
+        self.state_bytes += len(packet)
+        self.state_packets += 1
+        self.link.sendto(packet, self.client)
+        return True
+
+class NetClient:
+    def __init__(self, link, host_address, character):
+        self.link = link
+        self.host_address = host_address
+        self.character = character
+        self.match = None
+        self.theme = 0
+        self.codec = None
+        self.history = {}
+        self.latest_frame = None
+        self.sequence = 0
+        self.decode_time = 0.0
+    
+    def poll(self):
+        for data, address in self.link.receive():
+            if address != self.host_address:
+                continue
+            kind = data[0]
+            if kind == PACKET_WELCOME and self.match is None:
+                _, host_character, client_character, theme = WELCOME_FORMAT.unpack_from(data)
+                self.match = create_match([CHARACTERS[host_character][2], CHARACTERS[client_character][2]])
+                self.codec = StateCodec(self.match.fighters)
+                self.theme = theme
+            elif kind == PACKET_STATE and self.codec is not None:
+                start = time.perf_counter()
+                decoded = self.codec.decode(data, self.history)
+                self.decode_time += time.perf_counter() - start
+                if decoded is None:
+                    continue
+                frame, snapshot = decoded
+                self.history[frame] = snapshot
+                self.history.pop(frame - SNAPSHOT_HISTORY, None)
+                # Packets can arrive out of order; only show newer states
+                if self.latest_frame is None or frame > self.latest_frame:
+                    self.latest_frame = frame
+                    self.apply(snapshot)
+    
+    def apply(self, snapshot):
+        for fighter, state in zip(self.match.fighters, snapshot):
+            hp = fighter.hp
+            fighter.set_state(state)
+            if fighter.hp < hp:
+                fighter.hit_effect()
+    
+    def tick(self, local_input):
+        # Send this frame's input (or a hello until the host answers)
+        self.poll()
+        if self.match is None:
+            self.link.sendto(HELLO_FORMAT.pack(PACKET_HELLO, self.character), self.host_address)
+            return False
+        self.sequence += 1
+        acknowledged = NO_BASELINE if self.latest_frame is None else self.latest_frame
+        self.link.sendto(INPUT_FORMAT.pack(PACKET_INPUT, self.sequence, acknowledged, local_input),
+                         self.host_address)
+        for fighter in self.match.fighters:
+            fighter.update_particles()
+        return True
+
+# Rollback netplay: both peers simulate. Remote input is predicted (last
+# known input repeated) so the local player never waits; when the real input
+# arrives and differs, the game restores the state before that frame and
+# resimulates up to the present within the same render frame.
+PACKET_ROLLBACK_INPUT = 5
+ROLLBACK_WINDOW = 8                              # most frames resimulated at once
+ROLLBACK_HEADER = struct.Struct("<BIIbB")        # kind, acknowledged frame, first frame, advantage, count
+ROLLBACK_MAX_INPUTS = 32
+ROLLBACK_HASH = struct.Struct("<II")             # after the inputs: latest confirmed frame and its state hash
+PACKET_ROLLBACK_DESYNC = 6                       # frame, then the sender's packed state after it
+DESYNC_HEADER = struct.Struct("<BI")
+
+class RollbackSession:
+    def __init__(self, link, character, remote_address=None, theme=0, input_delay=0):
+        # With no remote address we host: slot 0, waiting for a hello
+        self.link = link
+        self.character = character
+        self.remote_address = remote_address
+        self.theme = theme
+        self.input_delay = input_delay
+        self.local = 0 if remote_address is None else 1
+        self.remote = 1 - self.local
+        self.match = None
+        self.on_confirmed = None
+        self.telemetry_stage = None
+        
+        self.local_inputs = {}
+        self.remote_inputs = {}
+        self.predictions = {}
+        self.last_remote_frame = -1      # remote inputs known for every frame up to here
+        self.remote_acknowledged = -1    # our inputs the remote has up to here
+        self.remote_advantage = 0
+        self.states = {}
+        self.rollback_to = None
+        self.confirmed_frame = -1
+        self.pruned_local = 0
+        self.pruned_remote = 0
+        self.last_local_frame = -1
+        
+        # Hashes of confirmed states, compared with the remote's
+        self.hashes = {}
+        self.packed_states = {}
+        self.remote_hashes = {}
+        self.hashes_compared = 0
+        self.desync_frame = None
+        self.desync = None               # (frame, slot, field, local value, remote value)
+        
+        # Measured simulation cost
+        self.frames_simulated = 0
+        self.sim_time = 0.0
+        self.worst_frame = 0.0
+        self.rollbacks = 0
+        self.frames_resimulated = 0
+        self.longest_rollback = 0
+        self.worst_resimulation = 0.0
+        self.stalls = 0
+    
+    def start(self, characters):
+        self.match = create_match([CHARACTERS[character][2] for character in characters])
+        self.match.speculative = True
+        self.telemetry_stage = TelemetryStage(telemetry) if telemetry else None
+    
+    def frame_cost(self):
+        return self.sim_time / max(1, self.frames_simulated)
+    
+    def budget_fraction(self):
+        # Worst-case resimulation plus the new frame, as a share of one frame
+        return (ROLLBACK_WINDOW + 1) * self.frame_cost() * FPS
+    
+    def input_for(self, slot, frame):
+        # Frames before the input delay has passed play no input
+        if slot == self.local:
+            return self.local_inputs.get(frame, 0)
+        bits = self.remote_inputs.get(frame)
+        if bits is None:
+            bits = self.remote_inputs.get(self.last_remote_frame, 0)
+            self.predictions[frame] = bits
+        return bits
+    
+    def simulate(self, frame):
+        global telemetry
+        self.states[frame] = self.match.save_state()
+        self.states.pop(frame - ROLLBACK_WINDOW - 2, None)
+        inputs = [self.input_for(0, frame), self.input_for(1, frame)]
+        start = time.perf_counter()
+        if self.telemetry_stage:
+            # Events wait in the stage until confirm()
+            bus, telemetry = telemetry, self.telemetry_stage
+            try:
+                self.match.step(inputs)
+            finally:
+                telemetry = bus
+        else:
+            self.match.step(inputs)
+        elapsed = time.perf_counter() - start
+        self.frames_simulated += 1
+        self.sim_time += elapsed
+        self.worst_frame = max(self.worst_frame, elapsed)
+    
+    def resimulate(self):
+        global effect_scale
+        first, present = self.rollback_to, self.match.frame
+        self.rollback_to = None
+        if first >= present:
+            return
+        
+        # Effects already on screen stay; replayed frames don't add more
+        start = time.perf_counter()
+        particles = [fighter.particles for fighter in self.match.fighters]
+        # Resimulated frames replace their staged telemetry events
+        scale, effect_scale = effect_scale, 0
+        try:
+            self.match.load_state(self.states[first])
+            for fighter in self.match.fighters:
+                fighter.particles = []
+            for frame in range(first, present):
+                self.simulate(frame)
+        finally:
+            for fighter, saved in zip(self.match.fighters, particles):
+                fighter.particles = saved
+            effect_scale = scale
+        
+        self.rollbacks += 1
+        self.frames_resimulated += present - first
+        self.longest_rollback = max(self.longest_rollback, present - first)
+        self.worst_resimulation = max(self.worst_resimulation, time.perf_counter() - start)
+    
+    def receive(self):
+        for data, address in self.link.receive():
+            kind = data[0]
+            if kind == PACKET_HELLO and self.local == 0:
+                _, remote_character = HELLO_FORMAT.unpack_from(data)
+                if self.match is None:
+                    self.remote_address = address
+                    self.start([self.character, remote_character])
+                    self.remote_character = remote_character
+                if address == self.remote_address:
+                    self.link.sendto(WELCOME_FORMAT.pack(PACKET_WELCOME, self.character,
+                                                         self.remote_character, self.theme), address)
+            elif kind == PACKET_WELCOME and self.local == 1 and self.match is None:
+                _, host_character, client_character, self.theme = WELCOME_FORMAT.unpack_from(data)
+                self.start([host_character, client_character])
+            elif kind == PACKET_ROLLBACK_INPUT and self.match is not None and address == self.remote_address:
+                acknowledged, first, advantage, count = ROLLBACK_HEADER.unpack_from(data, 0)[1:]
+                if acknowledged != NO_BASELINE:
+                    self.remote_acknowledged = max(self.remote_acknowledged, acknowledged)
+                self.remote_advantage = advantage
+                for offset, bits in enumerate(data[ROLLBACK_HEADER.size:ROLLBACK_HEADER.size + count]):
+                    frame = first + offset
+                    if frame in self.remote_inputs:
+                        continue
+                    self.remote_inputs[frame] = bits
+                    predicted = self.predictions.pop(frame, None)
+                    if predicted is not None and predicted != bits:
+                        if self.rollback_to is None or frame < self.rollback_to:
+                            self.rollback_to = frame
+                while self.last_remote_frame + 1 in self.remote_inputs:
+                    self.last_remote_frame += 1
+                offset = ROLLBACK_HEADER.size + count
+                if len(data) >= offset + ROLLBACK_HASH.size:
+                    frame, crc = ROLLBACK_HASH.unpack_from(data, offset)
+                    if frame != NO_BASELINE:
+                        self.remote_hashes[frame] = crc
+                        self.check_hash(frame)
+            elif kind == PACKET_ROLLBACK_DESYNC and self.match is not None and address == self.remote_address:
+                _, frame = DESYNC_HEADER.unpack_from(data)
+                packed = self.packed_states.get(frame)
+                if packed is not None and self.desync is None:
+                    difference = self.match.hasher.difference(packed, data[DESYNC_HEADER.size:])
+                    if difference:
+                        self.desync = (frame,) + difference
+                        slot, field, local, remote = difference
+                        print(f"[rollback] desync at frame {frame}: P{slot + 1} {field} is {local!r} here, "
+                              f"{remote!r} on the remote")
+    
+    def check_hash(self, frame):
+        # Compare once both sides have confirmed the frame
+        if frame > self.confirmed_frame or frame not in self.remote_hashes:
+            return
+        remote = self.remote_hashes.pop(frame)
+        local = self.hashes.get(frame)
+        if local is None:
+            return
+        self.hashes_compared += 1
+        if local != remote and self.desync_frame is None:
+            self.desync_frame = frame
+            print(f"[rollback] state hash differs from the remote at frame {frame}")
+            self.link.sendto(DESYNC_HEADER.pack(PACKET_ROLLBACK_DESYNC, frame) + self.packed_states[frame],
+                             self.remote_address)
+    
+    def send_inputs(self):
+        first = self.remote_acknowledged + 1
+        last = self.last_local_frame
+        first = max(first, last - ROLLBACK_MAX_INPUTS + 1)
+        bits = bytes(self.local_inputs.get(frame, 0) for frame in range(first, last + 1))
+        advantage = max(-128, min(127, self.match.frame - (self.last_remote_frame + 1)))
+        acknowledged = NO_BASELINE if self.last_remote_frame < 0 else self.last_remote_frame
+        header = ROLLBACK_HEADER.pack(PACKET_ROLLBACK_INPUT, acknowledged, first, advantage, len(bits))
+        confirmed = self.hashes.get(self.confirmed_frame)
+        checksum = ROLLBACK_HASH.pack(NO_BASELINE if confirmed is None else self.confirmed_frame, confirmed or 0)
+        self.link.sendto(header + bits + checksum, self.remote_address)
+    
+    def prune(self):
+        # Inputs older than the rollback window (and, for ours, already
+        # acknowledged) are never needed again
+        oldest = self.match.frame - ROLLBACK_WINDOW - 2
+        while self.pruned_remote < min(oldest, self.last_remote_frame):
+            self.remote_inputs.pop(self.pruned_remote, None)
+            self.pruned_remote += 1
+        while self.pruned_local < min(oldest, self.remote_acknowledged + 1):
+            self.local_inputs.pop(self.pruned_local, None)
+            self.pruned_local += 1
+    
+    def confirm(self):
+        # States that can no longer be rolled back, for desync checks
+        while self.confirmed_frame < min(self.last_remote_frame, self.match.frame - 1):
+            self.confirmed_frame += 1
+            frame = self.confirmed_frame
+            after = self.states.get(frame + 1)
+            states = self.match.save_state()[1] if after is None else after[1]
+            packed = self.match.hasher.pack(states)
+            self.hashes[frame] = zlib.crc32(packed)
+            self.packed_states[frame] = packed
+            self.hashes.pop(frame - SNAPSHOT_HISTORY, None)
+            self.packed_states.pop(frame - SNAPSHOT_HISTORY, None)
+            self.check_hash(frame)
+            if self.telemetry_stage:
+                self.telemetry_stage.confirm(frame)
+            if self.on_confirmed is not None:
+                self.on_confirmed(frame, states)
+        # The replay ends once the knockout frame itself is confirmed
+        if (self.match.replay and self.match.is_over() and
+                self.confirmed_frame == self.match.frame - 1):
+            recorder.finish(self.match.replay)
+            self.match.replay = None
+    
+    def tick(self, local_input):
+        # One render frame; False until the match has started
+        self.receive()
+        if self.match is None:
+            if self.local == 1:
+                self.link.sendto(HELLO_FORMAT.pack(PACKET_HELLO, self.character), self.remote_address)
+            return False
+        
+        if self.rollback_to is not None:
+            self.resimulate()
+        self.confirm()
+        
+        frame = self.match.frame
+        # Input already sent for this frame is final, even while stalled
+        if frame + self.input_delay > self.last_local_frame:
+            self.last_local_frame = frame + self.input_delay
+            self.local_inputs[self.last_local_frame] = local_input
+        self.prune()
+        # Don't run further ahead than we can roll back, and give the remote a
+        # frame to catch up when we are clearly ahead of it
+        local_advantage = frame - (self.last_remote_frame + 1)
+        if self.match.is_over():
+            self.send_inputs()
+            return True
+        if (local_advantage >= ROLLBACK_WINDOW or
+                local_advantage - self.remote_advantage >= 2 and frame % 4 == 0):
+            self.stalls += 1
+            self.send_inputs()
+            return True
+        
+        self.simulate(frame)
+        self.send_inputs()
+        return True
+
+# Match server: one process hosting many headless matches. A single
+# scheduler task advances every match in one pass per tick; players and bots
+# connect over local TCP and exchange length-prefixed messages (the UDP
+# input/state formats, with state deltas against the last state sent).
+SERVER_START = 4
+SERVER_HIGH_WATER = 64 * 1024      # skip state updates above this much unsent data
+SERVER_DROP_LIMIT = 1024 * 1024    # disconnect clients this far behind
+SERVER_MAX_CATCHUP = 4             # ticks run back to back when the scheduler is late
+SERVER_REPORT_INTERVAL = 5.0
+
+MESSAGE_LENGTH = struct.Struct("<H")
+JOIN_FORMAT = struct.Struct("<BBB")          # kind, character, opponent (0 = player, 1 = server bot)
+START_FORMAT = struct.Struct("<BBBB")        # kind, slot, character 0, character 1
+
+def frame_message(payload):
+    return MESSAGE_LENGTH.pack(len(payload)) + payload
+
+async def read_message(reader):
+    header = await reader.readexactly(MESSAGE_LENGTH.size)
+    length, = MESSAGE_LENGTH.unpack(header)
+    return await reader.readexactly(length)
+
+class ServerClient:
+    def __init__(self, writer):
+        self.writer = writer
+        self.input = 0
+        self.match = None
+        self.baseline = None
+        self.baseline_frame = NO_BASELINE
+        self.states_sent = 0
+        self.states_skipped = 0
+        self.closed = False
+    
+    def send(self, payload):
+        self.writer.write(frame_message(payload))
+    
+    def send_state(self, codec, frame, snapshot):
+        buffered = self.writer.transport.get_write_buffer_size()
+        if buffered > SERVER_DROP_LIMIT:
+            self.close()
+            return
+        if buffered > SERVER_HIGH_WATER:
+            # Backpressure: the next state we do send is a delta against the
+            # last one queued, so skipped frames cost nothing to recover from
+            self.states_skipped += 1
+            return
+        self.send(codec.encode(frame, self.baseline_frame, self.baseline, snapshot))
+        self.baseline, self.baseline_frame = snapshot, frame
+        self.states_sent += 1
+    
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+
+class ServerMatch:
+    def __init__(self, match_id, characters, clients):
+        self.match_id = match_id
+        self.characters = characters
+        self.match = create_match([CHARACTERS[character][2] for character in characters])
+        self.codec = StateCodec(self.match.fighters)
+        # None marks a slot played by a server-side bot
+        self.clients = clients
+        self.bots = [CpuController(match_id * 2 + slot) if client is None else None
+                     for slot, client in enumerate(clients)]
+        self.finished_at = None
+        
+        # Tick accounting
+        self.ticks = 0
+        self.step_time = 0.0
+        self.worst_step = 0.0
+        self.overruns = 0
+        self.skipped_ticks = 0
+    
+    def tick(self, budget):
+        start = time.perf_counter()
+        match = self.match
+        if not match.is_over():
+            inputs = []
+            for slot, fighter in enumerate(match.fighters):
+                bot = self.bots[slot]
+                if bot is not None:
+                    inputs.append(bot.control(fighter, match.fighters[1 - slot]))
+                else:
+                    client = self.clients[slot]
+                    inputs.append(client.input if not client.closed and client.match is self else 0)
+            match.step(inputs)
+        
+        if any(client is not None for client in self.clients):
+            snapshot = self.codec.snapshot(match.fighters)
+            for client in self.clients:
+                # Players may have moved on to their next match already
+                if client is not None and not client.closed and client.match is self:
+                    client.send_state(self.codec, match.frame, snapshot)
+        
+        elapsed = time.perf_counter() - start
+        self.ticks += 1
+        self.step_time += elapsed
+        self.worst_step = max(self.worst_step, elapsed)
+        # Over this match's fair share of the tick budget
+        if elapsed > budget:
+            self.overruns += 1
+
+class MatchServer:
+    def __init__(self, bot_matches=0, finished_linger=2.0):
+        self.matches = []
+        self.clients = set()
+        self.waiting = []
+        self.next_match_id = 0
+        self.finished_linger = finished_linger
+        self.running = True
+        
+        self.ticks = 0
+        self.tick_time = 0.0
+        self.worst_tick = 0.0
+        self.overruns = 0
+        self.skipped_ticks = 0
+        
+        for _ in range(bot_matches):
+            self.start_match([random.randrange(len(CHARACTERS)) for _ in range(2)], [None, None])
+    
+    def start_match(self, characters, clients):
+        server_match = ServerMatch(self.next_match_id, characters, clients)
+        self.next_match_id += 1
+        self.matches.append(server_match)
+        for slot, client in enumerate(clients):
+            if client is not None:
+                client.match = server_match
+                client.baseline, client.baseline_frame = None, NO_BASELINE
+                client.send(START_FORMAT.pack(SERVER_START, slot, *characters))
+        return server_match
+    
+    async def handle_client(self, reader, writer):
+        client = ServerClient(writer)
+        self.clients.add(client)
+        try:
+            while not client.closed:
+                data = await read_message(reader)
+                kind = data[0]
+                if kind == PACKET_HELLO:
+                    _, character, opponent = JOIN_FORMAT.unpack_from(data)
+                    if opponent:
+                        self.start_match([character, random.randrange(len(CHARACTERS))], [client, None])
+                    elif self.waiting and not self.waiting[0][0].closed:
+                        other, other_character = self.waiting.pop(0)
+                        self.start_match([other_character, character], [other, client])
+                    else:
+                        self.waiting = [(client, character)]
+                elif kind == PACKET_INPUT:
+                    _, _, _, client.input = INPUT_FORMAT.unpack_from(data)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            client.close()
+            self.clients.discard(client)
+    
+    def tick_all(self, budget):
+        start = time.perf_counter()
+        share = budget / max(1, len(self.matches))
+        for server_match in self.matches:
+            server_match.tick(share)
+        elapsed = time.perf_counter() - start
+        self.ticks += 1
+        self.tick_time += elapsed
+        self.worst_tick = max(self.worst_tick, elapsed)
+        if elapsed > budget:
+            self.overruns += 1
+    
+    def retire_matches(self, now):
+        # Finished matches stay up briefly so players see the result; bot
+        # matches are replaced to keep the load constant
+        keep = []
+        replacements = 0
+        for server_match in self.matches:
+            players = [client for client in server_match.clients if client is not None]
+            if players and all(client.closed or client.match is not server_match for client in players):
+                continue
+            if server_match.match.is_over():
+                if server_match.finished_at is None:
+                    server_match.finished_at = now
+                elif now - server_match.finished_at > self.finished_linger:
+                    if not players:
+                        replacements += 1
+                    continue
+            keep.append(server_match)
+        self.matches = keep
+        for _ in range(replacements):
+            self.start_match([random.randrange(len(CHARACTERS)) for _ in range(2)], [None, None])
+    
+    async def run_scheduler(self):
+        loop = asyncio.get_running_loop()
+        tick = 1 / FPS
+        next_tick = loop.time()
+        next_report = next_tick + SERVER_REPORT_INTERVAL
+        while self.running:
+            now = loop.time()
+            if now < next_tick:
+                await asyncio.sleep(next_tick - now)
+                continue
+            due = int((now - next_tick) / tick) + 1
+            steps = min(due, SERVER_MAX_CATCHUP)
+            for _ in range(steps):
+                self.tick_all(tick)
+            if due > steps:
+                # Too far behind to catch up; these ticks are dropped
+                self.skipped_ticks += due - steps
+                for server_match in self.matches:
+                    server_match.skipped_ticks += due - steps
+            next_tick += due * tick
+            self.retire_matches(now)
+            if now >= next_report:
+                self.report()
+                next_report = now + SERVER_REPORT_INTERVAL
+            # Let client reads and writes run between ticks
+            await asyncio.sleep(0)
+    
+    def report(self):
+        clients = sum(1 for m in self.matches for c in m.clients if c is not None and not c.closed)
+        skipped_states = sum(c.states_skipped for m in self.matches for c in m.clients if c is not None)
+        average = self.tick_time / max(1, self.ticks) * 1000
+        print(f"[server] {len(self.matches)} matches, {clients} clients, tick avg {average:.2f} ms "
+              f"max {self.worst_tick * 1000:.2f} ms, {self.overruns} overruns, {self.skipped_ticks} skipped ticks, "
+              f"{skipped_states} states held back")
+        worst = sorted(self.matches, key=lambda m: (m.overruns, m.worst_step), reverse=True)[:3]
+        for m in worst:
+            if m.overruns:
+                print(f"[server]   match {m.match_id}: {m.overruns}/{m.ticks} ticks over its share, "
+                      f"worst {m.worst_step * 1000:.3f} ms, {m.skipped_ticks} skipped")
+        self.worst_tick = 0.0
+    
+    async def serve(self, host, port, duration=None):
+        server = await asyncio.start_server(self.handle_client, host, port)
+        print(f"[server] listening on {host}:{port}")
+        scheduler = asyncio.create_task(self.run_scheduler())
+        try:
+            if duration:
+                await asyncio.sleep(duration)
+            else:
+                await scheduler
+        finally:
+            self.running = False
+            server.close()
+            await scheduler
+            self.report()
+            # Closing the connections ends their handlers cleanly
+            for client in list(self.clients):
+                client.close()
+            await server.wait_closed()
+
+async def run_bot_client(host, port, seed, stats, deadline):
+    rng = random.Random(seed)
+    controller = CpuController(seed)
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(frame_message(JOIN_FORMAT.pack(PACKET_HELLO, rng.randrange(len(CHARACTERS)), 0)))
+    match = codec = None
+    history = {}
+    sequence = 0
+    try:
+        while time.monotonic() < deadline:
+            data = await read_message(reader)
+            kind = data[0]
+            if kind == SERVER_START:
+                _, slot, *characters = START_FORMAT.unpack_from(data)
+                match = create_match([CHARACTERS[character][2] for character in characters])
+                codec = StateCodec(match.fighters)
+                history = {}
+                stats["matches"] += 1
+            elif kind == PACKET_STATE and codec is not None:
+                decoded = codec.decode(data, history)
+                if decoded is None:
+                    stats["errors"] += 1
+                    continue
+                frame, snapshot = decoded
+                history = {frame: snapshot}
+                for fighter, state in zip(match.fighters, snapshot):
+                    fighter.set_state(state)
+                stats["states"] += 1
+                if match.is_over():
+                    # Queue up for the next match
+                    codec = None
+                    writer.write(frame_message(JOIN_FORMAT.pack(PACKET_HELLO, rng.randrange(len(CHARACTERS)), 0)))
+                    continue
+                fighter, opponent = match.fighters[slot], match.fighters[1 - slot]
+                sequence += 1
+                writer.write(frame_message(INPUT_FORMAT.pack(PACKET_INPUT, sequence, frame,
+                                                             controller.control(fighter, opponent))))
+                await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        stats["disconnects"] += 1
+    finally:
+        writer.close()
+
+def run_bot_clients(host, port, count, duration):
+    # Load generator: count bot clients playing each other through the server
+    global effect_scale, telemetry, recorder
+    effect_scale = 0
+    telemetry = recorder = None  # the server records the matches
+    stats = {"matches": 0, "states": 0, "errors": 0, "disconnects": 0}
+    
+    async def run_all():
+        deadline = time.monotonic() + duration
+        await asyncio.gather(*(run_bot_client(host, port, seed, stats, deadline) for seed in range(count)),
+                             return_exceptions=True)
+    
+    asyncio.run(run_all())
+    print(f"[bots] {count} clients: {stats['matches']} matches joined, "
+          f"{stats['states'] / duration:.0f} states/s received, {stats['errors']} decode errors, "
+          f"{stats['disconnects']} disconnects")
+
+def run_server(args):
+    global effect_scale
+    effect_scale = 0  # headless
+    server = MatchServer(args.server_matches)
+    bots = None
+    if args.bots:
+        bots = multiprocessing.Process(target=run_bot_clients,
+                                       args=("127.0.0.1", args.server, args.bots, args.duration or 10))
+    
+    async def serve():
+        task = asyncio.create_task(server.serve("127.0.0.1", args.server, args.duration))
+        await asyncio.sleep(0.2)
+        if bots:
+            bots.start()
+        await task
+    
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    if bots:
+        bots.join()
+    return 1 if server.skipped_ticks else 0
+
+# Threaded simulation (--threaded). The match runs on its own thread at a
+# fixed FPS and after each tick publishes a render snapshot: copies of the
+# fighters (particles included) and of the camera that are never changed
+# afterwards. Snapshots are double-buffered; the simulation fills the back
+# slot and swaps it to the front, and the window draws whatever is in front,
+# so a slow draw no longer delays the next tick. Keyboard controllers read
+# the key state from the window thread's last event pump.
+SIM_MAX_CATCHUP = 4  # Frames run back to back when the simulation thread is late
+
+class RenderSnapshot:
+    def __init__(self, match, camera):
+        self.frame = match.frame
+        self.fighters = [fighter.snapshot() for fighter in match.fighters]
+        self.camera = object.__new__(Camera)
+        self.camera.__dict__.update(camera.__dict__)
+        self.over = match.is_over()
+
+class SnapshotBuffer:
+    def __init__(self):
+        self.slots = [None, None]
+        self.front = 0
+        self.lock = threading.Lock()
+    
+    def publish(self, snapshot):
+        back = 1 - self.front
+        self.slots[back] = snapshot
+        with self.lock:
+            self.front = back
+    
+    def latest(self):
+        with self.lock:
+            return self.slots[self.front]
+
+class SimulationThread(threading.Thread):
+    def __init__(self, match, controllers, camera):
+        super().__init__(name="simulation", daemon=True)
+        self.match = match
+        self.controllers = controllers
+        self.camera = camera
+        self.snapshots = SnapshotBuffer()
+        self.snapshots.publish(RenderSnapshot(match, camera))
+        self.running = True
+        self.worst_lateness = 0.0  # Seconds a tick started after it was due
+        self.dropped_frames = 0
+    
+    def run(self):
+        match = self.match
+        tick = 1 / FPS
+        next_tick = time.perf_counter()
+        while self.running and not match.is_over():
+            now = time.perf_counter()
+            if now < next_tick:
+                time.sleep(next_tick - now)
+                continue
+            self.worst_lateness = max(self.worst_lateness, now - next_tick)
+            due = int((now - next_tick) / tick) + 1
+            steps = min(due, SIM_MAX_CATCHUP)
+            for _ in range(steps):
+                match.step([controller.control(fighter, match.target_of(fighter))
+                            for controller, fighter in zip(self.controllers, match.fighters)])
+                self.camera.follow(match.fighters)
+                if match.is_over():
+                    break
+            # Too far behind to catch up; these frames are dropped
+            self.dropped_frames += due - steps
+            next_tick += due * tick
+            self.snapshots.publish(RenderSnapshot(match, self.camera))
+    
+    def stop(self):
+        self.running = False
+        self.join()
+
+# Output window. Everything is drawn on a fixed SCREEN_WIDTH x SCREEN_HEIGHT
+# canvas which is upscaled once per frame, so drawing cost does not depend on
+# the output resolution.
+class Display:
+    def __init__(self, width=SCREEN_WIDTH, height=SCREEN_HEIGHT, fullscreen=False, scale_mode=SCALE_FAST):
+        self.scale_mode = scale_mode
+        if fullscreen:
+            # (0, 0) picks the desktop resolution
+            self.window = pygame.display.set_mode((width, height) if width and height else (0, 0), FULLSCREEN)
+        else:
+            self.window = pygame.display.set_mode((width, height), RESIZABLE)
+        pygame.display.set_caption("Python Street Fighter")
+        self.canvas = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT)).convert()
+        self.resize()
+
+    def resize(self):
+        # pygame resizes the window surface itself, we only redo the layout
+        self.window = pygame.display.get_surface()
+        size = self.window.get_size()
+        
+        # Largest aspect-preserving fit, letterboxed and centered
+        scale = min(size[0] / SCREEN_WIDTH, size[1] / SCREEN_HEIGHT)
+        scaled_size = (max(1, int(SCREEN_WIDTH * scale)), max(1, int(SCREEN_HEIGHT * scale)))
+        self.dest = pygame.Rect((0, 0), scaled_size)
+        self.dest.center = (size[0] // 2, size[1] // 2)
+        
+        # Scale straight into the window to avoid an extra blit per frame
+        self.window.fill(BLACK)
+        self.target = self.window.subsurface(self.dest)
+
+    def toggle_scale_mode(self):
+        self.scale_mode = SCALE_SMOOTH if self.scale_mode == SCALE_FAST else SCALE_FAST
+
+    def present(self):
+        if self.dest.size == self.canvas.get_size():
+            self.target.blit(self.canvas, (0, 0))
+        elif self.scale_mode == SCALE_SMOOTH:
+            pygame.transform.smoothscale(self.canvas, self.dest.size, self.target)
+        else:
+            pygame.transform.scale(self.canvas, self.dest.size, self.target)
+        pygame.display.flip()
+
+# Main game functions
+def draw_menu(screen):
+    screen.fill(BLACK)
+    
+    # Title
+    title_text = render_text(title_font, "PYTHON STREET FIGHTER", RED)
+    screen.blit(title_text, (SCREEN_WIDTH//2 - title_text.get_width()//2, 100))
+    
+    # Menu options
+    start_text = render_text(menu_font, "PRESS ENTER TO START", WHITE)
+    screen.blit(start_text, (SCREEN_WIDTH//2 - start_text.get_width()//2, 300))
+    
+    controls_text = render_text(menu_font, "Player 1: WASD + F/G    Player 2: Arrows + K/L", WHITE)
+    screen.blit(controls_text, (SCREEN_WIDTH//2 - controls_text.get_width()//2, 400))
+
+def draw_character_select(screen, p1_selection, p2_selection, characters):
+    screen.fill(BLACK)
+    
+    # Title
+    title_text = render_text(title_font, "SELECT YOUR FIGHTER", RED)
+    screen.blit(title_text, (SCREEN_WIDTH//2 - title_text.get_width()//2, 50))
+    
+    # Character selection boxes
+    box_width = 150
+    box_height = 200
+    spacing = 30
+    total_width = len(characters) * box_width + (len(characters) - 1) * spacing
+    start_x = (SCREEN_WIDTH - total_width) // 2
+    
+    for i, (name, color, _) in enumerate(characters):
+        x = start_x + i * (box_width + spacing)
+        y = 150
+        
+        # Box background
+        pygame.draw.rect(screen, color, (x, y, box_width, box_height))
+        
+        # Character name
+        name_text = render_text(menu_font, name, WHITE)
+        screen.blit(name_text, (x + box_width//2 - name_text.get_width()//2, y + box_height + 20))
+        
+        # Selection indicators
+        if p1_selection == i:
+            pygame.draw.rect(screen, RED, (x, y, box_width, box_height), 5)
+            p1_text = render_text(menu_font, "P1", RED)
             screen.blit(p1_text, (x + 10, y + 10))
             
         if p2_selection == i:
             pygame.draw.rect(screen, BLUE, (x, y, box_width, box_height), 5)
-            p2_text = menu_font.render("P2", True, BLUE)
+            p2_text = render_text(menu_font, "P2", BLUE)
             screen.blit(p2_text, (x + box_width - 40, y + 10))
     
     # Instructions
-    instructions_text = menu_font.render("PRESS ENTER TO FIGHT", True, WHITE)
+    instructions_text = render_text(menu_font, "PRESS ENTER TO FIGHT", WHITE)
     screen.blit(instructions_text, (SCREEN_WIDTH//2 - instructions_text.get_width()//2, 500))
-    
-    pygame.display.flip()
 
-def draw_fighting(screen, p1, p2, background):
+def draw_fighting(screen, fighters, background, camera=None):
     screen.fill(BLACK)
+    camera_x = camera.left() if camera else 0
     
     # Draw background
-    background.draw(screen)
+    background.draw(screen, camera_x)
     
-    # Draw fighters
-    p1.draw(screen)
-    p2.draw(screen)
+    # Draw fighters (skipping any the camera can't see)
+    for fighter in fighters:
+        if camera is None or camera.sees(fighter):
+            fighter.draw(screen, camera_x)
     
     # Draw timer
-    timer_text = hud_font.render(f"FIGHT!", True, WHITE)
+    timer_text = render_text(hud_font, f"FIGHT!", WHITE)
     screen.blit(timer_text, (SCREEN_WIDTH//2 - timer_text.get_width()//2, 30))
-    
-    pygame.display.flip()
+
+# Profiler overlay (F3): frame work time against the budget, particle count
+# and the current effects quality level
+def draw_profiler(screen, governor, fighters, simulation=None, rollback=None):
+    particles = sum(len(fighter.particles) for fighter in fighters)
+    mode = "auto" if governor.adaptive else "fixed"
+    lines = [
+        f"FRAME {governor.average * 1000:.1f} / {governor.budget * 1000:.1f} ms",
+        f"QUALITY {governor.name().upper()} ({mode})",
+        f"PARTICLES {particles}",
+    ]
+    if simulation:
+        lines.append(f"SIM TICK LATE {simulation.worst_lateness * 1000:.1f} ms MAX, "
+                     f"{simulation.dropped_frames} DROPPED")
+    if rollback:
+        lines.append(f"ROLLBACKS {rollback.rollbacks} (LONGEST {rollback.longest_rollback}), "
+                     f"FULL WINDOW {rollback.budget_fraction():.1%} OF FRAME")
+    for row, line in enumerate(lines):
+        screen.blit(render_text(profiler_font, line, WHITE), (10, 10 + row * 18))
+
+def draw_waiting(screen, message):
+    screen.fill(BLACK)
+    waiting_text = render_text(menu_font, message, WHITE)
+    screen.blit(waiting_text, (SCREEN_WIDTH//2 - waiting_text.get_width()//2, 280))
 
 def draw_game_over(screen, winner, loser):
     screen.fill(BLACK)
     
     # Winner text
-    winner_text = title_font.render(f"{winner.name} WINS!", True, winner.color)
+    winner_text = render_text(title_font, f"{winner.name} WINS!", winner.color)
     screen.blit(winner_text, (SCREEN_WIDTH//2 - winner_text.get_width()//2, 200))
     
     # Restart text
-    restart_text = menu_font.render("PRESS ENTER TO PLAY AGAIN", True, WHITE)
+    restart_text = render_text(menu_font, "PRESS ENTER TO PLAY AGAIN", WHITE)
     screen.blit(restart_text, (SCREEN_WIDTH//2 - restart_text.get_width()//2, 350))
-    
-    pygame.display.flip()
 
 # Main game loop
-def main():
+def main(args):
+    display = Display(args.width, args.height, args.fullscreen, SCALE_SMOOTH if args.smooth else SCALE_FAST)
+    screen = display.canvas
+    
     game_state = MENU
     running = True
     
-    # Character definitions
-    characters = [
-        ("Shadow Ninja", BLACK, NinjaFighter),
-        ("Volt Striker", BLUE, ElectricFighter),
-        ("Flame Master", RED, FireFighter),
-        ("Stone Titan", (139, 69, 19), EarthFighter)
-    ]
+    characters = CHARACTERS
+    preload_atlases([fighter_class for _, _, fighter_class in characters])
     
     # Select random stage
-    stage_themes = ["dojo", "street", "arena"]
-    background = Background(random.choice(stage_themes))
+    background = Background(random.choice(STAGE_THEMES), stage_width)
+    camera = Camera(stage_width)
     
     # Character selection state
     p1_selection = 0
     p2_selection = 1
     
-    # Initialize fighters (will be properly set after character selection)
-    p1 = None
-    p2 = None
+    # Match and per-player controllers (set up after character selection)
+    match = None
+    controllers = []
+    simulation = None
+    frame_data = FrameData.read(args.frame_data) if args.frame_data else None
+    policy = Policy.read(args.policy) if args.policy else None
+    
+    def cpu():
+        return PolicyController(policy) if policy else CpuController(frame_data=frame_data)
+    
+    governor = QualityGovernor(QUALITY_NAMES.index(args.quality) if args.quality != "auto" else 0,
+                               args.quality == "auto")
+    show_profiler = False
     
     while running:
+        governor.begin_frame()
+        
         # Handle events
         for event in pygame.event.get():
             if event.type == QUIT:
                 running = False
                 
+            if event.type == VIDEORESIZE:
+                display.resize()
+                
             if event.type == KEYDOWN:
                 if event.key == K_ESCAPE:
                     running = False
                     
+                if event.key == K_F9:
+                    display.toggle_scale_mode()
+                    
+                if event.key == K_F3:
+                    show_profiler = not show_profiler
+                    
                 if game_state == MENU and event.key == K_RETURN:
                     game_state = CHARACTER_SELECT
                     
@@ -1034,14 +4521,23 @@ def main():
                     elif event.key == K_RIGHT:
                         p2_selection = (p2_selection + 1) % len(characters)
                     elif event.key == K_RETURN:
-                        # Create fighters based on selection
-                        p1_class = characters[p1_selection][2]
-                        p2_class = characters[p2_selection][2]
+                        # Create fighters based on selection; extra players in
+                        # 2v2 / free-for-all get random characters
+                        fighter_classes = [characters[p1_selection][2], characters[p2_selection][2]]
+                        if args.mode != "versus":
+                            fighter_classes += [random.choice(characters)[2] for _ in range(args.players - 2)]
+                        match = create_match(fighter_classes, args.mode)
+                        camera.follow(match.fighters, snap=True)
+                        if memory:
+                            memory.start_match()
                         
-                        p1 = p1_class(150, FLOOR_HEIGHT - 100)
-                        p2 = p2_class(SCREEN_WIDTH - 200, FLOOR_HEIGHT - 100)
-                        p1.facing_right = True
-                        p2.facing_right = False
+                        controllers = [KeyboardController(P1_KEYS), KeyboardController(P2_KEYS)]
+                        controllers += [cpu() for _ in range(len(fighter_classes) - 2)]
+                        for index in range(2 - args.cpu, 2):
+                            controllers[index] = cpu()
+                        if args.threaded:
+                            simulation = SimulationThread(match, controllers, camera)
+                            simulation.start()
                         
                         game_state = FIGHTING
                         
@@ -1056,88 +4552,639 @@ def main():
             draw_character_select(screen, p1_selection, p2_selection, characters)
             
         elif game_state == FIGHTING:
-            # Get keyboard state
-            keys = pygame.key.get_pressed()
-            
-            # Player 1 controls
-            x_direction1 = 0
-            if keys[K_a]:
-                x_direction1 = -1
-            elif keys[K_d]:
-                x_direction1 = 1
-            p1.move(x_direction1)
-            
-            if keys[K_w]:
-                p1.jump()
-                
-            if keys[K_s]:
-                if isinstance(p1, NinjaFighter) and x_direction1 != 0:
-                    p1.dash(x_direction1)
-                
-            p1.block(keys[K_c])
-            
-            # Player 1 attack controls (handled as events to avoid key repeat)
-            if keys[K_f] and not p1.is_attacking:
-                p1.attack()
-            if keys[K_g] and not p1.is_attacking:
-                p1.special_attack()
+            if memory:
+                memory.begin_frame()
             
-            # Player 2 controls
-            x_direction2 = 0
-            if keys[K_LEFT]:
-                x_direction2 = -1
-            elif keys[K_RIGHT]:
-                x_direction2 = 1
-            p2.move(x_direction2)
-            
-            if keys[K_UP]:
-                p2.jump()
-                
-            if keys[K_DOWN]:
-                if isinstance(p2, NinjaFighter) and x_direction2 != 0:
-                    p2.dash(x_direction2)
+            if simulation:
+                # The simulation thread steps the match; draw its latest state
+                snapshot = simulation.snapshots.latest()
+                fighters, view, over = snapshot.fighters, snapshot.camera, snapshot.over
+            else:
+                # Player controls
+                inputs = [controller.control(fighter, match.target_of(fighter))
+                          for controller, fighter in zip(controllers, match.fighters)]
                 
-            p2.block(keys[K_l])
-            
-            # Player 2 attack controls
-            if keys[K_k] and not p2.is_attacking:
-                p2.attack()
-            if keys[K_j] and not p2.is_attacking:
-                p2.special_attack()
+                # Update fighters and check for hits
+                match.step(inputs)
+                camera.follow(match.fighters)
+                fighters, view, over = match.fighters, camera, match.is_over()
             
-            # Update fighters
-            p1.update(p2)
-            p2.update(p1)
+            # Draw game
+            draw_fighting(screen, fighters, background, view)
+            if show_profiler:
+                draw_profiler(screen, governor, fighters, simulation)
             
-            # Check for hits
-            p1.check_hit(p2)
-            p2.check_hit(p1)
+            if memory:
+                memory.end_frame()
             
             # Check for game over
-            if p1.hp <= 0 or p2.hp <= 0:
+            if over:
+                if simulation:
+                    simulation.stop()
+                    simulation = None
                 game_state = GAME_OVER
-                if p1.hp <= 0 and p2.hp <= 0:
-                    # In case of a draw, player with higher HP percentage wins
-                    if p1.hp / p1.max_hp > p2.hp / p2.max_hp:
-                        winner, loser = p1, p2
-                    else:
-                        winner, loser = p2, p1
-                elif p1.hp <= 0:
-                    winner, loser = p2, p1
-                else:
-                    winner, loser = p1, p2
-            
-            # Draw game
-            draw_fighting(screen, p1, p2, background)
+                winner, loser = match.result()
+                if memory:
+                    memory.end_match(match.fighters)
             
         elif game_state == GAME_OVER:
             draw_game_over(screen, winner, loser)
         
+        display.present()
+        governor.end_frame()
+        
         # Cap the frame rate
         clock.tick(FPS)
     
+    if simulation:
+        simulation.stop()
+    pygame.quit()
+    sys.exit()
+
+# Network versus loop; the local player always uses the P1 controls
+def netplay_main(args):
+    display = Display(args.width, args.height, args.fullscreen, SCALE_SMOOTH if args.smooth else SCALE_FAST)
+    screen = display.canvas
+    preload_atlases([fighter_class for _, _, fighter_class in CHARACTERS])
+    
+    if args.host:
+        link = LossyLink(open_udp_socket(("0.0.0.0", args.host)), args.loss, args.delay / 1000, args.jitter / 1000)
+        theme = random.randrange(len(STAGE_THEMES))
+        if args.rollback:
+            peer = RollbackSession(link, args.character, theme=theme, input_delay=args.input_delay)
+        else:
+            peer = NetHost(link, args.character, theme)
+        waiting_message = f"WAITING FOR PLAYER ON PORT {args.host}"
+    else:
+        host, port = args.join
+        link = LossyLink(open_udp_socket(("0.0.0.0", 0)), args.loss, args.delay / 1000, args.jitter / 1000)
+        address = (socket.gethostbyname(host), port)
+        if args.rollback:
+            peer = RollbackSession(link, args.character, address, input_delay=args.input_delay)
+        else:
+            peer = NetClient(link, address, args.character)
+        waiting_message = f"CONNECTING TO {host}:{port}"
+    controller = KeyboardController(P1_KEYS)
+    background = None
+    camera = Camera(stage_width)
+    governor = QualityGovernor(QUALITY_NAMES.index(args.quality) if args.quality != "auto" else 0,
+                               args.quality == "auto")
+    show_profiler = False
+    
+    running = True
+    while running:
+        governor.begin_frame()
+        for event in pygame.event.get():
+            if event.type == QUIT:
+                running = False
+            if event.type == VIDEORESIZE:
+                display.resize()
+            if event.type == KEYDOWN:
+                if event.key == K_ESCAPE:
+                    running = False
+                if event.key == K_F9:
+                    display.toggle_scale_mode()
+                if event.key == K_F3:
+                    show_profiler = not show_profiler
+                if (event.key == K_RETURN and isinstance(peer, NetHost) and peer.match is not None
+                        and peer.match.is_over()):
+                    peer.rematch()
+        
+        local_input = controller.control(None, None)
+        if not peer.tick(local_input):
+            draw_waiting(screen, waiting_message)
+        elif peer.match.is_over():
+            winner, loser = peer.match.result()
+            draw_game_over(screen, winner, loser)
+        else:
+            if background is None:
+                background = Background(STAGE_THEMES[peer.theme], stage_width)
+                camera.follow(peer.match.fighters, snap=True)
+            camera.follow(peer.match.fighters)
+            draw_fighting(screen, peer.match.fighters, background, camera)
+            if show_profiler:
+                draw_profiler(screen, governor, peer.match.fighters,
+                              rollback=peer if isinstance(peer, RollbackSession) else None)
+        
+        display.present()
+        governor.end_frame()
+        clock.tick(FPS)
+    
+    pygame.quit()
+    sys.exit()
+
+# Spectator mode: CPU matches (--spectate) or recorded replays (--watch) at
+# a multiple of real time. Every frame is simulated, with particles and the
+# camera advancing in simulation time, but only every k-th frame is drawn.
+# k starts at the speed (one draw per display refresh) and grows when the
+# measured simulation and drawing costs would not fit in real time, so
+# higher speeds spend the CPU simulating. Sounds are muted above 1x.
+TURBO_KEYS = {K_1: 1, K_2: 2, K_3: 4, K_4: 16, K_5: 0}  # 0: as fast as possible
+TURBO_DRAW_SHARE = 0.1     # Unlimited speed: share of the time spent drawing
+TURBO_MIN_DRAW_RATE = 10   # Unlimited speed: draws per second at least
+
+class TurboClock:
+    def __init__(self, speed=1):
+        self.speed = speed
+        self.sim_time = 0.0001   # Moving averages, seconds per simulated / drawn frame
+        self.draw_time = 0.001
+    
+    def frames_per_draw(self):
+        if self.speed:
+            frame_time = 1 / (FPS * self.speed)  # Real time per simulated frame
+            if frame_time > self.sim_time:
+                return max(self.speed, math.ceil(self.draw_time / (frame_time - self.sim_time)))
+        # Unlimited, or the simulation alone can't keep up
+        frames = self.draw_time * (1 - TURBO_DRAW_SHARE) / TURBO_DRAW_SHARE / self.sim_time
+        return max(1, min(int(frames), int(1 / TURBO_MIN_DRAW_RATE / self.sim_time)))
+    
+    def measure(self, frames, sim_time, draw_time):
+        if frames:
+            self.sim_time += (sim_time / frames - self.sim_time) * 0.1
+        self.draw_time += (draw_time - self.draw_time) * 0.1
+    
+    def rate(self, frames):
+        # Frame cap for the display loop; 0 runs uncapped
+        return FPS * self.speed / frames if self.speed else 0
+
+def cpu_matches(args, frame_data, policy=None):
+    rng = random.Random()
+    count = 2 if args.mode == "versus" else args.players
+    while True:
+        match = create_match([rng.choice(CHARACTERS)[2] for _ in range(count)], args.mode)
+        controllers = [PolicyController(policy) if policy else CpuController(rng.random(), frame_data)
+                       for _ in range(count)]
+        yield match, (lambda frame, match=match, controllers=controllers:
+                      [controller.control(fighter, match.target_of(fighter))
+                       for controller, fighter in zip(controllers, match.fighters)]), None
+
+def replay_matches(paths):
+    for path in paths:
+        for replay in read_replays(path):
+            yield replay.new_match(), replay.frame_inputs, replay.frames()
+
+def draw_spectator_hud(screen, turbo, frames, number, match, last_winner):
+    speed = f"{turbo.speed}x" if turbo.speed else "MAX"
+    lines = [
+        f"SPEED {speed}  (drawing 1 of {frames} frames)   1-5: 1x 2x 4x 16x MAX",
+        f"MATCH {number}  FRAME {match.frame}",
+    ]
+    if last_winner:
+        lines.append(f"LAST WINNER {last_winner}")
+    for row, line in enumerate(lines):
+        screen.blit(render_text(profiler_font, line, WHITE), (10, SCREEN_HEIGHT - 10 - (len(lines) - row) * 18))
+
+def spectate_main(args):
+    global recorder, muted
+    display = Display(args.width, args.height, args.fullscreen, SCALE_SMOOTH if args.smooth else SCALE_FAST)
+    screen = display.canvas
+    preload_atlases([fighter_class for _, _, fighter_class in CHARACTERS])
+    if args.watch:
+        # Replays being watched are not recorded again
+        recording, recorder = recorder, None
+        source = replay_matches(args.watch)
+    else:
+        source = cpu_matches(args, FrameData.read(args.frame_data) if args.frame_data else None,
+                             Policy.read(args.policy) if args.policy else None)
+    
+    turbo = TurboClock()
+    number, last_winner = 0, None
+    match = None
+    running = True
+    while running:
+        for event in pygame.event.get():
+            if event.type == QUIT:
+                running = False
+            if event.type == VIDEORESIZE:
+                display.resize()
+            if event.type == KEYDOWN:
+                if event.key == K_ESCAPE:
+                    running = False
+                if event.key == K_F9:
+                    display.toggle_scale_mode()
+                if event.key in TURBO_KEYS:
+                    turbo.speed = TURBO_KEYS[event.key]
+        muted = turbo.speed != 1
+        
+        frames = turbo.frames_per_draw()
+        start = time.perf_counter()
+        simulated = 0
+        while simulated < frames:
+            if match is None or match.is_over() or (length is not None and match.frame >= length):
+                if match is not None:
+                    last_winner = match.result()[0].name
+                match, inputs, length = next(source, (None, None, None))
+                if match is None:
+                    running = False
+                    break
+                number += 1
+                width = match.fighters[0].stage_width
+                background = Background(random.choice(STAGE_THEMES), width)
+                camera = Camera(width)
+                camera.follow(match.fighters, snap=True)
+            match.step(inputs(match.frame))
+            camera.follow(match.fighters)
+            simulated += 1
+        if match is None:
+            break
+        simulated_at = time.perf_counter()
+        
+        draw_fighting(screen, match.fighters, background, camera)
+        draw_spectator_hud(screen, turbo, frames, number, match, last_winner)
+        display.present()
+        turbo.measure(simulated, simulated_at - start, time.perf_counter() - simulated_at)
+        clock.tick(turbo.rate(frames))
+    
+    muted = False
+    if args.watch:
+        recorder = recording
     pygame.quit()
     sys.exit()
 
+# Headless benchmark: CPU players fight on an offscreen canvas and the
+# simulation and drawing time of every frame is measured
+def run_benchmark(args):
+    rng = random.Random(1)
+    count = 2 if args.mode == "versus" else args.players
+    fighter_classes = [rng.choice(CHARACTERS)[2] for _ in range(count)]
+    preload_atlases([fighter_class for _, _, fighter_class in CHARACTERS])
+    canvas = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT))
+    background = Background(rng.choice(STAGE_THEMES), stage_width)
+    camera = Camera(stage_width)
+    
+    match = create_match(fighter_classes, args.mode)
+    camera.follow(match.fighters, snap=True)
+    if memory:
+        memory.start_match()
+    controllers = [CpuController(seed) for seed in range(count)]
+    sim_times, draw_times = [], []
+    peak_particles = 0
+    for _ in range(args.bench):
+        # Restart finished matches so the whole run is spent fighting
+        if match.is_over():
+            if memory:
+                memory.end_match(match.fighters)
+            match = create_match(fighter_classes, args.mode)
+            camera.follow(match.fighters, snap=True)
+            if memory:
+                memory.start_match()
+        
+        if memory:
+            memory.begin_frame()
+        start = time.perf_counter()
+        inputs = [controller.control(fighter, match.target_of(fighter))
+                  for controller, fighter in zip(controllers, match.fighters)]
+        match.step(inputs)
+        camera.follow(match.fighters)
+        simulated = time.perf_counter()
+        draw_fighting(canvas, match.fighters, background, camera)
+        drawn = time.perf_counter()
+        
+        if memory:
+            memory.end_frame()
+        
+        sim_times.append(simulated - start)
+        draw_times.append(drawn - simulated)
+        peak_particles = max(peak_particles, sum(len(fighter.particles) for fighter in match.fighters))
+    
+    frame_times = sorted(a + b for a, b in zip(sim_times, draw_times))
+    average = sum(frame_times) / len(frame_times)
+    p99 = frame_times[min(len(frame_times) - 1, int(len(frame_times) * 0.99))]
+    budget = 1 / FPS
+    print(f"{args.mode} with {count} fighters, {len(frame_times)} frames, peak {peak_particles} particles")
+    print(f"  simulation {sum(sim_times) / len(sim_times) * 1000:.3f} ms/frame, "
+          f"drawing {sum(draw_times) / len(draw_times) * 1000:.3f} ms/frame")
+    print(f"  frame avg {average * 1000:.3f} ms, p99 {p99 * 1000:.3f} ms, "
+          f"{1 / average:.0f} FPS (budget {budget * 1000:.1f} ms)")
+    if memory:
+        # tracemalloc slows every allocation, so only the memory budgets apply
+        memory.end_match(match.fighters)
+        failures = memory.over_budget(args.memory_budget * 1024, args.frame_alloc_budget * 1024)
+        for failure in failures:
+            print(f"  FAIL: {failure}")
+        return 1 if failures else 0
+    if args.fixed:
+        fixed = time_simulation(fighter_classes, args.mode, args.bench, True)
+        floating = time_simulation(fighter_classes, args.mode, args.bench, False)
+        print(f"  headless simulation: fixed-point {fixed * 1e6:.1f} us/frame, "
+              f"float {floating * 1e6:.1f} us/frame ({fixed / floating:.2f}x)")
+    return 0 if p99 <= budget else 1
+
+# Seconds per frame of a headless CPU match (no effects, no drawing)
+def time_simulation(fighter_classes, mode, frames, fixed):
+    global effect_scale, recorder
+    scale, effect_scale = effect_scale, 0
+    recording, recorder = recorder, None
+    controllers = [CpuController(seed) for seed in range(len(fighter_classes))]
+    match = create_match(fighter_classes, mode, fixed)
+    start = time.perf_counter()
+    for _ in range(frames):
+        if match.is_over():
+            match = create_match(fighter_classes, mode, fixed)
+        match.step([controller.control(fighter, match.target_of(fighter))
+                    for controller, fighter in zip(controllers, match.fighters)])
+    elapsed = time.perf_counter() - start
+    effect_scale = scale
+    recorder = recording
+    return elapsed / frames
+
+# Host and client in one process over localhost, both CPU-controlled, with
+# simulated loss and delay on a virtual clock. Checks that every state the
+# client reconstructs from deltas matches what the host sent.
+def run_net_selftest(args):
+    now = [0.0]
+    virtual_clock = lambda: now[0]
+    host_link = LossyLink(open_udp_socket(("127.0.0.1", 0)), args.loss, args.delay / 1000, args.jitter / 1000,
+                          seed=1, clock=virtual_clock)
+    client_link = LossyLink(open_udp_socket(("127.0.0.1", 0)), args.loss, args.delay / 1000, args.jitter / 1000,
+                            seed=2, clock=virtual_clock)
+    host = NetHost(host_link, 0, 0)
+    client = NetClient(client_link, host_link.sock.getsockname(), 3)
+    host_cpu, client_cpu = CpuController(1), CpuController(2)
+    
+    checked = mismatches = lag = 0
+    for _ in range(args.net_selftest):
+        now[0] += 1 / FPS
+        client_input = 0
+        if client.match is not None:
+            fighter, opponent = client.match.fighters[1], client.match.fighters[0]
+            client_input = client_cpu.control(fighter, opponent)
+        client.tick(client_input)
+        
+        host_input = 0
+        if host.match is not None:
+            host_input = host_cpu.control(host.match.fighters[0], host.match.fighters[1])
+            if host.match.is_over():
+                host.rematch()
+        host.tick(host_input)
+        
+        client.poll()
+        if client.latest_frame is not None:
+            checked += 1
+            lag += host.match.frame - client.latest_frame
+            if client.history[client.latest_frame] != host.history.get(client.latest_frame):
+                mismatches += 1
+    
+    full_size = STATE_HEADER.size + sum(FIELD_MASK.size + full.size for full in host.codec.full)
+    print(f"{host.match.frame} frames simulated, loss {args.loss:.0%}, "
+          f"delay {args.delay:.0f}+{args.jitter:.0f} ms")
+    print(f"  host sent {host_link.packets_sent} packets ({host_link.packets_dropped} dropped), "
+          f"client sent {client_link.packets_sent} ({client_link.packets_dropped} dropped)")
+    print(f"  state packets avg {host.state_bytes / host.state_packets:.1f} bytes (full state {full_size} bytes), "
+          f"{host_link.bytes_sent * FPS / max(1, host.state_packets):.0f} B/s")
+    print(f"  encode {host.encode_time / host.state_packets * 1e6:.1f} us/tick, "
+          f"decode {client.decode_time / max(1, checked) * 1e6:.1f} us/tick")
+    print(f"  client behind host by {lag / max(1, checked):.1f} frames on average, "
+          f"{mismatches} mismatched states out of {checked} checked")
+    return 1 if mismatches or not checked else 0
+
+# Two rollback peers over localhost with injected latency, both
+# CPU-controlled. Every confirmed state on both sides is checked against a
+# plain simulation of the inputs that were actually played.
+def run_rollback_selftest(args):
+    now = [0.0]
+    virtual_clock = lambda: now[0]
+    totals = {"frames": 0, "rounds": 0, "checked": 0, "mismatches": 0}
+    sessions = []
+    remaining = args.rollback_selftest
+    while remaining > 0:
+        links = [LossyLink(open_udp_socket(("127.0.0.1", 0)), args.loss, args.delay / 1000, args.jitter / 1000,
+                           seed=totals["rounds"] * 2 + slot, clock=virtual_clock) for slot in range(2)]
+        peers = [RollbackSession(links[0], 0, input_delay=args.input_delay),
+                 RollbackSession(links[1], 3, links[0].sock.getsockname(), input_delay=args.input_delay)]
+        controllers = [CpuController(totals["rounds"] * 2 + slot) for slot in range(2)]
+        confirmed = [{}, {}]
+        played = [{}, {}]
+        for slot, peer in enumerate(peers):
+            peer.on_confirmed = confirmed[slot].__setitem__
+        
+        while remaining > 0 and not all(peer.match is not None and peer.match.is_over() for peer in peers):
+            now[0] += 1 / FPS
+            remaining -= 1
+            for slot, peer in enumerate(peers):
+                bits = 0
+                if peer.match is not None:
+                    bits = controllers[slot].control(peer.match.fighters[peer.local], peer.match.fighters[peer.remote])
+                peer.tick(bits)
+                for frame, frame_bits in peer.local_inputs.items():
+                    played[peer.local].setdefault(frame, frame_bits)
+        # Let the last inputs arrive so the end of the match gets confirmed
+        for _ in range(60):
+            now[0] += 1 / FPS
+            for peer in peers:
+                if peer.match is not None:
+                    peer.tick(0)
+        
+        reference = create_match([CHARACTERS[0][2], CHARACTERS[3][2]])
+        last = min(peer.confirmed_frame for peer in peers)
+        for frame in range(last + 1):
+            reference.step([played[0].get(frame, 0), played[1].get(frame, 0)])
+            expected = reference.save_state()[1]
+            for slot in range(2):
+                totals["checked"] += 1
+                if confirmed[slot].get(frame) != expected:
+                    totals["mismatches"] += 1
+        totals["frames"] += last + 1
+        totals["rounds"] += 1
+        sessions += peers
+        for link in links:
+            link.sock.close()
+    
+    rollbacks = sum(peer.rollbacks for peer in sessions)
+    resimulated = sum(peer.frames_resimulated for peer in sessions)
+    frame_cost = sum(peer.sim_time for peer in sessions) / max(1, sum(peer.frames_simulated for peer in sessions))
+    budget = max(peer.budget_fraction() for peer in sessions)
+    print(f"{totals['frames']} confirmed frames over {totals['rounds']} matches, loss {args.loss:.0%}, "
+          f"delay {args.delay:.0f}+{args.jitter:.0f} ms, input delay {args.input_delay}")
+    print(f"  {rollbacks} rollbacks, {resimulated} frames resimulated "
+          f"(longest {max(peer.longest_rollback for peer in sessions)}), "
+          f"{sum(peer.stalls for peer in sessions)} stalled frames")
+    print(f"  simulation {frame_cost * 1e6:.1f} us/frame (worst {max(peer.worst_frame for peer in sessions) * 1e6:.1f} us), "
+          f"worst resimulation {max(peer.worst_resimulation for peer in sessions) * 1000:.2f} ms")
+    print(f"  a full {ROLLBACK_WINDOW}-frame rollback costs up to {budget:.1%} "
+          f"of the {1000 / FPS:.1f} ms frame")
+    print(f"  {totals['mismatches']} mismatched states out of {totals['checked']} checked")
+    desyncs = sum(peer.desync_frame is not None for peer in sessions)
+    print(f"  {sum(peer.hashes_compared for peer in sessions)} state hashes compared between peers, "
+          f"{desyncs} desyncs reported")
+    return 1 if totals["mismatches"] or desyncs or not totals["checked"] else 0
+
+def parse_resolution(value):
+    try:
+        width, height = (int(v) for v in value.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected WIDTHxHEIGHT, got {value!r}")
+    return width, height
+
+def parse_address(value):
+    host, _, port = value.rpartition(":")
+    if not host or not port.isdigit():
+        raise argparse.ArgumentTypeError(f"expected HOST:PORT, got {value!r}")
+    return host, int(port)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Python Street Fighter")
+    parser.add_argument("--resolution", type=parse_resolution, default=None,
+                        help="output window size as WIDTHxHEIGHT (game is rendered at %dx%d and scaled)"
+                        % (SCREEN_WIDTH, SCREEN_HEIGHT))
+    parser.add_argument("--fullscreen", action="store_true",
+                        help="run fullscreen at the desktop resolution unless --resolution is given")
+    parser.add_argument("--smooth", action="store_true",
+                        help="use smooth (bilinear) scaling instead of fast nearest-neighbour (toggle with F9)")
+    parser.add_argument("--mode", choices=MATCH_MODES, default="versus",
+                        help="versus (1v1), 2v2 (P1+P3 vs P2+P4) or ffa (free-for-all)")
+    parser.add_argument("--players", type=int, choices=(3, 4), default=4,
+                        help="number of fighters in 2v2/ffa modes; players beyond P2 are CPU")
+    parser.add_argument("--quality", choices=["auto"] + QUALITY_NAMES, default="auto",
+                        help="effects quality; auto adapts it to hold the frame budget (F3 shows the profiler overlay)")
+    parser.add_argument("--threaded", action="store_true",
+                        help="run the simulation on its own fixed-rate thread; the window draws its latest snapshot")
+    parser.add_argument("--cpu", type=int, choices=(0, 1, 2), default=0,
+                        help="number of CPU-controlled players among P1/P2 (counted from P2)")
+    parser.add_argument("--bench", type=int, metavar="FRAMES", default=0,
+                        help="run a headless CPU-vs-CPU benchmark for FRAMES frames and exit")
+    parser.add_argument("--host", type=int, metavar="PORT",
+                        help="host a network versus match on this UDP port")
+    parser.add_argument("--join", type=parse_address, metavar="HOST:PORT",
+                        help="join a network versus match")
+    parser.add_argument("--character", type=int, choices=range(len(CHARACTERS)), default=0,
+                        help="character index for network play")
+    parser.add_argument("--loss", type=float, default=0.0,
+                        help="simulated outgoing packet loss (0-1) for network play")
+    parser.add_argument("--delay", type=float, default=0.0,
+                        help="simulated outgoing packet delay in ms for network play")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="extra random outgoing packet delay in ms for network play")
+    parser.add_argument("--server", type=int, metavar="PORT",
+                        help="run a headless match server on this local TCP port")
+    parser.add_argument("--server-matches", type=int, default=0, metavar="N",
+                        help="bot-vs-bot matches the server keeps running")
+    parser.add_argument("--bots", type=int, default=0, metavar="N",
+                        help="with --server, also start N local bot clients (load test)")
+    parser.add_argument("--connect", type=parse_address, metavar="HOST:PORT",
+                        help="with --bots, connect the bot clients to an existing server")
+    parser.add_argument("--duration", type=float, default=0, metavar="SECONDS",
+                        help="stop the server / bot clients after this long")
+    parser.add_argument("--rollback", action="store_true",
+                        help="with --host/--join, use rollback netcode instead of an authoritative host")
+    parser.add_argument("--input-delay", type=int, default=0, metavar="FRAMES",
+                        help="local input delay for rollback netcode")
+    parser.add_argument("--rollback-selftest", type=int, metavar="FRAMES", default=0,
+                        help="run two rollback peers over localhost for FRAMES frames and exit")
+    parser.add_argument("--telemetry", metavar="FILE",
+                        help="record combat events to FILE (*.jsonl.gz for JSON lines, otherwise columnar)")
+    parser.add_argument("--telemetry-summary", nargs="+", metavar="FILE",
+                        help="print event counts from telemetry files and exit")
+    parser.add_argument("--memory", action="store_true",
+                        help="trace memory use (tracemalloc and per-subsystem counters) and report at exit")
+    parser.add_argument("--memory-budget", type=float, default=0, metavar="KIB",
+                        help="with --bench, fail if any match's peak traced memory exceeds KIB (implies --memory)")
+    parser.add_argument("--frame-alloc-budget", type=float, default=0, metavar="KIB",
+                        help="with --bench, fail if p99 per-frame allocations exceed KIB (implies --memory)")
+    parser.add_argument("--fixed", action="store_true",
+                        help="simulate in fixed-point integers (bit-identical on every machine; "
+                        "both network peers must use it)")
+    parser.add_argument("--stage-width", type=int, default=SCREEN_WIDTH, metavar="PIXELS",
+                        help="fight on a stage this wide with a scrolling camera "
+                        "(at least %d; both network peers must use the same width)" % SCREEN_WIDTH)
+    parser.add_argument("--record", metavar="FILE",
+                        help="record every match (inputs, per-frame state hashes and states) to a replay FILE")
+    parser.add_argument("--verify-replay", nargs="+", metavar="FILE",
+                        help="re-simulate replay files, report the first diverging frame and field, and exit")
+    parser.add_argument("--golden-build", action="store_true",
+                        help="record the golden-replay corpus (every pairing, float and fixed point, two stage "
+                        "widths, 2v2 and free-for-all) and its throughput baseline into golden/ and exit")
+    parser.add_argument("--golden", action="store_true",
+                        help="re-simulate the committed golden-replay corpus, check it for divergences, report "
+                        "throughput against the baseline in golden/, and exit")
+    parser.add_argument("--batch-bench", type=int, metavar="MATCHES", default=0,
+                        help="check the NumPy batch kernel against Match, time it on MATCHES matches and exit")
+    parser.add_argument("--pool-bench", type=int, metavar="MATCHES", default=0,
+                        help="step MATCHES matches in shared-memory worker processes with random actions and exit")
+    parser.add_argument("--workers", type=int, default=0, metavar="N",
+                        help="worker processes for --pool-bench (default: one per CPU)")
+    parser.add_argument("--pixel-bench", type=int, metavar="MATCHES", default=0,
+                        help="time 84x84 grayscale pixel observations for MATCHES batched matches and exit, "
+                             "failing if they cost more than PIXEL_RATIO_LIMIT times the state vector")
+    parser.add_argument("--pixel-dump", metavar="PNG",
+                        help="with --pixel-bench, save the first match's last frame stack")
+    parser.add_argument("--spectate", action="store_true",
+                        help="watch endless CPU matches; keys 1-5 set 1x/2x/4x/16x/unlimited speed")
+    parser.add_argument("--watch", nargs="+", metavar="FILE",
+                        help="play back recorded replays (speed keys as for --spectate)")
+    parser.add_argument("--train", metavar="FILE",
+                        help="train per-character CPU policies by self-play (continuing FILE if it exists), "
+                        "save them to FILE and exit")
+    parser.add_argument("--train-matches", type=int, default=1024, metavar="MATCHES",
+                        help="matches played in parallel while training")
+    parser.add_argument("--train-steps", type=int, default=3000, metavar="STEPS",
+                        help="frames each training match is stepped")
+    parser.add_argument("--train-eval", type=int, default=50, metavar="ROUNDS",
+                        help="evaluation rounds against the scripted CPU before and after training")
+    parser.add_argument("--policy", metavar="FILE",
+                        help="CPU players use the trained policies in FILE")
+    parser.add_argument("--frame-data-build", metavar="FILE",
+                        help="simulate every move/guard/spacing interaction, write the frame-data tables and exit")
+    parser.add_argument("--frame-data", metavar="FILE",
+                        help="CPU players choose moves from these frame-data tables")
+    parser.add_argument("--net-selftest", type=int, metavar="FRAMES", default=0,
+                        help="run host and client over localhost for FRAMES frames and exit")
+    args = parser.parse_args(argv)
+    if args.stage_width < SCREEN_WIDTH:
+        parser.error(f"--stage-width must be at least {SCREEN_WIDTH}")
+    if args.mode == "2v2":
+        args.players = 4
+    if args.resolution:
+        args.width, args.height = args.resolution
+    elif args.fullscreen:
+        args.width = args.height = 0
+    else:
+        args.width, args.height = SCREEN_WIDTH, SCREEN_HEIGHT
+    return args
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    args = parse_args()
+    if args.telemetry_summary:
+        sys.exit(summarize_telemetry(args.telemetry_summary))
+    fixed_point = args.fixed
+    stage_width = args.stage_width
+    if args.verify_replay:
+        sys.exit(run_verify_replays(args))
+    if args.golden_build:
+        sys.exit(run_golden_build(args))
+    if args.golden:
+        sys.exit(run_golden(args))
+    start_telemetry(args.telemetry)
+    start_recording(args.record)
+    start_memory_monitor(args.memory or args.memory_budget or args.frame_alloc_budget)
+    try:
+        if args.bench:
+            sys.exit(run_benchmark(args))
+        if args.batch_bench:
+            sys.exit(run_batch_benchmark(args))
+        if args.pool_bench:
+            sys.exit(run_pool_benchmark(args))
+        if args.pixel_bench:
+            sys.exit(run_pixel_benchmark(args))
+        if args.frame_data_build:
+            sys.exit(run_frame_data_build(args))
+        if args.train:
+            sys.exit(run_policy_training(args))
+        if args.net_selftest:
+            sys.exit(run_net_selftest(args))
+        if args.rollback_selftest:
+            sys.exit(run_rollback_selftest(args))
+        if args.server:
+            sys.exit(run_server(args))
+        if args.bots and args.connect:
+            run_bot_clients(*args.connect, args.bots, args.duration or 10)
+            sys.exit()
+        if args.host or args.join:
+            netplay_main(args)
+        if args.spectate or args.watch:
+            spectate_main(args)
+        main(args)
+    finally:
+        stop_memory_monitor()
+        stop_recording()
+        stop_telemetry()